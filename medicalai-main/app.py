@@ -1,4 +1,4 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session, render_template, jsonify
+from flask import Flask, render_template_string, request, redirect, url_for, session, render_template, jsonify, g, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
 import whisper
 import os
@@ -6,13 +6,29 @@ import tempfile
 import google.generativeai as genai
 from dotenv import load_dotenv
 import sqlite3
-from datetime import datetime, timedelta
-from functools import wraps
+import base64
+import json
+import csv
+import argparse
+import itertools
+import heapq
+from array import array
+from datetime import datetime, timedelta, date
+from decimal import Decimal
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import re
 import sys
+import unicodedata
+import queue
+import threading
+import random
+import time
+from urllib.request import pathname2url, Request, urlopen
 
 print("="*50)
-print("啟動應用程式 (純 SQLite 版)")
+print("啟動應用程式")
 print("="*50)
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -22,18 +38,738 @@ app = Flask(__name__)
 app.secret_key = "supersecretkey"
 
 # === 資料庫設定 ===
-SQLITE_DB_FILE = os.path.join(basedir, 'medical_appointments.db')
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE") or os.path.join(basedir, 'medical_appointments.db')
+
+# 資料庫後端：sqlite（預設）、mysql、postgresql；沿用舊設定 USE_SQLITE=false 時視為 mysql
+DB_BACKEND = (os.getenv("DB_BACKEND") or ("mysql" if os.getenv("USE_SQLITE", "true").lower() == "false" else "sqlite")).lower()
+if DB_BACKEND in ("postgres", "pg"):
+    DB_BACKEND = "postgresql"
+if DB_BACKEND not in ("sqlite", "mysql", "postgresql"):
+    print(f"[警告] 未知的 DB_BACKEND={DB_BACKEND}，改用 sqlite")
+    DB_BACKEND = "sqlite"
+# MySQL / PostgreSQL 連線設定（與診斷腳本使用相同的環境變數）
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = int(os.getenv("DB_PORT") or (3306 if DB_BACKEND == "mysql" else 5432))
+DB_USER = os.getenv("DB_USER", "postgres" if DB_BACKEND == "postgresql" else "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "")
+DB_NAME = os.getenv("DB_NAME", "medical_db")
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+
+# 各後端的 SQL 差異：placeholder 格式、upsert 語法、不分大小寫的 LIKE、是否有 FTS5 全文索引
+DB_DIALECTS = {
+    "sqlite": {"placeholder": "?", "upsert": "on_conflict", "like": "LIKE", "fulltext": True},
+    "mysql": {"placeholder": "%s", "upsert": "on_duplicate_key", "like": "LIKE", "fulltext": False},
+    "postgresql": {"placeholder": "%s", "upsert": "on_conflict", "like": "ILIKE", "fulltext": False},
+}
+DB_DIALECT = DB_DIALECTS[DB_BACKEND]
+
+# 每個 worker 最多保留幾條閒置連線；0 表示不使用連線池（用完即關閉）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4") or 0)
+# GET / HEAD 路由改用唯讀連線（SQLite 以 mode=ro 開檔並設定 query_only），唯讀連線池大小獨立設定
+DB_READONLY_GET = os.getenv("DB_READONLY_GET", "1") == "1"
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "8") or 0)
+# 設為 1 時，每個請求會在 log 與 X-DB-Stats header 回報連線使用次數與執行的 SQL 語句數
+DB_DEBUG_STATS = os.getenv("DB_DEBUG_STATS", "0") == "1"
+# 併發設定檔：legacy 為原本的 rollback journal 模式；wal 讓讀取不會被寫入阻擋
+SQLITE_PROFILES = {
+    "legacy": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+    },
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -16000,  # 負數代表 KiB，約 16 MB
+        "temp_store": "MEMORY",
+        "journal_size_limit": 64 * 1024 * 1024,
+    },
+}
+DB_PROFILE = os.getenv("DB_PROFILE", "wal")
+if DB_PROFILE not in SQLITE_PROFILES:
+    print(f"[警告] 未知的 DB_PROFILE={DB_PROFILE}，改用 wal")
+    DB_PROFILE = "wal"
+# SQLITE_BUSY 時的重試次數與基本等待秒數（指數退避並加上隨機抖動）
+DB_BUSY_RETRIES = int(os.getenv("DB_BUSY_RETRIES", "5"))
+DB_BUSY_BACKOFF = float(os.getenv("DB_BUSY_BACKOFF", "0.05"))
+# SQLite 在驅動層等待鎖的毫秒數（PRAGMA busy_timeout）；有重試時只短暫等待，主要由 retry_on_busy 退避，
+# 最壞情況約為 (DB_BUSY_RETRIES + 1) × busy_timeout 加上退避時間；關閉重試（0）時沿用 sqlite3 預設的 5 秒
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "100" if DB_BUSY_RETRIES > 0 else "5000"))
+# WAL 背景 checkpoint 間隔（秒）；WAL 檔超過 journal_size_limit 時改用 TRUNCATE 縮回
+DB_CHECKPOINT_INTERVAL = float(os.getenv("DB_CHECKPOINT_INTERVAL", "30"))
+
+def build_connection_pragmas(profile_name=DB_PROFILE, readonly=False):
+    """依設定檔產生每條連線建立時只執行一次的 PRAGMA；唯讀連線不變更日誌模式，並開啟 query_only。"""
+    pragmas = ["PRAGMA foreign_keys = ON", f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}"]
+    pragmas.extend(
+        f"PRAGMA {name} = {value}" for name, value in SQLITE_PROFILES[profile_name].items()
+        if not (readonly and name in ("journal_mode", "journal_size_limit"))
+    )
+    if readonly:
+        pragmas.append("PRAGMA query_only = ON")
+    return tuple(pragmas)
+
+SQLITE_CONNECTION_PRAGMAS = build_connection_pragmas()
+SQLITE_READONLY_PRAGMAS = build_connection_pragmas(readonly=True)
+
+# 伺服器資料庫可重試的錯誤：MySQL 1205 lock wait timeout、1213 deadlock；PostgreSQL 40001 serialization failure、40P01 deadlock
+RETRYABLE_SERVER_ERRORS = {1205, 1213, "40001", "40P01"}
+
+def is_busy_error(error):
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error).lower()
+        return "locked" in message or "busy" in message
+    code = getattr(error, "pgcode", None) or (error.args[0] if error.args else None)
+    return DB_BACKEND != "sqlite" and code in RETRYABLE_SERVER_ERRORS
+
+def retry_on_busy(func, attempts=DB_BUSY_RETRIES, backoff=DB_BUSY_BACKOFF):
+    """執行 func()；遇到 SQLITE_BUSY / database is locked（或伺服器端 deadlock）時以指數退避加隨機抖動重試。"""
+    for attempt in range(attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if not is_busy_error(e) or attempt == attempts:
+                raise
+            time.sleep(backoff * (2 ** attempt) * (0.5 + random.random()))
+
+def begin_write_transaction(conn):
+    """開始寫入交易：SQLite 以 BEGIN IMMEDIATE 先取得寫入鎖；MySQL / PostgreSQL 在第一個語句時自動開始交易。"""
+    if DB_BACKEND == "sqlite":
+        conn.execute("BEGIN IMMEDIATE")
+
+@lru_cache(maxsize=1024)
+def translate_placeholders(sql):
+    """將 SQL 中的 ? 轉成目前後端的 placeholder；字串常值內的 ? 不轉換，% 需跳脫為 %%。"""
+    if DB_DIALECT["placeholder"] == "?":
+        return sql
+    parts = []
+    quote = None
+    for char in sql:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in ("'", '"'):
+            quote = char
+        elif char == "?":
+            parts.append("%s")
+            continue
+        parts.append("%%" if char == "%" else char)
+    return "".join(parts)
+
+def upsert_new_value(column):
+    """upsert 的 UPDATE 子句中代表「這次要新增的值」的運算式。"""
+    return f"VALUES({column})" if DB_DIALECT["upsert"] == "on_duplicate_key" else f"excluded.{column}"
+
+def build_upsert_sql(table_name, columns, conflict_columns, update_columns, values=None):
+    """產生目前後端的 upsert 語句（SQLite / PostgreSQL 為 ON CONFLICT，MySQL 為 ON DUPLICATE KEY UPDATE）。
+
+    values 可為個別欄位指定 SQL 運算式（預設為 ?）；update_columns 為 {欄位: 運算式}，
+    運算式為 None 時代表沿用這次要新增的值。
+    """
+    values = values or {}
+    sql = (
+        f"INSERT INTO {table_name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(values.get(column, '?') for column in columns)})"
+    )
+    assignments = []
+    for column, expression in update_columns.items():
+        if expression is None:
+            expression = upsert_new_value(column)
+        assignments.append(f"{column} = {expression}")
+    if DB_DIALECT["upsert"] == "on_duplicate_key":
+        return sql + " ON DUPLICATE KEY UPDATE " + ", ".join(assignments)
+    return sql + f" ON CONFLICT({', '.join(conflict_columns)}) DO UPDATE SET " + ", ".join(assignments)
+
+class PooledConnection:
+    """由連線管理器發出的連線（SQLite 與 MySQL / PostgreSQL 共用的借還邏輯）。
+
+    close() 不會真的關閉連線：在請求中，同一請求的所有 helper 共用同一條連線，
+    直到 teardown 才交回連線池；在請求外（init_db、腳本）則直接交回連線池。
+    與原本一樣，最外層 close() 時尚未 commit 的變更會被 rollback。
+    """
+
+    borrow_depth = 0
+    request_bound = False
+    readonly = False
+    pid = None
+    archive_attached = False
+
+    def close(self):
+        if self.borrow_depth <= 0:
+            return
+        self.borrow_depth -= 1
+        if self.borrow_depth:
+            return
+        if self.in_transaction:
+            self.rollback()
+        if not self.request_bound:
+            release_db_connection(self)
+
+    def is_usable(self):
+        return True
+
+class ManagedConnection(PooledConnection, sqlite3.Connection):
+    """由連線管理器發出的 SQLite 連線。"""
+
+    def close_physical(self):
+        sqlite3.Connection.close(self)
+
+def _normalize_db_value(value):
+    """伺服器資料庫回傳的日期與 Decimal 轉成與 SQLite 相同的字串與數字，模板與排序不必區分後端。"""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+class DBRow(dict):
+    """伺服器資料庫的查詢結果列；與 sqlite3.Row 相同，可用欄位名稱或位置存取。"""
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return super().__getitem__(key)
+
+class ServerCursor:
+    """包裝 pymysql / psycopg2 的 cursor：轉換 placeholder 並回傳 DBRow。"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.raw = connection.raw.cursor()
+
+    def execute(self, sql, params=()):
+        self.connection.in_transaction = True
+        if DB_DEBUG_STATS:
+            count_db_query()
+        self.raw.execute(translate_placeholders(sql), tuple(params))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.connection.in_transaction = True
+        if DB_DEBUG_STATS:
+            count_db_query()
+        self.raw.executemany(translate_placeholders(sql), [tuple(params) for params in seq_of_params])
+        return self
+
+    def _to_row(self, values):
+        if values is None:
+            return None
+        names = [column[0] for column in self.raw.description]
+        return DBRow(zip(names, (_normalize_db_value(value) for value in values)))
 
-def get_db_connection():
-    """獲取 SQLite 資料庫連接"""
-    try:
-        conn = sqlite3.connect(SQLITE_DB_FILE)
+    def fetchone(self):
+        return self._to_row(self.raw.fetchone())
+
+    def fetchall(self):
+        return [self._to_row(values) for values in self.raw.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    @property
+    def lastrowid(self):
+        if DB_BACKEND == "postgresql":
+            # psycopg2 的 lastrowid 是 OID，改取同一連線最後一次取得的序列值
+            self.raw.execute("SELECT lastval()")
+            return self.raw.fetchone()[0]
+        return self.raw.lastrowid
+
+    def close(self):
+        self.raw.close()
+
+class ServerConnection(PooledConnection):
+    """MySQL / PostgreSQL 連線，提供 app.py 使用到的 sqlite3.Connection 介面。
+
+    與 SQLite 相同，第一個語句會隱含開始交易；交回連線池時未 commit 的交易會被 rollback，
+    下一個請求不會看到舊的 snapshot。
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.in_transaction = False
+
+    def cursor(self):
+        return ServerCursor(self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self.raw.commit()
+        self.in_transaction = False
+
+    def rollback(self):
+        self.raw.rollback()
+        self.in_transaction = False
+
+    def is_usable(self):
+        """連線池取出的連線可能已被伺服器以 wait_timeout 等原因關閉。"""
+        if DB_BACKEND == "postgresql":
+            return not self.raw.closed
+        try:
+            self.raw.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def close_physical(self):
+        try:
+            self.raw.close()
+        except Exception:
+            pass
+
+# 伺服器資料庫的唯讀連線以 session 層級的 READ ONLY 交易模式擋下寫入
+SERVER_READONLY_SQL = {
+    "mysql": "SET SESSION TRANSACTION READ ONLY",
+    "postgresql": "SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY",
+}
+
+def _connect_server_database(readonly=False):
+    """開啟 MySQL（pymysql）或 PostgreSQL（psycopg2）連線；驅動只在選用該後端時才需要安裝。"""
+    if DB_BACKEND == "mysql":
+        try:
+            import pymysql
+        except ImportError:
+            raise RuntimeError("DB_BACKEND=mysql 需要安裝 pymysql")
+        raw = pymysql.connect(
+            host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, database=DB_NAME,
+            charset="utf8mb4", connect_timeout=DB_CONNECT_TIMEOUT, autocommit=False
+        )
+    else:
+        try:
+            import psycopg2
+        except ImportError:
+            raise RuntimeError("DB_BACKEND=postgresql 需要安裝 psycopg2-binary")
+        raw = psycopg2.connect(
+            host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, dbname=DB_NAME,
+            connect_timeout=DB_CONNECT_TIMEOUT
+        )
+    conn = ServerConnection(raw)
+    if readonly:
+        conn.execute(SERVER_READONLY_SQL[DB_BACKEND])
+        conn.commit()
+    return conn
+
+# 讀寫與唯讀連線分屬兩個連線池，各自有大小上限；fork 之後重新建立
+_db_pools = {}
+_db_pools_pid = None
+_db_stats_lock = threading.Lock()
+DB_CONNECTION_STATS = {"opened": 0, "reused": 0, "closed": 0}
+
+def _bump_db_stat(key):
+    with _db_stats_lock:
+        DB_CONNECTION_STATS[key] += 1
+    if has_request_context() and "db_stats" in g:
+        g.db_stats[key] = g.db_stats.get(key, 0) + 1
+
+def count_db_query(statement=None):
+    """DB_DEBUG_STATS 開啟時計算目前請求執行的 SQL 語句數（trigger 內的語句不計）。"""
+    if statement and statement.startswith("--"):
+        return
+    if has_request_context() and "db_stats" in g:
+        g.db_stats["queries"] = g.db_stats.get("queries", 0) + 1
+
+def request_memo(key, factory):
+    """同一請求內相同 key 只呼叫一次 factory（權限、可代辦對象、使用者資料）；請求外不快取。"""
+    if not has_request_context():
+        return factory()
+    memo = g.setdefault("request_memo", {})
+    if key not in memo:
+        memo[key] = factory()
+    return memo[key]
+
+def clear_request_memo():
+    """寫入後清除本請求的快取，之後的查詢會看到新資料。"""
+    if has_request_context():
+        g.pop("request_memo", None)
+
+def _open_db_connection(readonly=False):
+    """開啟新的實體連線並套用 PRAGMA（每條連線只套用一次）。"""
+    if DB_BACKEND != "sqlite":
+        conn = _connect_server_database(readonly)
+    else:
+        # busy 等待改由 PRAGMA busy_timeout（DB_BUSY_TIMEOUT）與 retry_on_busy 控制，不使用 sqlite3 預設的 5 秒 timeout
+        if readonly:
+            # mode=ro 以唯讀方式開檔，不會取得寫入鎖；query_only 讓誤寫的語句立即失敗
+            database = f"file:{pathname2url(SQLITE_DB_FILE)}?mode=ro"
+            conn = sqlite3.connect(database, uri=True, timeout=0, factory=ManagedConnection, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(SQLITE_DB_FILE, timeout=0, factory=ManagedConnection, check_same_thread=False)
         conn.row_factory = sqlite3.Row  # 讓結果可以像字典一樣訪問
+        for pragma in (SQLITE_READONLY_PRAGMAS if readonly else SQLITE_CONNECTION_PRAGMAS):
+            conn.execute(pragma)
+        if DB_DEBUG_STATS:
+            conn.set_trace_callback(count_db_query)
+    conn.readonly = readonly
+    conn.pid = os.getpid()
+    _bump_db_stat("opened")
+    return conn
+
+def _get_db_pool(readonly):
+    """回傳本行程的讀寫或唯讀連線池；大小設為 0 時回傳 None（用完即關閉）。"""
+    global _db_pools, _db_pools_pid
+    if _db_pools_pid != os.getpid():
+        # fork 之後不可沿用父行程的連線
+        _db_pools = {
+            False: queue.LifoQueue(maxsize=DB_POOL_SIZE) if DB_POOL_SIZE > 0 else None,
+            True: queue.LifoQueue(maxsize=DB_READ_POOL_SIZE) if DB_READ_POOL_SIZE > 0 else None,
+        }
+        _db_pools_pid = os.getpid()
+    return _db_pools[readonly]
+
+def _acquire_db_connection(readonly=False):
+    pool = _get_db_pool(readonly)
+    if pool is not None:
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            if conn.is_usable():
+                _bump_db_stat("reused")
+                return conn
+            conn.close_physical()
+            _bump_db_stat("closed")
+    return _open_db_connection(readonly)
+
+def release_db_connection(conn):
+    """將連線交回所屬的連線池；池已滿或未啟用連線池時直接關閉。"""
+    conn.borrow_depth = 0
+    conn.request_bound = False
+    if conn.in_transaction:
+        conn.rollback()
+    # fork 前開啟的連線不可交給子行程的連線池
+    pool = _get_db_pool(conn.readonly) if conn.pid == os.getpid() else None
+    if pool is not None:
+        try:
+            pool.put_nowait(conn)
+            return
+        except queue.Full:
+            pass
+    conn.close_physical()
+    _bump_db_stat("closed")
+
+def db_writes_on_get(f):
+    """標記會在 GET 請求中寫入資料庫的路由（例如封存、取消），讓它取得讀寫連線。
+
+    需放在 @login_required 之下，functools.wraps 才會把標記帶到外層函式。
+    """
+    f.db_writes_on_get = True
+    return f
+
+def request_uses_readonly_db():
+    """目前請求是否使用唯讀連線：GET / HEAD 且路由未標記 db_writes_on_get。"""
+    if not DB_READONLY_GET or request.method not in ("GET", "HEAD"):
+        return False
+    view = app.view_functions.get(request.endpoint)
+    return not getattr(view, "db_writes_on_get", False)
+
+def get_db_connection(readonly=None):
+    """獲取資料庫連接（同一請求內共用同一條連線）。
+
+    readonly 未指定時依請求決定：GET / HEAD 路由取得唯讀連線，其餘取得讀寫連線；請求外預設為讀寫連線。
+    """
+    try:
+        if has_request_context():
+            if "db_stats" not in g:
+                g.db_stats = {"opened": 0, "reused": 0, "closed": 0, "checkouts": 0, "queries": 0}
+            if readonly is None:
+                readonly = request_uses_readonly_db()
+            key = "db_read_conn" if readonly else "db_conn"
+            conn = g.get(key)
+            if conn is None:
+                conn = _acquire_db_connection(readonly)
+                conn.request_bound = True
+                setattr(g, key, conn)
+            g.db_stats["checkouts"] += 1
+        else:
+            conn = _acquire_db_connection(bool(readonly))
+        conn.borrow_depth += 1
         return conn
     except Exception as e:
         print(f"[錯誤] 資料庫連線失敗: {e}")
         return None
 
+def get_db_pool_stats():
+    """回傳本 worker 的連線統計（開啟、重用、關閉次數與讀寫 / 唯讀連線池目前的閒置連線數）。"""
+    with _db_stats_lock:
+        stats = dict(DB_CONNECTION_STATS)
+    write_pool = _get_db_pool(False)
+    read_pool = _get_db_pool(True)
+    stats["idle"] = write_pool.qsize() if write_pool is not None else 0
+    stats["idle_readonly"] = read_pool.qsize() if read_pool is not None else 0
+    stats["pool_size"] = DB_POOL_SIZE
+    stats["read_pool_size"] = DB_READ_POOL_SIZE
+    return stats
+
+_checkpoint_thread_pid = None
+_checkpoint_lock = threading.Lock()
+DB_CHECKPOINT_STATS = {"runs": 0, "truncates": 0, "last_wal_pages": 0, "errors": 0}
+
+def run_wal_checkpoint(conn):
+    """執行一次 PASSIVE checkpoint；WAL 檔過大時再以 TRUNCATE 縮回。"""
+    busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    DB_CHECKPOINT_STATS["runs"] += 1
+    DB_CHECKPOINT_STATS["last_wal_pages"] = wal_pages
+    wal_file = SQLITE_DB_FILE + "-wal"
+    size_limit = SQLITE_PROFILES[DB_PROFILE].get("journal_size_limit", 0)
+    if size_limit and os.path.exists(wal_file) and os.path.getsize(wal_file) > size_limit:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        DB_CHECKPOINT_STATS["truncates"] += 1
+    return busy, wal_pages, checkpointed
+
+def _wal_checkpoint_loop():
+    conn = _open_db_connection()
+    while True:
+        time.sleep(DB_CHECKPOINT_INTERVAL)
+        try:
+            run_wal_checkpoint(conn)
+        except sqlite3.Error as e:
+            DB_CHECKPOINT_STATS["errors"] += 1
+            print(f"[警告] WAL checkpoint 失敗: {e}")
+
+def ensure_wal_checkpointer():
+    """WAL 模式下，每個 worker 啟動一個背景 checkpoint 執行緒，避免 WAL 檔無限成長。"""
+    global _checkpoint_thread_pid
+    if DB_BACKEND != "sqlite" or SQLITE_PROFILES[DB_PROFILE].get("journal_mode") != "WAL" or DB_CHECKPOINT_INTERVAL <= 0:
+        return
+    if _checkpoint_thread_pid == os.getpid():
+        return
+    with _checkpoint_lock:
+        if _checkpoint_thread_pid == os.getpid():
+            return
+        threading.Thread(target=_wal_checkpoint_loop, name="wal-checkpoint", daemon=True).start()
+        _checkpoint_thread_pid = os.getpid()
+
+@app.before_request
+def start_db_background_tasks():
+    ensure_wal_checkpointer()
+
+@app.teardown_request
+def teardown_db_connection(exc):
+    for key in ("db_conn", "db_read_conn"):
+        conn = g.pop(key, None)
+        if conn is not None:
+            release_db_connection(conn)
+
+# === 單一寫入執行緒（選用） ===
+# DB_WRITE_QUEUE=1 時，路由的寫入交給每個 worker 唯一的寫入執行緒，多筆寫入合併在同一個交易提交
+DB_WRITE_QUEUE = os.getenv("DB_WRITE_QUEUE", "0") == "1"
+DB_WRITE_TIMEOUT = float(os.getenv("DB_WRITE_TIMEOUT", "5"))
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "200"))
+DB_WRITE_QUEUE_MAX = int(os.getenv("DB_WRITE_QUEUE_MAX", "2000"))
+
+class DBWriteTimeout(Exception):
+    """寫入在等待時間內未完成（佇列已滿或寫入執行緒忙碌）。"""
+
+class DBWriteQueue:
+    """單一寫入執行緒與其工作佇列。
+
+    每個工作是 job(conn) 函式，在寫入執行緒的連線上執行且不可自行 commit。
+    執行緒一次取出佇列中所有待處理工作（最多 batch_size 筆），各自包在 SAVEPOINT 內執行，
+    最後只 commit 一次；單筆失敗只會 rollback 該筆，不影響同批其他寫入。
+    """
+
+    def __init__(self, batch_size=DB_WRITE_BATCH_SIZE, max_pending=DB_WRITE_QUEUE_MAX):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self.stats = {"jobs": 0, "batches": 0, "largest_batch": 0, "failed": 0}
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, job, timeout=DB_WRITE_TIMEOUT):
+        future = Future()
+        try:
+            self.jobs.put((job, future), timeout=timeout)
+        except queue.Full:
+            raise DBWriteTimeout("寫入佇列已滿，請稍後再試")
+        return future
+
+    def _run(self):
+        conn = _open_db_connection()
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(conn, batch)
+
+    def _commit_batch(self, conn, batch):
+        outcomes = []
+        try:
+            retry_on_busy(lambda: begin_write_transaction(conn))
+            for job, future in batch:
+                # 呼叫端等待逾時後會取消 future，已取消的工作不再執行
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write_job")
+                try:
+                    result = job(conn)
+                    conn.execute("RELEASE SAVEPOINT write_job")
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO SAVEPOINT write_job")
+                    conn.execute("RELEASE SAVEPOINT write_job")
+                    outcomes.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            print(f"[錯誤] 批次寫入失敗: {e}")
+            self.stats["failed"] += len(batch)
+            for _job, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.stats["jobs"] += len(outcomes)
+        self.stats["batches"] += 1
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(outcomes))
+        for future, result, error in outcomes:
+            if error is not None:
+                self.stats["failed"] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+_db_write_queue = None
+_db_write_queue_lock = threading.Lock()
+
+def get_db_write_queue():
+    """取得本行程的寫入佇列（fork 後的 worker 會各自建立自己的寫入執行緒）。"""
+    global _db_write_queue
+    with _db_write_queue_lock:
+        if _db_write_queue is None or _db_write_queue.pid != os.getpid():
+            _db_write_queue = DBWriteQueue()
+        return _db_write_queue
+
+def run_db_write(job, timeout=DB_WRITE_TIMEOUT):
+    """執行一個寫入工作 job(conn) 並回傳其結果。
+
+    未啟用 DB_WRITE_QUEUE 時直接在目前請求的連線上執行並 commit；
+    啟用時交給寫入執行緒批次提交，最多等待 timeout 秒，逾時拋出 DBWriteTimeout。
+    """
+    if not DB_WRITE_QUEUE:
+        conn = get_db_connection(readonly=False)
+        if not conn:
+            raise RuntimeError("資料庫連線失敗")
+
+        def attempt():
+            try:
+                result = job(conn)
+                conn.commit()
+                clear_request_memo()
+                return result
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+
+        try:
+            return retry_on_busy(attempt)
+        finally:
+            conn.close()
+
+    future = get_db_write_queue().submit(job, timeout)
+    try:
+        result = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        if future.cancel():
+            raise DBWriteTimeout("資料庫忙碌中，這筆資料未寫入，請稍後再試")
+        # 已開始執行的工作無法取消，再多等一個 timeout 以回報確實結果；仍未完成時不再阻塞請求
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise DBWriteTimeout("資料庫忙碌中，無法確認這筆資料是否已寫入，請重新整理後確認")
+    clear_request_memo()
+    return result
+
+def build_write_error_message(error, lang="zh", action="save"):
+    """寫入失敗時記錄例外，回傳給使用者的一般訊息；資料庫錯誤內容只寫入 log，不顯示在頁面上。"""
+    print(f"[錯誤] 資料庫寫入失敗: {error}")
+    if isinstance(error, DBWriteTimeout):
+        return "The database is busy, please try again later" if lang == "en" else str(error)
+    if action == "delete":
+        return "Delete failed, please try again later" if lang == "en" else "刪除失敗，請稍後再試"
+    return "Save failed, please try again later" if lang == "en" else "儲存失敗，請稍後再試"
+
+@app.after_request
+def report_db_stats(response):
+    stats = g.get("db_stats")
+    if DB_DEBUG_STATS and stats:
+        summary = ";".join(f"{key}={value}" for key, value in stats.items())
+        response.headers["X-DB-Stats"] = summary
+        print(f"[DB] {request.method} {request.path} {summary}")
+    return response
+
+# 用藥列表「啟用中優先」的排序運算式；idx_medications_owner_status_start 以同一運算式建立
+MEDICATION_STATUS_RANK_SQL = "CASE WHEN {alias}status = 'active' THEN 0 ELSE 1 END"
+
+# 關鍵字搜尋欄位（trigram 全文索引）；trigram 至少需要 3 個字元，較短的關鍵字改用 LIKE
+APPOINTMENT_SEARCH_COLUMNS = ("patient_id", "patient_name", "patient_phone")
+MEDICATION_SEARCH_COLUMNS = ("medication_name", "dosage", "frequency")
+FTS_MIN_KEYWORD_LENGTH = 3
+
+# 列表分頁：預設每頁筆數與上限（?limit= 不可超過上限）
+LIST_PAGE_SIZE = 20
+LIST_PAGE_SIZE_MAX = 100
+
+def encode_page_cursor(values):
+    """將排序鍵編碼成網址安全的分頁游標。"""
+    raw = json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_page_cursor(cursor, types):
+    """解析分頁游標；types 為各排序鍵的型別（例如 (str, str, int)），格式不正確時回傳 None（視為第一頁）。"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw.decode("utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(types):
+        return None
+    # 游標來自網址，可能被竄改；每個值都必須是預期的純量型別（bool 也是 int 的子類別，需排除）
+    if not all(type(value) is value_type for value, value_type in zip(values, types)):
+        return None
+    return values
+
+def build_keyset_page(rows, limit, cursor_values, cursor, backwards):
+    """rows 為多取一筆（limit + 1）的查詢結果，整理成 items 與前後頁游標。"""
+    has_more = len(rows) > limit
+    items = rows[:limit]
+    if backwards:
+        items.reverse()
+    next_cursor = prev_cursor = None
+    if items:
+        if has_more or backwards:
+            next_cursor = encode_page_cursor(cursor_values(items[-1]))
+        if (has_more and backwards) or (cursor and not backwards):
+            prev_cursor = encode_page_cursor(cursor_values(items[0]))
+    return {"items": items, "limit": limit, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
+
+def get_page_args():
+    """讀取列表分頁參數：limit（1 到 LIST_PAGE_SIZE_MAX）與 after / before 游標。"""
+    limit = request.args.get("limit", LIST_PAGE_SIZE, type=int) or LIST_PAGE_SIZE
+    limit = max(1, min(limit, LIST_PAGE_SIZE_MAX))
+    return limit, request.args.get("after") or None, request.args.get("before") or None
+
+def build_fts_match(keyword):
+    """將使用者輸入轉成 FTS5 片語查詢，避免引號或運算子被解讀為語法。"""
+    return '"' + keyword.replace('"', '""') + '"'
+
 def ensure_column(conn, table_name, column_name, column_definition):
     """Add a column if it does not already exist."""
     existing_columns = {
@@ -42,229 +778,1700 @@ def ensure_column(conn, table_name, column_name, column_definition):
     if column_name not in existing_columns:
         conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_definition}")
 
-def init_db():
-    """初始化 SQLite 資料庫表結構"""
-    try:
-        conn = get_db_connection()
-        if not conn: return
-        
-        cursor = conn.cursor()
-        
-        # 建立資料表
-        create_table_sql = """
-        CREATE TABLE IF NOT EXISTS medical_appointments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(100) NOT NULL,
-            owner_username VARCHAR(100),
-            profile_id INTEGER,
-            created_by_username VARCHAR(100),
-            patient_id VARCHAR(50),
-            patient_name VARCHAR(100) NOT NULL,
-            patient_phone VARCHAR(20) NOT NULL,
-            department VARCHAR(100) NOT NULL,
-            doctor_name VARCHAR(100) NOT NULL,
-            appointment_date DATE NOT NULL,
-            appointment_time TIME NOT NULL,
-            symptoms TEXT,
-            status VARCHAR(20) DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """
-        cursor.execute(create_table_sql)
-        ensure_column(conn, "medical_appointments", "owner_username", "owner_username VARCHAR(100)")
-        ensure_column(conn, "medical_appointments", "profile_id", "profile_id INTEGER")
-        ensure_column(conn, "medical_appointments", "created_by_username", "created_by_username VARCHAR(100)")
-        conn.execute("UPDATE medical_appointments SET owner_username = username WHERE owner_username IS NULL OR owner_username = ''")
-        conn.execute("UPDATE medical_appointments SET created_by_username = username WHERE created_by_username IS NULL OR created_by_username = ''")
-        
-        # 建立索引以加速查詢
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_username ON medical_appointments(username)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_owner_username ON medical_appointments(owner_username)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_profile_id ON medical_appointments(profile_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_appointment_date ON medical_appointments(appointment_date)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_patient_id ON medical_appointments(patient_id)")
-
-        # 醫師表：每科兩位醫師，早/下午分流
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS doctors (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            department VARCHAR(100) NOT NULL,
-            doctor_name VARCHAR(100) NOT NULL,
-            shift VARCHAR(20) NOT NULL, -- morning / afternoon
-            start_time TIME NOT NULL,
-            end_time TIME NOT NULL
+def _migration_create_core_tables(conn):
+    """建立核心資料表；舊版資料庫缺少的欄位以 ensure_column 補上。"""
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS medical_appointments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100),
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        patient_id VARCHAR(50),
+        patient_name VARCHAR(100) NOT NULL,
+        patient_phone VARCHAR(20) NOT NULL,
+        department VARCHAR(100) NOT NULL,
+        doctor_name VARCHAR(100) NOT NULL,
+        appointment_date DATE NOT NULL,
+        appointment_time TIME NOT NULL,
+        symptoms TEXT,
+        status VARCHAR(20) DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    ensure_column(conn, "medical_appointments", "owner_username", "owner_username VARCHAR(100)")
+    ensure_column(conn, "medical_appointments", "profile_id", "profile_id INTEGER")
+    ensure_column(conn, "medical_appointments", "created_by_username", "created_by_username VARCHAR(100)")
+
+    # 建立索引以加速查詢
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_username ON medical_appointments(username)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_owner_username ON medical_appointments(owner_username)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_profile_id ON medical_appointments(profile_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_appointment_date ON medical_appointments(appointment_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_patient_id ON medical_appointments(patient_id)")
+
+    # 醫師表：每科兩位醫師，早/下午分流
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS doctors (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        department VARCHAR(100) NOT NULL,
+        doctor_name VARCHAR(100) NOT NULL,
+        shift VARCHAR(20) NOT NULL, -- morning / afternoon
+        start_time TIME NOT NULL,
+        end_time TIME NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_doctor_dept ON doctors(department)")
+
+    # 使用者資料表
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(50) NOT NULL UNIQUE,
+        password_hash VARCHAR(200) NOT NULL,
+        name VARCHAR(100) DEFAULT '',
+        phone VARCHAR(20) DEFAULT '',
+        identity_id VARCHAR(20) DEFAULT '',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS care_profiles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_username VARCHAR(50) NOT NULL,
+        profile_name VARCHAR(100) NOT NULL,
+        relationship VARCHAR(50) DEFAULT '',
+        phone VARCHAR(20) DEFAULT '',
+        identity_id VARCHAR(20) DEFAULT '',
+        birth_date DATE,
+        notes TEXT DEFAULT '',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_care_profiles_owner ON care_profiles(owner_username)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS care_links (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_username VARCHAR(50) NOT NULL,
+        linked_username VARCHAR(50) NOT NULL,
+        note VARCHAR(255) DEFAULT '',
+        status VARCHAR(20) DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(owner_username, linked_username)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_care_links_owner ON care_links(owner_username)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_care_links_linked ON care_links(linked_username)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS medications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100),
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        medication_name VARCHAR(120) NOT NULL,
+        dosage VARCHAR(120) NOT NULL,
+        frequency VARCHAR(120) NOT NULL,
+        reminder_times VARCHAR(255) NOT NULL,
+        start_date DATE NOT NULL,
+        end_date DATE,
+        instructions TEXT DEFAULT '',
+        precautions TEXT DEFAULT '',
+        status VARCHAR(20) DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    ensure_column(conn, "medications", "owner_username", "owner_username VARCHAR(100)")
+    ensure_column(conn, "medications", "profile_id", "profile_id INTEGER")
+    ensure_column(conn, "medications", "created_by_username", "created_by_username VARCHAR(100)")
+    ensure_column(conn, "medications", "instructions", "instructions TEXT DEFAULT ''")
+    ensure_column(conn, "medications", "precautions", "precautions TEXT DEFAULT ''")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_owner ON medications(owner_username)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_profile ON medications(profile_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_status ON medications(status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_start_date ON medications(start_date)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS medication_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        medication_id INTEGER NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        log_date DATE NOT NULL,
+        reminder_time VARCHAR(10) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        note TEXT DEFAULT '',
+        created_by_username VARCHAR(100),
+        taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(medication_id, log_date, reminder_time)
+    )
+    """)
+    ensure_column(conn, "medication_logs", "owner_username", "owner_username VARCHAR(100)")
+    ensure_column(conn, "medication_logs", "note", "note TEXT DEFAULT ''")
+    ensure_column(conn, "medication_logs", "created_by_username", "created_by_username VARCHAR(100)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_medication_logs_med_date ON medication_logs(medication_id, log_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_medication_logs_owner ON medication_logs(owner_username)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS mood_assessments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100),
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        sleep_score INTEGER NOT NULL DEFAULT 0,
+        appetite_score INTEGER NOT NULL DEFAULT 0,
+        energy_score INTEGER NOT NULL DEFAULT 0,
+        stress_score INTEGER NOT NULL DEFAULT 0,
+        social_score INTEGER NOT NULL DEFAULT 0,
+        emotion_score INTEGER NOT NULL DEFAULT 0,
+        interest_score INTEGER NOT NULL DEFAULT 0,
+        anxiety_score INTEGER NOT NULL DEFAULT 0,
+        irritability_score INTEGER NOT NULL DEFAULT 0,
+        meaninglessness_risk INTEGER NOT NULL DEFAULT 0,
+        self_harm_risk INTEGER NOT NULL DEFAULT 0,
+        total_score INTEGER NOT NULL DEFAULT 0,
+        mood_level VARCHAR(50) NOT NULL DEFAULT 'stable',
+        mood_label VARCHAR(120) NOT NULL DEFAULT '',
+        summary TEXT DEFAULT '',
+        suggestion TEXT DEFAULT '',
+        note TEXT DEFAULT '',
+        risk_alert TEXT DEFAULT '',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    ensure_column(conn, "mood_assessments", "owner_username", "owner_username VARCHAR(100)")
+    ensure_column(conn, "mood_assessments", "profile_id", "profile_id INTEGER")
+    ensure_column(conn, "mood_assessments", "created_by_username", "created_by_username VARCHAR(100)")
+    ensure_column(conn, "mood_assessments", "note", "note TEXT DEFAULT ''")
+    ensure_column(conn, "mood_assessments", "risk_alert", "risk_alert TEXT DEFAULT ''")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_mood_assessments_owner ON mood_assessments(owner_username)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_mood_assessments_profile ON mood_assessments(profile_id)")
+
+def _migration_backfill_ownership(conn):
+    """舊資料只有 username，補上 owner_username / created_by_username。"""
+    for table_name in ("medical_appointments", "medications", "mood_assessments"):
+        conn.execute(f"UPDATE {table_name} SET owner_username = username WHERE owner_username IS NULL OR owner_username = ''")
+        conn.execute(f"UPDATE {table_name} SET created_by_username = username WHERE created_by_username IS NULL OR created_by_username = ''")
+
+def _migration_seed_defaults(conn):
+    """植入預設醫師與 admin 帳號（若尚未存在）。"""
+    cursor = conn.cursor()
+    doctor_seed = {
+        "內科": [("張內晨", "morning"), ("李內昕", "afternoon")],
+        "外科": [("王外晨", "morning"), ("陳外昕", "afternoon")],
+        "兒科": [("林兒晨", "morning"), ("黃兒昕", "afternoon")],
+        "婦產科": [("周婦晨", "morning"), ("趙婦昕", "afternoon")],
+        "骨科": [("吳骨晨", "morning"), ("鄭骨昕", "afternoon")],
+        "眼科": [("許眼晨", "morning"), ("郭眼昕", "afternoon")],
+        "耳鼻喉科": [("洪耳晨", "morning"), ("邱耳昕", "afternoon")],
+        "皮膚科": [("何膚晨", "morning"), ("柯膚昕", "afternoon")],
+        "精神科": [("施心晨", "morning"), ("簡心昕", "afternoon")],
+        "復健科": [("蔡復晨", "morning"), ("曾復昕", "afternoon")],
+    }
+
+    cursor.execute("SELECT COUNT(*) FROM doctors")
+    doctor_count = cursor.fetchone()[0]
+    if doctor_count == 0:
+        for dept, doctors in doctor_seed.items():
+            for name, shift in doctors:
+                start, end = ("09:00", "15:00") if shift == "morning" else ("15:00", "21:00")
+                cursor.execute(
+                    "INSERT INTO doctors (department, doctor_name, shift, start_time, end_time) VALUES (?, ?, ?, ?, ?)",
+                    (dept, name, shift, start, end)
+                )
+        print("[成功] 預設醫師資料已建立")
+
+    cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(
+            "INSERT INTO users (username, password_hash, name, phone, identity_id) VALUES (?, ?, ?, ?, ?)",
+            ('admin', generate_password_hash('1234'), '系統管理員', '', '')
         )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_doctor_dept ON doctors(department)")
-
-        doctor_seed = {
-            "內科": [("張內晨", "morning"), ("李內昕", "afternoon")],
-            "外科": [("王外晨", "morning"), ("陳外昕", "afternoon")],
-            "兒科": [("林兒晨", "morning"), ("黃兒昕", "afternoon")],
-            "婦產科": [("周婦晨", "morning"), ("趙婦昕", "afternoon")],
-            "骨科": [("吳骨晨", "morning"), ("鄭骨昕", "afternoon")],
-            "眼科": [("許眼晨", "morning"), ("郭眼昕", "afternoon")],
-            "耳鼻喉科": [("洪耳晨", "morning"), ("邱耳昕", "afternoon")],
-            "皮膚科": [("何膚晨", "morning"), ("柯膚昕", "afternoon")],
-            "精神科": [("施心晨", "morning"), ("簡心昕", "afternoon")],
-            "復健科": [("蔡復晨", "morning"), ("曾復昕", "afternoon")],
-        }
+        print("[成功] 預設 admin 帳號已建立")
+
+def rebuild_table(conn, table_name, create_sql, column_overrides=None):
+    """依 create_sql 重建資料表並搬移資料（SQLite 無法直接修改欄位限制）。
+
+    create_sql 以 {table} 代表資料表名稱；column_overrides 可為個別欄位指定搬移時的 SELECT 運算式。
+    重建後舊索引會一併消失，需由呼叫端重新建立。
+    """
+    column_overrides = column_overrides or {}
+    staging_table = f"{table_name}_rebuild"
+    old_columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table_name})").fetchall()}
+    conn.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    conn.execute(create_sql.format(table=staging_table))
+    columns = [
+        row["name"] for row in conn.execute(f"PRAGMA table_info({staging_table})").fetchall()
+        if row["name"] in old_columns
+    ]
+    select_exprs = [column_overrides.get(column, column) for column in columns]
+    conn.execute(
+        f"INSERT INTO {staging_table} ({', '.join(columns)}) SELECT {', '.join(select_exprs)} FROM {table_name}"
+    )
+    conn.execute(f"DROP TABLE {table_name}")
+    conn.execute(f"ALTER TABLE {staging_table} RENAME TO {table_name}")
 
-        cursor.execute("SELECT COUNT(*) FROM doctors")
-        doctor_count = cursor.fetchone()[0]
-        if doctor_count == 0:
-            for dept, doctors in doctor_seed.items():
-                for name, shift in doctors:
-                    start, end = ("09:00", "15:00") if shift == "morning" else ("15:00", "21:00")
-                    cursor.execute(
-                        "INSERT INTO doctors (department, doctor_name, shift, start_time, end_time) VALUES (?, ?, ?, ?, ?)",
-                        (dept, name, shift, start, end)
-                    )
-            print("[成功] 預設醫師資料已建立")
-
-        # 使用者資料表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(50) NOT NULL UNIQUE,
-            password_hash VARCHAR(200) NOT NULL,
-            name VARCHAR(100) DEFAULT '',
-            phone VARCHAR(20) DEFAULT '',
-            identity_id VARCHAR(20) DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+def _migration_authoritative_owner(conn):
+    """owner_username 改為 NOT NULL，並以 (owner_username, 排序欄位) 複合索引取代單欄索引。
+
+    列表查詢改以 owner_username IN (...) 過濾後，可直接依索引順序讀出，不需全表掃描與排序。
+    """
+    owner_overrides = {
+        "owner_username": "COALESCE(NULLIF(owner_username, ''), username)",
+        "created_by_username": "COALESCE(NULLIF(created_by_username, ''), username)",
+    }
+    rebuild_table(conn, "medical_appointments", """
+    CREATE TABLE {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        patient_id VARCHAR(50),
+        patient_name VARCHAR(100) NOT NULL,
+        patient_phone VARCHAR(20) NOT NULL,
+        department VARCHAR(100) NOT NULL,
+        doctor_name VARCHAR(100) NOT NULL,
+        appointment_date DATE NOT NULL,
+        appointment_time TIME NOT NULL,
+        symptoms TEXT,
+        status VARCHAR(20) DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """, owner_overrides)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_username ON medical_appointments(username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_profile_id ON medical_appointments(profile_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointment_date ON medical_appointments(appointment_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_id ON medical_appointments(patient_id)")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_appointments_owner_date
+                    ON medical_appointments(owner_username, appointment_date DESC, appointment_time DESC, id DESC)""")
+
+    rebuild_table(conn, "medications", """
+    CREATE TABLE {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        medication_name VARCHAR(120) NOT NULL,
+        dosage VARCHAR(120) NOT NULL,
+        frequency VARCHAR(120) NOT NULL,
+        reminder_times VARCHAR(255) NOT NULL,
+        start_date DATE NOT NULL,
+        end_date DATE,
+        instructions TEXT DEFAULT '',
+        precautions TEXT DEFAULT '',
+        status VARCHAR(20) DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """, owner_overrides)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_medications_profile ON medications(profile_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_medications_status ON medications(status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_medications_start_date ON medications(start_date)")
+    # 排序運算式需與 MEDICATION_STATUS_RANK_SQL 完全一致，SQLite 才會使用這個索引排序
+    conn.execute(f"""CREATE INDEX IF NOT EXISTS idx_medications_owner_status_start
+                     ON medications(owner_username, ({MEDICATION_STATUS_RANK_SQL.format(alias="")}), start_date DESC, id DESC)""")
+
+    rebuild_table(conn, "mood_assessments", """
+    CREATE TABLE {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        sleep_score INTEGER NOT NULL DEFAULT 0,
+        appetite_score INTEGER NOT NULL DEFAULT 0,
+        energy_score INTEGER NOT NULL DEFAULT 0,
+        stress_score INTEGER NOT NULL DEFAULT 0,
+        social_score INTEGER NOT NULL DEFAULT 0,
+        emotion_score INTEGER NOT NULL DEFAULT 0,
+        interest_score INTEGER NOT NULL DEFAULT 0,
+        anxiety_score INTEGER NOT NULL DEFAULT 0,
+        irritability_score INTEGER NOT NULL DEFAULT 0,
+        meaninglessness_risk INTEGER NOT NULL DEFAULT 0,
+        self_harm_risk INTEGER NOT NULL DEFAULT 0,
+        total_score INTEGER NOT NULL DEFAULT 0,
+        mood_level VARCHAR(50) NOT NULL DEFAULT 'stable',
+        mood_label VARCHAR(120) NOT NULL DEFAULT '',
+        summary TEXT DEFAULT '',
+        suggestion TEXT DEFAULT '',
+        note TEXT DEFAULT '',
+        risk_alert TEXT DEFAULT '',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """, owner_overrides)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mood_assessments_profile ON mood_assessments(profile_id)")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_mood_assessments_owner_created
+                    ON mood_assessments(owner_username, created_at DESC, id DESC)""")
+
+def create_fts_index(conn, table_name, columns):
+    """為 table_name 建立 trigram FTS5 索引（external content），並以 trigger 同步增刪改。"""
+    fts_table = f"{table_name}_fts"
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+    old_values = ", ".join(f"old.{column}" for column in columns)
+    conn.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table}
+                     USING fts5({column_list}, content='{table_name}', content_rowid='id', tokenize='trigram')""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table_name} BEGIN
+                         INSERT INTO {fts_table}(rowid, {column_list}) VALUES (new.id, {new_values});
+                     END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table_name} BEGIN
+                         INSERT INTO {fts_table}({fts_table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                     END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF {column_list} ON {table_name} BEGIN
+                         INSERT INTO {fts_table}({fts_table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+                         INSERT INTO {fts_table}(rowid, {column_list}) VALUES (new.id, {new_values});
+                     END""")
+    conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+def _migration_keyword_search_fts(conn):
+    """預約與用藥的關鍵字搜尋改用 trigram 全文索引，支援中文姓名與部分電話號碼。"""
+    create_fts_index(conn, "medical_appointments", APPOINTMENT_SEARCH_COLUMNS)
+    create_fts_index(conn, "medications", MEDICATION_SEARCH_COLUMNS)
+
+# === 每日服藥遵從度 ===
+# medication_adherence_daily 每個用藥每天一列；記錄服藥狀態時在同一個交易更新，區間遵從度只需加總主鍵範圍
+ADHERENCE_DAILY_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS medication_adherence_daily (
+    medication_id INTEGER NOT NULL,
+    log_date DATE NOT NULL,
+    scheduled INTEGER NOT NULL DEFAULT 0,
+    taken INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (medication_id, log_date)
+){table_options}"""
+
+def refresh_medication_adherence_day(conn, medication_id, log_date, scheduled):
+    """依 medication_logs 重新計算單一用藥單日的彙總列；只讀該日最多數筆紀錄（idx_medication_logs_med_date）。"""
+    row = conn.execute(
+        """SELECT SUM(CASE WHEN status = 'taken' THEN 1 ELSE 0 END) AS taken,
+                  SUM(CASE WHEN status = 'skipped' THEN 1 ELSE 0 END) AS skipped
+           FROM medication_logs WHERE medication_id = ? AND log_date = ?""",
+        (medication_id, log_date)
+    ).fetchone()
+    conn.execute(
+        build_adherence_daily_upsert_sql(),
+        (medication_id, log_date, scheduled, row["taken"] or 0, row["skipped"] or 0)
+    )
+
+def refresh_medication_adherence_days(conn, scheduled_by_day):
+    """批次版的 refresh_medication_adherence_day：scheduled_by_day 為 {(medication_id, log_date): 應服次數}，
+    以一次彙總查詢與一次 executemany 更新所有列。"""
+    if not scheduled_by_day:
+        return
+    medication_ids = sorted({medication_id for medication_id, _log_date in scheduled_by_day})
+    log_dates = sorted({log_date for _medication_id, log_date in scheduled_by_day})
+    rows = conn.execute(
+        f"""SELECT medication_id, log_date,
+                   SUM(CASE WHEN status = 'taken' THEN 1 ELSE 0 END) AS taken,
+                   SUM(CASE WHEN status = 'skipped' THEN 1 ELSE 0 END) AS skipped
+            FROM medication_logs
+            WHERE medication_id IN ({",".join(["?"] * len(medication_ids))})
+              AND log_date IN ({",".join(["?"] * len(log_dates))})
+            GROUP BY medication_id, log_date""",
+        medication_ids + log_dates
+    ).fetchall()
+    counts = {(row["medication_id"], str(row["log_date"])): row for row in rows}
+    conn.executemany(build_adherence_daily_upsert_sql(), [
+        (
+            medication_id, log_date, scheduled,
+            (counts[(medication_id, log_date)]["taken"] or 0) if (medication_id, log_date) in counts else 0,
+            (counts[(medication_id, log_date)]["skipped"] or 0) if (medication_id, log_date) in counts else 0,
         )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS care_profiles (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            owner_username VARCHAR(50) NOT NULL,
-            profile_name VARCHAR(100) NOT NULL,
-            relationship VARCHAR(50) DEFAULT '',
-            phone VARCHAR(20) DEFAULT '',
-            identity_id VARCHAR(20) DEFAULT '',
-            birth_date DATE,
-            notes TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        for (medication_id, log_date), scheduled in sorted(scheduled_by_day.items())
+    ])
+
+def build_adherence_daily_upsert_sql():
+    return build_upsert_sql(
+        "medication_adherence_daily",
+        ("medication_id", "log_date", "scheduled", "taken", "skipped", "updated_at"),
+        ("medication_id", "log_date"),
+        {"scheduled": None, "taken": None, "skipped": None, "updated_at": "CURRENT_TIMESTAMP"},
+        values={"updated_at": "CURRENT_TIMESTAMP"},
+    )
+
+def rebuild_medication_adherence(conn, source="medication_logs"):
+    """由服藥紀錄重建整張彙總表，回傳列數。
+
+    taken / skipped 依服藥紀錄重新計算；scheduled 是記錄當時的提醒次數，已有彙總列的日子沿用原值，
+    之後改過提醒時間也不會改寫過去的遵從度，只有尚無彙總列的日子才以 medication_reminders 目前的提醒數補上。
+    """
+    conn.execute("DROP TABLE IF EXISTS adherence_scheduled_snapshot")
+    conn.execute(
+        """CREATE TEMPORARY TABLE adherence_scheduled_snapshot AS
+           SELECT medication_id, log_date, scheduled FROM medication_adherence_daily"""
+    )
+    conn.execute("DELETE FROM medication_adherence_daily")
+    conn.execute(f"""
+        INSERT INTO medication_adherence_daily (medication_id, log_date, scheduled, taken, skipped)
+        SELECT l.medication_id, l.log_date,
+               COALESCE(MAX(s.scheduled), MAX(r.scheduled), 0),
+               SUM(CASE WHEN l.status = 'taken' THEN 1 ELSE 0 END),
+               SUM(CASE WHEN l.status = 'skipped' THEN 1 ELSE 0 END)
+        FROM {source} l
+        LEFT JOIN adherence_scheduled_snapshot s ON s.medication_id = l.medication_id AND s.log_date = l.log_date
+        LEFT JOIN (
+            SELECT medication_id, COUNT(*) AS scheduled FROM medication_reminders GROUP BY medication_id
+        ) r ON r.medication_id = l.medication_id
+        GROUP BY l.medication_id, l.log_date
+    """)
+    conn.execute("DROP TABLE adherence_scheduled_snapshot")
+    return conn.execute("SELECT COUNT(*) AS total FROM medication_adherence_daily").fetchone()["total"]
+
+def get_table_options():
+    return SERVER_DDL_TOKENS[DB_BACKEND]["table_options"] if DB_BACKEND != "sqlite" else ""
+
+def _migration_adherence_daily(conn):
+    """新增每日遵從度彙總表；初始資料需要 medication_reminders 的提醒數，在建立該表的遷移中一併產生。"""
+    conn.execute(ADHERENCE_DAILY_TABLE_SQL.format(table_options=get_table_options()))
+
+def bump_adherence_epoch(conn, owner_usernames=None):
+    """遞增 owner_usernames（None 代表全部帳號）的遵從度版本號，使各 worker 的遵從度分析快取失效；須在寫入交易中呼叫。"""
+    if owner_usernames is None:
+        conn.execute("UPDATE users SET adherence_epoch = adherence_epoch + 1")
+        return
+    owner_usernames = sorted(set(owner_usernames))
+    if owner_usernames:
+        placeholders = ",".join(["?"] * len(owner_usernames))
+        conn.execute(
+            f"UPDATE users SET adherence_epoch = adherence_epoch + 1 WHERE username IN ({placeholders})", owner_usernames
         )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_care_profiles_owner ON care_profiles(owner_username)")
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS care_links (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            owner_username VARCHAR(50) NOT NULL,
-            linked_username VARCHAR(50) NOT NULL,
-            note VARCHAR(255) DEFAULT '',
-            status VARCHAR(20) DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(owner_username, linked_username)
+
+def _migration_adherence_epoch(conn):
+    """新增每個帳號的遵從度版本號，服藥紀錄或用藥計畫變動時遞增，供遵從度分析快取判斷是否過期。"""
+    conn.execute("ALTER TABLE users ADD COLUMN adherence_epoch INTEGER NOT NULL DEFAULT 0")
+
+# === 代辦權限（care_links 的遞移閉包） ===
+# care_links 一列代表 linked_username 可代辦 owner_username；user_access 存放展開後所有「誰可代辦誰」的組合，
+# 權限檢查只需查主鍵。CARE_LINK_MAX_HOPS > 1 時允許轉授權，例如子女代辦父親、父親代辦母親時，子女也能代辦母親。
+CARE_LINK_MAX_HOPS = max(1, int(os.getenv("CARE_LINK_MAX_HOPS", "1")))
+USER_ACCESS_TABLE_SQL = """
+CREATE TABLE user_access (
+    manager_username VARCHAR(50) NOT NULL,
+    owner_username VARCHAR(50) NOT NULL,
+    hops INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (manager_username, owner_username)
+){table_options}"""
+
+def refresh_user_access(conn, manager_usernames=None):
+    """重新展開 manager_usernames（None 代表全部）可代辦的帳號；須在寫入交易中呼叫。"""
+    seed_condition = ""
+    params = []
+    if manager_usernames is not None:
+        manager_usernames = sorted(set(manager_usernames))
+        if not manager_usernames:
+            return
+        placeholders = ",".join(["?"] * len(manager_usernames))
+        seed_condition = f" AND linked_username IN ({placeholders})"
+        params = list(manager_usernames)
+        conn.execute(f"DELETE FROM user_access WHERE manager_username IN ({placeholders})", params)
+    else:
+        conn.execute("DELETE FROM user_access")
+    conn.execute(f"""
+        INSERT INTO user_access (manager_username, owner_username, hops)
+        WITH RECURSIVE reach(manager_username, owner_username, hops) AS (
+            SELECT linked_username, owner_username, 1
+            FROM care_links
+            WHERE status = 'active'{seed_condition}
+            UNION
+            SELECT r.manager_username, cl.owner_username, r.hops + 1
+            FROM reach r
+            JOIN care_links cl ON cl.linked_username = r.owner_username AND cl.status = 'active'
+            WHERE r.hops < ?
         )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_care_links_owner ON care_links(owner_username)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_care_links_linked ON care_links(linked_username)")
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS medications (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(100) NOT NULL,
-            owner_username VARCHAR(100),
-            profile_id INTEGER,
-            created_by_username VARCHAR(100),
-            medication_name VARCHAR(120) NOT NULL,
-            dosage VARCHAR(120) NOT NULL,
-            frequency VARCHAR(120) NOT NULL,
-            reminder_times VARCHAR(255) NOT NULL,
-            start_date DATE NOT NULL,
-            end_date DATE,
-            instructions TEXT DEFAULT '',
-            precautions TEXT DEFAULT '',
-            status VARCHAR(20) DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        SELECT manager_username, owner_username, MIN(hops)
+        FROM reach
+        WHERE manager_username <> owner_username
+        GROUP BY manager_username, owner_username
+    """, params + [CARE_LINK_MAX_HOPS])
+
+def refresh_user_access_for_link(conn, linked_username):
+    """linked_username 的授權變動後，更新它本身與所有可代辦它的帳號（轉授權時會經過這條連結）。"""
+    rows = conn.execute(
+        "SELECT manager_username FROM user_access WHERE owner_username = ?", (linked_username,)
+    ).fetchall()
+    refresh_user_access(conn, [linked_username] + [row["manager_username"] for row in rows])
+    bump_auth_epoch(conn, [linked_username])
+
+def bump_auth_epoch(conn, owner_usernames=None):
+    """遞增 owner_usernames 與所有可代辦他們的帳號的授權版本號（None 代表全部帳號）；須在同一個寫入交易中呼叫。
+
+    版本號變動後，這些帳號在 session 中快取的可代辦帳號與各 worker 的可代辦對象快取會在下一個請求失效。
+    """
+    if owner_usernames is None:
+        conn.execute("UPDATE users SET auth_epoch = auth_epoch + 1")
+        return
+    placeholders = ",".join(["?"] * len(owner_usernames))
+    conn.execute(
+        f"""UPDATE users SET auth_epoch = auth_epoch + 1
+            WHERE username IN ({placeholders})
+               OR username IN (SELECT manager_username FROM user_access WHERE owner_username IN ({placeholders}))""",
+        list(owner_usernames) * 2
+    )
+
+def _migration_user_auth_epoch(conn):
+    """新增每個帳號各自的授權版本號，供跨請求的可代辦對象快取判斷是否過期；只有受影響的帳號需要重新載入權限。"""
+    conn.execute("ALTER TABLE users ADD COLUMN auth_epoch INTEGER NOT NULL DEFAULT 0")
+
+def _migration_user_access(conn):
+    """新增代辦權限閉包表，並由現有的 care_links 展開。"""
+    conn.execute(USER_ACCESS_TABLE_SQL.format(table_options=get_table_options()))
+    conn.execute("CREATE INDEX idx_user_access_owner ON user_access(owner_username)")
+    refresh_user_access(conn)
+
+# === 用藥提醒時間（medication_reminders） ===
+# 每個提醒時間一列，以當日第幾分鐘（0 ~ 1439）儲存；medications.reminder_times 保留逗號串接的 HH:MM 供顯示與匯出。
+# 讀取時以 REMINDER_MINUTE_LABELS 查表轉回 HH:MM，不需要解析時間字串。
+REMINDER_MINUTE_LABELS = tuple(f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(24 * 60))
+MEDICATION_REMINDERS_TABLE_SQL = """
+CREATE TABLE medication_reminders (
+    medication_id INTEGER NOT NULL,
+    minute_of_day INTEGER NOT NULL,
+    PRIMARY KEY (medication_id, minute_of_day)
+){table_options}"""
+
+def parse_reminder_minutes(reminder_times):
+    """將 "08:00, 20:30" 之類的文字轉成排序後不重複的當日分鐘數；格式不符的項目略過。"""
+    if not reminder_times:
+        return []
+    minutes = set()
+    for item in str(reminder_times).split(","):
+        hour_text, separator, minute_text = item.strip().partition(":")
+        if not separator or not hour_text.isdigit() or not minute_text.isdigit() or len(hour_text) > 2 or len(minute_text) > 2:
+            continue
+        hour, minute = int(hour_text), int(minute_text)
+        if hour < 24 and minute < 60:
+            minutes.add(hour * 60 + minute)
+    return sorted(minutes)
+
+def format_reminder_minutes(minutes):
+    return [REMINDER_MINUTE_LABELS[minute] for minute in minutes]
+
+def save_medication_reminders(conn, medication_id, minutes):
+    """以 minutes 取代單一用藥的提醒時間；須在寫入交易中呼叫。"""
+    conn.execute("DELETE FROM medication_reminders WHERE medication_id = ?", (medication_id,))
+    if minutes:
+        conn.executemany(
+            "INSERT INTO medication_reminders (medication_id, minute_of_day) VALUES (?, ?)",
+            [(medication_id, minute) for minute in minutes]
         )
-        """)
-        ensure_column(conn, "medications", "owner_username", "owner_username VARCHAR(100)")
-        ensure_column(conn, "medications", "profile_id", "profile_id INTEGER")
-        ensure_column(conn, "medications", "created_by_username", "created_by_username VARCHAR(100)")
-        ensure_column(conn, "medications", "instructions", "instructions TEXT DEFAULT ''")
-        ensure_column(conn, "medications", "precautions", "precautions TEXT DEFAULT ''")
-        conn.execute("UPDATE medications SET owner_username = username WHERE owner_username IS NULL OR owner_username = ''")
-        conn.execute("UPDATE medications SET created_by_username = username WHERE created_by_username IS NULL OR created_by_username = ''")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_owner ON medications(owner_username)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_profile ON medications(profile_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_status ON medications(status)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_medications_start_date ON medications(start_date)")
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS medication_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            medication_id INTEGER NOT NULL,
-            owner_username VARCHAR(100) NOT NULL,
-            log_date DATE NOT NULL,
-            reminder_time VARCHAR(10) NOT NULL,
-            status VARCHAR(20) NOT NULL,
-            note TEXT DEFAULT '',
-            created_by_username VARCHAR(100),
-            taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(medication_id, log_date, reminder_time)
+
+def sync_medication_reminders(conn, after_id=0):
+    """由 medications.reminder_times 補上 id > after_id 的提醒時間列（遷移與批次匯入使用），回傳寫入列數。"""
+    rows = conn.execute(
+        "SELECT id, reminder_times FROM medications WHERE id > ? ORDER BY id", (after_id,)
+    ).fetchall()
+    values = [(row["id"], minute) for row in rows for minute in parse_reminder_minutes(row["reminder_times"])]
+    if values:
+        conn.executemany(
+            "INSERT INTO medication_reminders (medication_id, minute_of_day) VALUES (?, ?)", values
         )
-        """)
-        ensure_column(conn, "medication_logs", "owner_username", "owner_username VARCHAR(100)")
-        ensure_column(conn, "medication_logs", "note", "note TEXT DEFAULT ''")
-        ensure_column(conn, "medication_logs", "created_by_username", "created_by_username VARCHAR(100)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_medication_logs_med_date ON medication_logs(medication_id, log_date)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_medication_logs_owner ON medication_logs(owner_username)")
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS mood_assessments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(100) NOT NULL,
-            owner_username VARCHAR(100),
-            profile_id INTEGER,
-            created_by_username VARCHAR(100),
-            sleep_score INTEGER NOT NULL DEFAULT 0,
-            appetite_score INTEGER NOT NULL DEFAULT 0,
-            energy_score INTEGER NOT NULL DEFAULT 0,
-            stress_score INTEGER NOT NULL DEFAULT 0,
-            social_score INTEGER NOT NULL DEFAULT 0,
-            emotion_score INTEGER NOT NULL DEFAULT 0,
-            interest_score INTEGER NOT NULL DEFAULT 0,
-            anxiety_score INTEGER NOT NULL DEFAULT 0,
-            irritability_score INTEGER NOT NULL DEFAULT 0,
-            meaninglessness_risk INTEGER NOT NULL DEFAULT 0,
-            self_harm_risk INTEGER NOT NULL DEFAULT 0,
-            total_score INTEGER NOT NULL DEFAULT 0,
-            mood_level VARCHAR(50) NOT NULL DEFAULT 'stable',
-            mood_label VARCHAR(120) NOT NULL DEFAULT '',
-            summary TEXT DEFAULT '',
-            suggestion TEXT DEFAULT '',
-            note TEXT DEFAULT '',
-            risk_alert TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    return len(values)
+
+MEDICATION_REMINDER_EVENTS_TABLE_SQL = """
+CREATE TABLE medication_reminder_events (
+    id {pk},
+    medication_id INTEGER NOT NULL,
+    owner_username VARCHAR(100) NOT NULL,
+    log_date DATE NOT NULL,
+    reminder_time VARCHAR(5) NOT NULL,
+    event_type VARCHAR(20) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(medication_id, log_date, reminder_time)
+){table_options}"""
+
+def _migration_reminder_events(conn):
+    """新增提醒事件表（提醒派送的 table sink），並為 medications.updated_at 建索引，供派送程式只讀取變動過的用藥。"""
+    tokens = SERVER_DDL_TOKENS.get(DB_BACKEND, {"pk": "INTEGER PRIMARY KEY AUTOINCREMENT"})
+    conn.execute(MEDICATION_REMINDER_EVENTS_TABLE_SQL.format(pk=tokens["pk"], table_options=get_table_options()))
+    conn.execute("CREATE INDEX idx_medication_reminder_events_owner ON medication_reminder_events(owner_username, log_date)")
+    conn.execute("CREATE INDEX idx_medications_updated ON medications(updated_at)")
+
+def sync_imported_medications(conn, after_id):
+    """批次匯入用藥後補上提醒時間，並讓這些帳號的遵從度分析快取失效。"""
+    sync_medication_reminders(conn, after_id)
+    rows = conn.execute("SELECT DISTINCT owner_username FROM medications WHERE id > ?", (after_id,)).fetchall()
+    bump_adherence_epoch(conn, [row["owner_username"] for row in rows])
+
+def _migration_medication_reminders(conn):
+    """提醒時間改存成每個時間一列，並由現有的 reminder_times 字串轉入。"""
+    conn.execute(MEDICATION_REMINDERS_TABLE_SQL.format(table_options=get_table_options()))
+    conn.execute("CREATE INDEX idx_medication_reminders_minute ON medication_reminders(minute_of_day, medication_id)")
+    sync_medication_reminders(conn)
+    # 遵從度彙總的 scheduled 以提醒數計算，提醒時間轉入後才由現有服藥紀錄建立
+    rebuild_medication_adherence(conn)
+    if DB_BACKEND == "sqlite" and os.path.exists(ARCHIVE_DB_FILE):
+        print("[提醒] 已封存的服藥紀錄未計入，請執行 python app.py rebuild-adherence")
+
+# === 心情趨勢（mood_trend_buckets） ===
+# 每個帳號 / 照護對象在日、週（週一起算）、月三種粒度各有一列彙總，新增或刪除心情評估時在同一個交易增減，
+# 趨勢查詢只讀彙總列，不需讀取原始紀錄。profile_key 為 profile_id，帳號本人為 0。
+MOOD_TREND_GRANULARITIES = ("day", "week", "month")
+MOOD_TREND_SCORE_COLUMNS = (
+    "total_score", "emotion_score", "anxiety_score", "irritability_score", "interest_score",
+    "sleep_score", "appetite_score", "energy_score", "social_score", "stress_score",
+    "meaninglessness_risk", "self_harm_risk",
+)
+MOOD_TREND_TABLE_SQL = """
+CREATE TABLE mood_trend_buckets (
+    owner_username VARCHAR(100) NOT NULL,
+    granularity VARCHAR(5) NOT NULL,
+    profile_key INTEGER NOT NULL DEFAULT 0,
+    bucket_start DATE NOT NULL,
+    entry_count INTEGER NOT NULL DEFAULT 0,
+    {sum_columns},
+    PRIMARY KEY (owner_username, granularity, profile_key, bucket_start)
+){table_options}"""
+
+def get_mood_bucket_starts(created_at):
+    """評估時間所屬的日、週、月彙總起始日。"""
+    day = date.fromisoformat(str(created_at)[:10])
+    return {
+        "day": day.isoformat(),
+        "week": (day - timedelta(days=day.weekday())).isoformat(),
+        "month": day.replace(day=1).isoformat(),
+    }
+
+def update_mood_trend_buckets(conn, assessment, sign=1):
+    """將一筆心情評估加入（sign=1）或移出（sign=-1）其日 / 週 / 月彙總；須在寫入交易中呼叫。"""
+    sum_columns = [f"{column}_sum" for column in MOOD_TREND_SCORE_COLUMNS]
+    columns = ("owner_username", "granularity", "profile_key", "bucket_start", "entry_count") + tuple(sum_columns)
+    upsert_sql = build_upsert_sql(
+        "mood_trend_buckets",
+        columns,
+        ("owner_username", "granularity", "profile_key", "bucket_start"),
+        {column: f"mood_trend_buckets.{column} + {upsert_new_value(column)}" for column in columns[4:]},
+    )
+    values = [sign] + [sign * int(assessment.get(column) or 0) for column in MOOD_TREND_SCORE_COLUMNS]
+    profile_key = assessment.get("profile_id") or 0
+    conn.executemany(upsert_sql, [
+        [assessment["owner_username"], granularity, profile_key, bucket_start] + values
+        for granularity, bucket_start in get_mood_bucket_starts(assessment["created_at"]).items()
+    ])
+    if sign < 0:
+        conn.execute(
+            "DELETE FROM mood_trend_buckets WHERE owner_username = ? AND profile_key = ? AND entry_count <= 0",
+            (assessment["owner_username"], profile_key)
         )
-        """)
-        ensure_column(conn, "mood_assessments", "owner_username", "owner_username VARCHAR(100)")
-        ensure_column(conn, "mood_assessments", "profile_id", "profile_id INTEGER")
-        ensure_column(conn, "mood_assessments", "created_by_username", "created_by_username VARCHAR(100)")
-        ensure_column(conn, "mood_assessments", "note", "note TEXT DEFAULT ''")
-        ensure_column(conn, "mood_assessments", "risk_alert", "risk_alert TEXT DEFAULT ''")
-        conn.execute("UPDATE mood_assessments SET owner_username = username WHERE owner_username IS NULL OR owner_username = ''")
-        conn.execute("UPDATE mood_assessments SET created_by_username = username WHERE created_by_username IS NULL OR created_by_username = ''")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mood_assessments_owner ON mood_assessments(owner_username)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mood_assessments_profile ON mood_assessments(profile_id)")
-
-        # 植入預設 admin 帳號（若尚未存在）
-        cursor.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'")
-        if cursor.fetchone()[0] == 0:
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, name, phone, identity_id) VALUES (?, ?, ?, ?, ?)",
-                ('admin', generate_password_hash('1234'), '系統管理員', '', '')
+
+def rebuild_mood_trend_buckets(conn):
+    """由 mood_assessments 重建全部彙總列，回傳列數。"""
+    conn.execute("DELETE FROM mood_trend_buckets")
+    buckets = {}
+    rows = conn.execute(
+        f"SELECT owner_username, profile_id, created_at, {', '.join(MOOD_TREND_SCORE_COLUMNS)} FROM mood_assessments"
+    )
+    for row in rows:
+        for granularity, bucket_start in get_mood_bucket_starts(row["created_at"]).items():
+            key = (row["owner_username"], granularity, row["profile_id"] or 0, bucket_start)
+            totals = buckets.setdefault(key, [0] * (len(MOOD_TREND_SCORE_COLUMNS) + 1))
+            totals[0] += 1
+            for index, column in enumerate(MOOD_TREND_SCORE_COLUMNS, start=1):
+                totals[index] += int(row[column] or 0)
+    sum_columns = ", ".join(f"{column}_sum" for column in MOOD_TREND_SCORE_COLUMNS)
+    placeholders = ",".join(["?"] * (len(MOOD_TREND_SCORE_COLUMNS) + 5))
+    conn.executemany(
+        f"""INSERT INTO mood_trend_buckets
+            (owner_username, granularity, profile_key, bucket_start, entry_count, {sum_columns})
+            VALUES ({placeholders})""",
+        [list(key) + totals for key, totals in buckets.items()]
+    )
+    return len(buckets)
+
+def _migration_mood_trend_buckets(conn):
+    """新增心情趨勢彙總表，並由現有的心情評估建立初始資料。"""
+    sum_columns = ",\n    ".join(f"{column}_sum INTEGER NOT NULL DEFAULT 0" for column in MOOD_TREND_SCORE_COLUMNS)
+    conn.execute(MOOD_TREND_TABLE_SQL.format(sum_columns=sum_columns, table_options=get_table_options()))
+    rebuild_mood_trend_buckets(conn)
+
+IMPORT_PROGRESS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS import_progress (
+    entity VARCHAR(50) NOT NULL,
+    source VARCHAR(500) NOT NULL,
+    rows_done INTEGER NOT NULL DEFAULT 0,
+    deferred_ddl TEXT,
+    completed_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (entity, source)
+){table_options}"""
+
+def _migration_import_progress(conn):
+    """新增批次匯入進度表；早期版本在匯入時才建立這張表，已存在時沿用。"""
+    conn.execute(IMPORT_PROGRESS_TABLE_SQL.format(table_options=get_table_options()))
+
+# MySQL / PostgreSQL 建表語法差異；時間欄位沿用 SQLite 的 "HH:MM" 字串，因此用 VARCHAR 而非 TIME
+SERVER_DDL_TOKENS = {
+    "mysql": {"pk": "INT AUTO_INCREMENT PRIMARY KEY", "empty_text": "TEXT DEFAULT ('')", "table_options": " ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"},
+    "postgresql": {"pk": "SERIAL PRIMARY KEY", "empty_text": "TEXT DEFAULT ''", "table_options": ""},
+}
+
+SERVER_BASELINE_TABLES = [
+    """CREATE TABLE medical_appointments (
+        id {pk},
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        patient_id VARCHAR(50),
+        patient_name VARCHAR(100) NOT NULL,
+        patient_phone VARCHAR(20) NOT NULL,
+        department VARCHAR(100) NOT NULL,
+        doctor_name VARCHAR(100) NOT NULL,
+        appointment_date DATE NOT NULL,
+        appointment_time VARCHAR(10) NOT NULL,
+        symptoms TEXT,
+        status VARCHAR(20) DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ){table_options}""",
+    """CREATE TABLE doctors (
+        id {pk},
+        department VARCHAR(100) NOT NULL,
+        doctor_name VARCHAR(100) NOT NULL,
+        shift VARCHAR(20) NOT NULL,
+        start_time VARCHAR(10) NOT NULL,
+        end_time VARCHAR(10) NOT NULL
+    ){table_options}""",
+    """CREATE TABLE users (
+        id {pk},
+        username VARCHAR(50) NOT NULL UNIQUE,
+        password_hash VARCHAR(200) NOT NULL,
+        name VARCHAR(100) DEFAULT '',
+        phone VARCHAR(20) DEFAULT '',
+        identity_id VARCHAR(20) DEFAULT '',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ){table_options}""",
+    """CREATE TABLE care_profiles (
+        id {pk},
+        owner_username VARCHAR(50) NOT NULL,
+        profile_name VARCHAR(100) NOT NULL,
+        relationship VARCHAR(50) DEFAULT '',
+        phone VARCHAR(20) DEFAULT '',
+        identity_id VARCHAR(20) DEFAULT '',
+        birth_date DATE,
+        notes {empty_text},
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ){table_options}""",
+    """CREATE TABLE care_links (
+        id {pk},
+        owner_username VARCHAR(50) NOT NULL,
+        linked_username VARCHAR(50) NOT NULL,
+        note VARCHAR(255) DEFAULT '',
+        status VARCHAR(20) DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(owner_username, linked_username)
+    ){table_options}""",
+    """CREATE TABLE medications (
+        id {pk},
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        medication_name VARCHAR(120) NOT NULL,
+        dosage VARCHAR(120) NOT NULL,
+        frequency VARCHAR(120) NOT NULL,
+        reminder_times VARCHAR(255) NOT NULL,
+        start_date DATE NOT NULL,
+        end_date DATE,
+        instructions {empty_text},
+        precautions {empty_text},
+        status VARCHAR(20) DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ){table_options}""",
+    """CREATE TABLE medication_logs (
+        id {pk},
+        medication_id INTEGER NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        log_date DATE NOT NULL,
+        reminder_time VARCHAR(10) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        note {empty_text},
+        created_by_username VARCHAR(100),
+        taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(medication_id, log_date, reminder_time)
+    ){table_options}""",
+    """CREATE TABLE mood_assessments (
+        id {pk},
+        username VARCHAR(100) NOT NULL,
+        owner_username VARCHAR(100) NOT NULL,
+        profile_id INTEGER,
+        created_by_username VARCHAR(100),
+        sleep_score INTEGER NOT NULL DEFAULT 0,
+        appetite_score INTEGER NOT NULL DEFAULT 0,
+        energy_score INTEGER NOT NULL DEFAULT 0,
+        stress_score INTEGER NOT NULL DEFAULT 0,
+        social_score INTEGER NOT NULL DEFAULT 0,
+        emotion_score INTEGER NOT NULL DEFAULT 0,
+        interest_score INTEGER NOT NULL DEFAULT 0,
+        anxiety_score INTEGER NOT NULL DEFAULT 0,
+        irritability_score INTEGER NOT NULL DEFAULT 0,
+        meaninglessness_risk INTEGER NOT NULL DEFAULT 0,
+        self_harm_risk INTEGER NOT NULL DEFAULT 0,
+        total_score INTEGER NOT NULL DEFAULT 0,
+        mood_level VARCHAR(50) NOT NULL DEFAULT 'stable',
+        mood_label VARCHAR(120) NOT NULL DEFAULT '',
+        summary {empty_text},
+        suggestion {empty_text},
+        note {empty_text},
+        risk_alert {empty_text},
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ){table_options}""",
+]
+
+SERVER_BASELINE_INDEXES = [
+    "CREATE INDEX idx_username ON medical_appointments(username)",
+    "CREATE INDEX idx_profile_id ON medical_appointments(profile_id)",
+    "CREATE INDEX idx_appointment_date ON medical_appointments(appointment_date)",
+    "CREATE INDEX idx_patient_id ON medical_appointments(patient_id)",
+    "CREATE INDEX idx_appointments_owner_date ON medical_appointments(owner_username, appointment_date DESC, appointment_time DESC, id DESC)",
+    "CREATE INDEX idx_doctor_dept ON doctors(department)",
+    "CREATE INDEX idx_care_profiles_owner ON care_profiles(owner_username)",
+    "CREATE INDEX idx_care_links_owner ON care_links(owner_username)",
+    "CREATE INDEX idx_care_links_linked ON care_links(linked_username)",
+    "CREATE INDEX idx_medications_profile ON medications(profile_id)",
+    "CREATE INDEX idx_medications_status ON medications(status)",
+    "CREATE INDEX idx_medications_start_date ON medications(start_date)",
+    # MySQL 8 的函數索引與 PostgreSQL 的運算式索引都接受 ((運算式)) 寫法
+    f"CREATE INDEX idx_medications_owner_status_start ON medications(owner_username, (({MEDICATION_STATUS_RANK_SQL.format(alias='')})), start_date DESC, id DESC)",
+    "CREATE INDEX idx_medication_logs_med_date ON medication_logs(medication_id, log_date)",
+    "CREATE INDEX idx_medication_logs_owner ON medication_logs(owner_username)",
+    "CREATE INDEX idx_mood_assessments_profile ON mood_assessments(profile_id)",
+    "CREATE INDEX idx_mood_assessments_owner_created ON mood_assessments(owner_username, created_at DESC, id DESC)",
+]
+
+def _migration_server_baseline(conn):
+    """MySQL / PostgreSQL 直接建立與 SQLite v5 相同的結構（關鍵字搜尋以 LIKE 取代 FTS5），並植入預設資料。"""
+    tokens = SERVER_DDL_TOKENS[DB_BACKEND]
+    for create_sql in SERVER_BASELINE_TABLES:
+        conn.execute(create_sql.format(**tokens))
+    for index_sql in SERVER_BASELINE_INDEXES:
+        conn.execute(index_sql)
+    _migration_seed_defaults(conn)
+
+# 依版本號排序的 schema 遷移步驟；新增結構變更時只能在最後追加，不可修改已發佈的步驟
+SCHEMA_MIGRATIONS = [
+    (1, "create core tables", _migration_create_core_tables),
+    (2, "backfill owner and creator usernames", _migration_backfill_ownership),
+    (3, "seed default doctors and admin account", _migration_seed_defaults),
+    (4, "authoritative owner_username with composite list indexes", _migration_authoritative_owner),
+    (5, "trigram full-text search for appointments and medications", _migration_keyword_search_fts),
+    (6, "daily medication adherence summary", _migration_adherence_daily),
+    (7, "care link access closure", _migration_user_access),
+    (8, "per-user authorization epoch", _migration_user_auth_epoch),
+    (9, "normalized medication reminder times", _migration_medication_reminders),
+    (10, "per-user adherence epoch for analytics caching", _migration_adherence_epoch),
+    (11, "medication reminder events and change index", _migration_reminder_events),
+    (12, "incremental mood trend buckets", _migration_mood_trend_buckets),
+    (13, "bulk import progress", _migration_import_progress),
+]
+# MySQL / PostgreSQL 從 v5 的完整結構開始；之後的版本需同時在兩個清單追加
+SERVER_SCHEMA_MIGRATIONS = [
+    (5, "baseline schema for MySQL / PostgreSQL", _migration_server_baseline),
+    (6, "daily medication adherence summary", _migration_adherence_daily),
+    (7, "care link access closure", _migration_user_access),
+    (8, "per-user authorization epoch", _migration_user_auth_epoch),
+    (9, "normalized medication reminder times", _migration_medication_reminders),
+    (10, "per-user adherence epoch for analytics caching", _migration_adherence_epoch),
+    (11, "medication reminder events and change index", _migration_reminder_events),
+    (12, "incremental mood trend buckets", _migration_mood_trend_buckets),
+    (13, "bulk import progress", _migration_import_progress),
+]
+
+def get_schema_migrations():
+    return SCHEMA_MIGRATIONS if DB_BACKEND == "sqlite" else SERVER_SCHEMA_MIGRATIONS
+
+LATEST_SCHEMA_VERSION = get_schema_migrations()[-1][0]
+SCHEMA_LOCK_FILE = SQLITE_DB_FILE + ".migrate.lock"
+# Windows 取得遷移鎖失敗時的重試間隔（秒）
+SCHEMA_LOCK_RETRY_INTERVAL = 0.2
+# 設為 0 時 worker 啟動不自動遷移，需先執行 python app.py migrate
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") != "0"
+
+# python app.py <command> 可執行的資料庫維護指令
+DB_COMMAND_NAMES = ("migrate", "check-query-plans", "archive", "import", "export", "backup", "rebuild-adherence", "rebuild-access", "dispatch-reminders")
+
+def get_db_command():
+    """回傳命令列指定的資料庫維護指令，沒有則回傳 None。"""
+    args = sys.argv[1:]
+    return args[0] if args and args[0] in DB_COMMAND_NAMES else None
+
+def is_migrate_command():
+    """判斷是否執行資料庫遷移命令。"""
+    return get_db_command() == "migrate"
+
+@contextmanager
+def schema_migration_lock():
+    """跨行程的檔案鎖，確保多個 worker 同時啟動時只有一個執行遷移。"""
+    with open(SCHEMA_LOCK_FILE, "a+") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+            lock_file.seek(0)
+            # 以非阻塞方式嘗試上鎖，其他 worker 正在遷移時稍候再試，避免空轉占滿 CPU
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(SCHEMA_LOCK_RETRY_INTERVAL)
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+@contextmanager
+def server_migration_lock(conn):
+    """MySQL / PostgreSQL 的 worker 可能分散在多台主機，改以資料庫的 advisory lock 確保只有一個執行遷移。"""
+    if DB_BACKEND == "mysql":
+        conn.execute("SELECT GET_LOCK('medicalai_schema_migration', 600)").fetchone()
+        try:
+            yield
+        finally:
+            conn.execute("SELECT RELEASE_LOCK('medicalai_schema_migration')").fetchone()
+    elif DB_BACKEND == "postgresql":
+        conn.execute("SELECT pg_advisory_lock(hashtext('medicalai_schema_migration'))").fetchone()
+        try:
+            yield
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(hashtext('medicalai_schema_migration'))").fetchone()
+    else:
+        yield
+
+def table_exists(conn, table_name):
+    """確認資料表是否存在（依後端查詢 sqlite_master 或 information_schema）。"""
+    if DB_BACKEND == "sqlite":
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    elif DB_BACKEND == "mysql":
+        sql = "SELECT 1 FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = ?"
+    else:
+        sql = "SELECT 1 FROM information_schema.tables WHERE table_schema = current_schema() AND table_name = ?"
+    return conn.execute(sql, (table_name,)).fetchone() is not None
+
+def get_schema_version(conn):
+    """讀取目前 schema 版本；尚未建立 schema_version 表時回傳 0。"""
+    if not table_exists(conn, "schema_version"):
+        return 0
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def migrate_db():
+    """在檔案鎖（MySQL / PostgreSQL 另加 advisory lock）保護下依序執行尚未套用的遷移步驟，回傳本次套用的版本號。"""
+    with schema_migration_lock():
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError("資料庫連線失敗")
+        try:
+            with server_migration_lock(conn):
+                applied = _apply_schema_migrations(conn)
+        finally:
+            conn.close()
+    return applied
+
+def _apply_schema_migrations(conn):
+    applied = []
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.commit()
+    # 取得鎖後重新確認版本，其他 worker 可能已經完成遷移
+    current_version = get_schema_version(conn)
+    for version, description, step in get_schema_migrations():
+        if version <= current_version:
+            continue
+        retry_on_busy(lambda: begin_write_transaction(conn))
+        try:
+            step(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+        print(f"[遷移] v{version}: {description}")
+    return applied
+
+def init_db():
+    """啟動時只檢查一次 schema 版本，落後時才執行遷移。"""
+    try:
+        conn = get_db_connection()
+        if not conn: return
+        try:
+            current_version = get_schema_version(conn)
+        finally:
+            conn.close()
+        if current_version >= LATEST_SCHEMA_VERSION or is_migrate_command():
+            return
+        if not AUTO_MIGRATE:
+            print(f"[警告] 資料庫版本 v{current_version} 落後於 v{LATEST_SCHEMA_VERSION}，請執行 python app.py migrate")
+            return
+        migrate_db()
+        if DB_BACKEND == "sqlite":
+            print(f"[成功] SQLite 資料庫已就緒: {SQLITE_DB_FILE}")
+        else:
+            print(f"[成功] {DB_BACKEND} 資料庫已就緒: {DB_HOST}:{DB_PORT}/{DB_NAME}")
+    except Exception as e:
+        print(f"[錯誤] 資料庫初始化失敗: {e}")
+
+def run_migrate_command():
+    """命令列指令：python app.py migrate"""
+    applied = migrate_db()
+    if applied:
+        print(f"[成功] 已套用 {len(applied)} 個遷移，目前版本 v{LATEST_SCHEMA_VERSION}")
+    else:
+        print(f"[完成] 資料庫已是最新版本 v{LATEST_SCHEMA_VERSION}")
+
+# === 冷熱資料分離（封存） ===
+# 已取消或超過保留天數的預約、超過保留天數的用藥紀錄搬到另一個 SQLite 檔（ATTACH 為 archive），
+# 熱資料表與索引維持精簡；歷史頁面透過 TEMP view {table}_history 同時讀取兩邊
+ARCHIVE_DB_FILE = os.getenv("ARCHIVE_DB_FILE") or os.path.splitext(SQLITE_DB_FILE)[0] + "_archive.db"
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# 各資料表的封存條件（? 皆代入保留期限的日期）與封存資料庫上的索引
+ARCHIVE_TABLES = {
+    "medical_appointments": {
+        "condition": "appointment_date < ? OR (status = 'canceled' AND updated_at < ?)",
+        "indexes": [
+            """CREATE INDEX IF NOT EXISTS archive.idx_archive_appointments_owner_date
+               ON medical_appointments(owner_username, appointment_date DESC, appointment_time DESC, id DESC)""",
+        ],
+    },
+    "medication_logs": {
+        "condition": "log_date < ?",
+        "indexes": [
+            "CREATE INDEX IF NOT EXISTS archive.idx_archive_medication_logs_med_date ON medication_logs(medication_id, log_date)",
+            "CREATE INDEX IF NOT EXISTS archive.idx_archive_medication_logs_owner ON medication_logs(owner_username, log_date)",
+        ],
+    },
+}
+
+def get_table_columns(conn, schema, table_name):
+    return [row["name"] for row in conn.execute(f"PRAGMA {schema}.table_info({table_name})").fetchall()]
+
+def ensure_archive_schema(conn):
+    """在已 ATTACH 的封存資料庫建立與熱資料表相同結構的資料表，熱資料表之後新增的欄位也會補上。"""
+    for table_name, spec in ARCHIVE_TABLES.items():
+        archive_columns = set(get_table_columns(conn, "archive", table_name))
+        if not archive_columns:
+            create_sql = conn.execute(
+                "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+            ).fetchone()[0]
+            conn.execute(re.sub(r'^CREATE TABLE\s+"?\w+"?', f"CREATE TABLE archive.{table_name}", create_sql))
+        else:
+            for row in conn.execute(f"PRAGMA main.table_info({table_name})").fetchall():
+                if row["name"] not in archive_columns:
+                    conn.execute(f"ALTER TABLE archive.{table_name} ADD COLUMN {row['name']} {row['type']}")
+        for index_sql in spec["indexes"]:
+            conn.execute(index_sql)
+
+def attach_archive_database(conn):
+    """將封存資料庫 ATTACH 為 archive，並建立 TEMP view {table}_history（熱資料 UNION ALL 封存資料）。
+
+    連線在連線池中會保持 ATTACH 狀態，每條連線只需處理一次。
+    回傳 False 代表沒有封存資料可讀（非 SQLite 後端，或唯讀連線時封存資料庫尚未建立）。
+    """
+    if DB_BACKEND != "sqlite":
+        return False
+    if conn.archive_attached:
+        return True
+    if conn.readonly:
+        if not os.path.exists(ARCHIVE_DB_FILE):
+            return False
+        conn.execute("ATTACH DATABASE ? AS archive", (f"file:{pathname2url(ARCHIVE_DB_FILE)}?mode=ro",))
+        # TEMP view 只存在於這條連線，但 query_only 仍會擋下建立，需暫時關閉
+        conn.execute("PRAGMA query_only = OFF")
+    else:
+        conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_FILE,))
+        conn.execute(f"PRAGMA archive.journal_mode = {SQLITE_PROFILES[DB_PROFILE]['journal_mode']}")
+        ensure_archive_schema(conn)
+    try:
+        for table_name in ARCHIVE_TABLES:
+            columns = get_table_columns(conn, "main", table_name)
+            archive_columns = set(get_table_columns(conn, "archive", table_name))
+            archive_select = ", ".join(
+                column if column in archive_columns else f"NULL AS {column}" for column in columns
             )
-            print("[成功] 預設 admin 帳號已建立")
+            # 封存中斷時同一個 id 可能短暫同時存在兩邊，以熱資料為準
+            conn.execute(f"DROP VIEW IF EXISTS temp.{table_name}_history")
+            conn.execute(f"""CREATE TEMP VIEW {table_name}_history AS
+                             SELECT {", ".join(columns)} FROM main.{table_name}
+                             UNION ALL
+                             SELECT {archive_select} FROM archive.{table_name} a
+                             WHERE NOT EXISTS (SELECT 1 FROM main.{table_name} h WHERE h.id = a.id)""")
+    finally:
+        if conn.readonly:
+            conn.execute("PRAGMA query_only = ON")
+    conn.archive_attached = True
+    return True
+
+def get_history_source(conn, table_name):
+    """歷史查詢的資料來源：有封存資料庫時為 {table}_history view，否則為熱資料表本身。"""
+    return f"{table_name}_history" if attach_archive_database(conn) else table_name
+
+def archive_history(days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """分批將冷資料搬到封存資料庫，回傳 {資料表: 搬移筆數}。
+
+    每批在獨立交易中複製後刪除，中斷後重新執行會從剩下的資料繼續。
+    WAL 模式下跨檔案交易不保證原子性，因此封存端以 INSERT OR REPLACE 寫入，重跑不會產生重複資料。
+    """
+    if DB_BACKEND != "sqlite":
+        raise RuntimeError(f"封存功能使用 SQLite 的 ATTACH，目前後端為 {DB_BACKEND}")
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    moved = {}
+    conn = get_db_connection(readonly=False)
+    if not conn:
+        raise RuntimeError("資料庫連線失敗")
+    try:
+        attach_archive_database(conn)
+        ensure_archive_schema(conn)
+        for table_name, spec in ARCHIVE_TABLES.items():
+            condition = spec["condition"]
+            condition_params = [cutoff] * condition.count("?")
+            columns = ", ".join(get_table_columns(conn, "main", table_name))
+            moved[table_name] = 0
+            while True:
+                ids = [row[0] for row in conn.execute(
+                    f"SELECT id FROM main.{table_name} WHERE {condition} ORDER BY id LIMIT ?",
+                    condition_params + [batch_size]
+                ).fetchall()]
+                if not ids:
+                    break
+                placeholders = ",".join(["?"] * len(ids))
+                # 取得寫入鎖後重新套用條件，期間被修改的資料留到下一批判斷
+                batch_filter = f"id IN ({placeholders}) AND ({condition})"
+                retry_on_busy(lambda: begin_write_transaction(conn))
+                try:
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO archive.{table_name} ({columns}) "
+                        f"SELECT {columns} FROM main.{table_name} WHERE {batch_filter}",
+                        ids + condition_params
+                    )
+                    deleted = conn.execute(
+                        f"DELETE FROM main.{table_name} WHERE {batch_filter}", ids + condition_params
+                    ).rowcount
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                moved[table_name] += deleted
+                print(f"[封存] {table_name}: 已搬移 {moved[table_name]} 筆")
+    finally:
+        conn.close()
+    return moved
+
+def run_archive_command():
+    """命令列指令：python app.py archive [--days N] [--batch-size N]"""
+    parser = argparse.ArgumentParser(prog="app.py archive", description="將冷資料搬到封存資料庫")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="保留在熱資料表的天數")
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE, help="每個交易搬移的筆數")
+    args = parser.parse_args(sys.argv[2:])
+    moved = archive_history(args.days, args.batch_size)
+    summary = "、".join(f"{table_name} {count} 筆" for table_name, count in moved.items())
+    print(f"[完成] 已封存 {summary}，封存資料庫：{ARCHIVE_DB_FILE}")
+
+# === 批次匯入 / 匯出 ===
+# python app.py import <類型> <檔案>、python app.py export <類型> <檔案>；支援 CSV 與 NDJSON，皆以串流方式處理
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+# 檔案超過此大小時，匯入期間先移除次要索引與 trigger，完成後再一次重建
+IMPORT_DEFER_INDEX_BYTES = int(os.getenv("IMPORT_DEFER_INDEX_BYTES", str(20 * 1024 * 1024)))
+
+# 可匯入的欄位（id、created_at 由資料庫產生）；owner_username / created_by_username 未提供時沿用 username
+BULK_ENTITIES = {
+    "appointments": {
+        "table": "medical_appointments",
+        "columns": (
+            "username", "owner_username", "created_by_username", "patient_id", "patient_name", "patient_phone",
+            "department", "doctor_name", "appointment_date", "appointment_time", "symptoms", "status",
+        ),
+        "required": ("username", "patient_name", "patient_phone", "department", "doctor_name", "appointment_date", "appointment_time"),
+        "defaults": {"status": "pending"},
+        "ignore_duplicates": False,
+    },
+    "medications": {
+        "table": "medications",
+        "columns": (
+            "username", "owner_username", "created_by_username", "medication_name", "dosage", "frequency",
+            "reminder_times", "start_date", "end_date", "instructions", "precautions", "status",
+        ),
+        "required": ("username", "medication_name", "dosage", "frequency", "reminder_times", "start_date"),
+        "defaults": {"status": "active", "instructions": "", "precautions": ""},
+        "ignore_duplicates": False,
+        # 每批寫入後在同一個交易補上新用藥的 medication_reminders
+        "after_chunk": sync_imported_medications,
+    },
+    "users": {
+        "table": "users",
+        # 匯入時可提供明文 password（會雜湊後存入）或既有的 password_hash；已存在的帳號會略過
+        "columns": ("username", "password_hash", "name", "phone", "identity_id"),
+        "required": ("username", "password_hash"),
+        "defaults": {"name": "", "phone": "", "identity_id": ""},
+        "ignore_duplicates": True,
+        # 密碼雜湊預設不匯出，需加上 --include-password-hash（例如搬移資料庫）
+        "secret_columns": ("password_hash",),
+    },
+}
+
+def detect_bulk_format(path, file_format=None):
+    """依參數或副檔名判斷檔案格式（csv / ndjson）。"""
+    if file_format:
+        return file_format
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+def iter_import_records(path, file_format):
+    """逐筆讀取 CSV / NDJSON 的 generator，不會把整個檔案載入記憶體。"""
+    with open(path, newline="", encoding="utf-8-sig") as source_file:
+        if file_format == "csv":
+            yield from csv.DictReader(source_file)
+        else:
+            for line in source_file:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # 無法解析的行交給 prepare_import_row 回報，不中斷整個檔案
+                        yield None
+
+def prepare_import_row(entity, record, record_number):
+    """將一筆原始資料整理成 INSERT 的參數；缺少必填欄位時拋出 ValueError。"""
+    spec = BULK_ENTITIES[entity]
+    if not isinstance(record, dict):
+        raise ValueError(f"第 {record_number} 筆不是有效的 JSON 物件")
+    values = {
+        key: (value.strip() if isinstance(value, str) else value)
+        for key, value in record.items() if key
+    }
+    if entity == "users" and not values.get("password_hash") and values.get("password"):
+        values["password_hash"] = generate_password_hash(values["password"])
+    if "owner_username" in spec["columns"]:
+        values["owner_username"] = values.get("owner_username") or values.get("username")
+        values["created_by_username"] = values.get("created_by_username") or values.get("username")
+    missing = [column for column in spec["required"] if values.get(column) in (None, "")]
+    if missing:
+        raise ValueError(f"第 {record_number} 筆缺少欄位：{', '.join(missing)}")
+    for column, default in spec["defaults"].items():
+        if values.get(column) in (None, ""):
+            values[column] = default
+    return tuple(values.get(column) if values.get(column) != "" else None for column in spec["columns"])
+
+def build_bulk_insert_sql(entity):
+    spec = BULK_ENTITIES[entity]
+    columns = ", ".join(spec["columns"])
+    placeholders = ", ".join(["?"] * len(spec["columns"]))
+    if not spec["ignore_duplicates"]:
+        return f"INSERT INTO {spec['table']} ({columns}) VALUES ({placeholders})"
+    if DB_BACKEND == "mysql":
+        return f"INSERT IGNORE INTO {spec['table']} ({columns}) VALUES ({placeholders})"
+    if DB_BACKEND == "postgresql":
+        return f"INSERT INTO {spec['table']} ({columns}) VALUES ({placeholders}) ON CONFLICT DO NOTHING"
+    return f"INSERT OR IGNORE INTO {spec['table']} ({columns}) VALUES ({placeholders})"
+
+def save_import_progress(conn, entity, source, rows_done, deferred_ddl=None, completed=False):
+    """匯入進度與資料在同一個交易 commit，中斷後可從最後完成的批次繼續。"""
+    conn.execute(
+        build_upsert_sql(
+            "import_progress",
+            ("entity", "source", "rows_done", "deferred_ddl", "completed_at", "updated_at"),
+            ("entity", "source"),
+            {"rows_done": None, "deferred_ddl": None, "completed_at": None, "updated_at": "CURRENT_TIMESTAMP"},
+            values={"completed_at": "CURRENT_TIMESTAMP" if completed else "NULL", "updated_at": "CURRENT_TIMESTAMP"},
+        ),
+        (entity, source, rows_done, json.dumps(deferred_ddl) if deferred_ddl else None)
+    )
+
+def drop_deferrable_ddl(conn, table_name):
+    """移除 table_name 的次要索引與 trigger，回傳重建用的 DDL；主鍵與 UNIQUE 限制保留，避免匯入重複資料。"""
+    rows = conn.execute(
+        """SELECT type, name, sql FROM sqlite_master
+           WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+             AND sql NOT LIKE 'CREATE UNIQUE%'""",
+        (table_name,)
+    ).fetchall()
+    for row in rows:
+        conn.execute(f"DROP {row['type'].upper()} IF EXISTS {row['name']}")
+    return [row["sql"] for row in rows]
+
+def restore_deferred_ddl(conn, table_name, ddl_statements):
+    """重建匯入前移除的索引與 trigger；全文索引的 trigger 停用期間沒有同步，需整個重建。"""
+    for ddl in ddl_statements:
+        conn.execute(ddl)
+    fts_table = f"{table_name}_fts"
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts_table,)).fetchone():
+        conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+def insert_import_rows(conn, insert_sql, rows, skipped):
+    """整批寫入失敗（非鎖定錯誤）時改為逐筆寫入，每筆包在 SAVEPOINT 內；失敗的資料列記到 skipped 後略過。"""
+    written = 0
+    for record_number, row in rows:
+        conn.execute("SAVEPOINT import_row")
+        try:
+            written += conn.execute(insert_sql, row).rowcount
+        except Exception as e:
+            conn.execute("ROLLBACK TO SAVEPOINT import_row")
+            conn.execute("RELEASE SAVEPOINT import_row")
+            if is_busy_error(e):
+                raise
+            skipped.append((record_number, f"第 {record_number} 筆：{e}"))
+            continue
+        conn.execute("RELEASE SAVEPOINT import_row")
+    return written
+
+def import_records(entity, path, file_format=None, chunk_size=IMPORT_CHUNK_SIZE, defer_indexes=None, restart=False):
+    """串流匯入 CSV / NDJSON，每 chunk_size 筆以 executemany 寫入並在同一個交易記錄進度，回傳寫入筆數。
+
+    格式錯誤或違反資料庫限制的資料列會略過並列出筆數與原因，不會讓整批在每次繼續匯入時重複失敗。
+    同一個檔案再次執行時會跳過已完成的筆數；restart=True 時從頭匯入。
+    defer_indexes 未指定時，SQLite 上超過 IMPORT_DEFER_INDEX_BYTES 的檔案會先移除次要索引，完成後重建。
+    """
+    spec = BULK_ENTITIES[entity]
+    table_name = spec["table"]
+    after_chunk = spec.get("after_chunk")
+    file_format = detect_bulk_format(path, file_format)
+    source = os.path.abspath(path)
+    if defer_indexes is None:
+        defer_indexes = os.path.getsize(path) >= IMPORT_DEFER_INDEX_BYTES
+    defer_indexes = defer_indexes and DB_BACKEND == "sqlite"
+
+    conn = get_db_connection(readonly=False)
+    if not conn:
+        raise RuntimeError("資料庫連線失敗")
+    try:
+        progress = conn.execute(
+            "SELECT rows_done, deferred_ddl, completed_at FROM import_progress WHERE entity = ? AND source = ?",
+            (entity, source)
+        ).fetchone()
+        rows_done = progress["rows_done"] if progress and not restart else 0
+        # 上次中斷時尚未重建的索引先補回
+        if progress and progress["deferred_ddl"]:
+            retry_on_busy(lambda: begin_write_transaction(conn))
+            restore_deferred_ddl(conn, table_name, json.loads(progress["deferred_ddl"]))
+            save_import_progress(conn, entity, source, progress["rows_done"])
+            conn.commit()
+        if progress and progress["completed_at"] and not restart:
+            print(f"[略過] {source} 已匯入完成，如需重新匯入請加上 --restart")
+            return 0
+        if rows_done:
+            print(f"[繼續] 從第 {rows_done + 1} 筆開始匯入")
+
+        deferred_ddl = []
+        retry_on_busy(lambda: begin_write_transaction(conn))
+        if defer_indexes:
+            deferred_ddl = drop_deferrable_ddl(conn, table_name)
+        save_import_progress(conn, entity, source, rows_done, deferred_ddl)
+        conn.commit()
 
+        insert_sql = build_bulk_insert_sql(entity)
+        records = itertools.islice(enumerate(iter_import_records(path, file_format), start=1), rows_done, None)
+        inserted = skipped_total = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                rows = []
+                invalid = []
+                for record_number, record in chunk:
+                    try:
+                        rows.append((record_number, prepare_import_row(entity, record, record_number)))
+                    except ValueError as e:
+                        invalid.append((record_number, str(e)))
+                chunk_end = chunk[-1][0]
+                skipped = []
+
+                def write_chunk():
+                    skipped[:] = invalid
+                    begin_write_transaction(conn)
+                    try:
+                        if after_chunk:
+                            last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) AS last_id FROM {table_name}").fetchone()["last_id"]
+                        conn.execute("SAVEPOINT import_chunk")
+                        try:
+                            written = conn.executemany(insert_sql, [row for _record_number, row in rows]).rowcount if rows else 0
+                        except Exception as e:
+                            conn.execute("ROLLBACK TO SAVEPOINT import_chunk")
+                            if is_busy_error(e):
+                                raise
+                            written = insert_import_rows(conn, insert_sql, rows, skipped)
+                        conn.execute("RELEASE SAVEPOINT import_chunk")
+                        if after_chunk:
+                            after_chunk(conn, last_id)
+                        save_import_progress(conn, entity, source, chunk_end, deferred_ddl)
+                        conn.commit()
+                        return written
+                    except Exception:
+                        conn.rollback()
+                        raise
+
+                inserted += retry_on_busy(write_chunk)
+                rows_done = chunk_end
+                for _record_number, reason in sorted(skipped):
+                    print(f"[略過] {reason}")
+                skipped_total += len(skipped)
+                print(f"[匯入] {table_name}: 已處理 {rows_done} 筆")
+        finally:
+            if deferred_ddl:
+                print(f"[匯入] 重建 {table_name} 的 {len(deferred_ddl)} 個索引 / trigger")
+                retry_on_busy(lambda: begin_write_transaction(conn))
+                restore_deferred_ddl(conn, table_name, deferred_ddl)
+                save_import_progress(conn, entity, source, rows_done)
+                conn.commit()
+        retry_on_busy(lambda: begin_write_transaction(conn))
+        save_import_progress(conn, entity, source, rows_done, completed=True)
         conn.commit()
+        if skipped_total:
+            print(f"[警告] 共略過 {skipped_total} 筆無法匯入的資料，請修正後另存新檔再匯入")
+        return inserted
+    finally:
         conn.close()
-        print(f"[成功] SQLite 資料庫已就緒: {SQLITE_DB_FILE}")
-    except Exception as e:
-        print(f"[錯誤] SQLite 資料庫初始化失敗: {e}")
+
+def get_export_columns(entity, include_secrets=False):
+    spec = BULK_ENTITIES[entity]
+    secret_columns = () if include_secrets else spec.get("secret_columns", ())
+    return ("id",) + tuple(column for column in spec["columns"] if column not in secret_columns) + ("created_at",)
+
+def iter_export_rows(entity, chunk_size=IMPORT_CHUNK_SIZE, include_secrets=False):
+    """依 id 分批讀出資料的 generator（預約包含已封存的資料），記憶體中一次只保留一批。"""
+    spec = BULK_ENTITIES[entity]
+    columns = ", ".join(get_export_columns(entity, include_secrets))
+    conn = get_db_connection(readonly=True)
+    if not conn:
+        raise RuntimeError("資料庫連線失敗")
+    try:
+        source = get_history_source(conn, spec["table"]) if spec["table"] in ARCHIVE_TABLES else spec["table"]
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT {columns} FROM {source} WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_size)
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+            last_id = rows[-1]["id"]
+    finally:
+        conn.close()
+
+def export_records(entity, path, file_format=None, include_secrets=False):
+    """將資料串流寫出成 CSV / NDJSON，回傳匯出筆數；include_secrets=False 時不含密碼雜湊等 secret_columns。"""
+    file_format = detect_bulk_format(path, file_format)
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as output_file:
+        rows = iter_export_rows(entity, include_secrets=include_secrets)
+        if file_format == "csv":
+            writer = csv.DictWriter(output_file, fieldnames=get_export_columns(entity, include_secrets))
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                output_file.write(json.dumps(row, ensure_ascii=False) + "\n")
+                count += 1
+    return count
+
+def run_bulk_command(command):
+    """命令列指令：python app.py import|export <appointments|medications|users> <檔案> [選項]"""
+    parser = argparse.ArgumentParser(prog=f"app.py {command}")
+    parser.add_argument("entity", choices=sorted(BULK_ENTITIES))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=("csv", "ndjson"), help="預設依副檔名判斷（.csv 以外視為 NDJSON）")
+    if command == "import":
+        parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="每個交易寫入的筆數")
+        parser.add_argument("--defer-indexes", action="store_true", default=None, help="匯入期間先移除次要索引")
+        parser.add_argument("--keep-indexes", dest="defer_indexes", action="store_false", help="匯入期間保留索引")
+        parser.add_argument("--restart", action="store_true", help="忽略先前的進度，從頭匯入")
+    else:
+        parser.add_argument("--include-password-hash", action="store_true", help="匯出帳號時包含密碼雜湊（僅供搬移資料庫）")
+    args = parser.parse_args(sys.argv[2:])
+    if command == "import":
+        inserted = import_records(args.entity, args.path, args.format, args.chunk_size, args.defer_indexes, args.restart)
+        print(f"[完成] 已匯入 {inserted} 筆 {args.entity}")
+    else:
+        count = export_records(args.entity, args.path, args.format, args.include_password_hash)
+        print(f"[完成] 已匯出 {count} 筆 {args.entity} 到 {args.path}")
+
+# === 線上備份 ===
+# 以 sqlite3 backup API 分段複製資料庫，每段之間暫停讓線上寫入有機會取得鎖；複製完成後以 integrity_check 驗證
+BACKUP_DIR = os.getenv("BACKUP_DIR") or os.path.join(basedir, "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.05"))
+# 複製途中來源被其他連線寫入時 SQLite 會從頭重新複製；重來超過此次數後改為一次複製完成
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "3"))
+
+class BackupRestartLimit(Exception):
+    pass
+
+def copy_sqlite_database(source_file, target_file, pages=BACKUP_PAGES_PER_STEP, step_sleep=BACKUP_STEP_SLEEP):
+    """以 backup API 將 source_file 複製到 target_file，回傳 {pages, steps, restarts}。"""
+    stats = {"pages": 0, "steps": 0, "restarts": 0}
+    last_remaining = [None]
+
+    def on_progress(status, remaining, total):
+        stats["steps"] += 1
+        stats["pages"] = total
+        if last_remaining[0] is not None and remaining > last_remaining[0]:
+            stats["restarts"] += 1
+            if stats["restarts"] > BACKUP_MAX_RESTARTS:
+                raise BackupRestartLimit()
+        last_remaining[0] = remaining
+        if remaining and step_sleep > 0:
+            time.sleep(step_sleep)
+
+    source = sqlite3.connect(source_file, timeout=DB_BUSY_TIMEOUT / 1000)
+    target = sqlite3.connect(target_file)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=on_progress)
+        except BackupRestartLimit:
+            # 一次複製只在讀取交易內進行；WAL 模式下不會擋住寫入
+            print("[警告] 備份途中資料庫持續變動，改為一次複製完成")
+            source.backup(target, pages=-1)
+            stats["steps"] += 1
+        stats["pages"] = target.execute("PRAGMA page_count").fetchone()[0]
+        # 備份檔改回 DELETE 日誌模式，單一檔案即可搬移或還原
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        target.close()
+        source.close()
+    return stats
+
+def verify_sqlite_database(path):
+    """對備份檔執行 integrity_check，回傳問題清單（空清單代表正常）。"""
+    conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro", uri=True)
+    try:
+        rows = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+    finally:
+        conn.close()
+    return [] if rows == ["ok"] else rows
+
+def rotate_backups(prefix, keep=BACKUP_KEEP, backup_dir=BACKUP_DIR):
+    """只保留最新的 keep 份備份，回傳刪除的檔案。"""
+    backups = sorted(
+        name for name in os.listdir(backup_dir)
+        if name.startswith(prefix + ".") and name.endswith(".db")
+    )
+    removed = []
+    for name in backups[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(backup_dir, name))
+        removed.append(name)
+    return removed
+
+def backup_database(backup_dir=BACKUP_DIR, keep=BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP, step_sleep=BACKUP_STEP_SLEEP, verify=True):
+    """備份主資料庫（與存在的封存資料庫），回傳每個檔案的報告。
+
+    先寫到 .partial 暫存檔，驗證通過後才改名，備份目錄中不會出現不完整的檔案。
+    """
+    if DB_BACKEND != "sqlite":
+        raise RuntimeError(f"線上備份使用 SQLite backup API，目前後端為 {DB_BACKEND}，請使用資料庫本身的備份工具")
+    os.makedirs(backup_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    reports = []
+    for source_file in (SQLITE_DB_FILE, ARCHIVE_DB_FILE):
+        if not os.path.exists(source_file):
+            continue
+        prefix = os.path.splitext(os.path.basename(source_file))[0]
+        target_file = os.path.join(backup_dir, f"{prefix}.{timestamp}.db")
+        partial_file = target_file + ".partial"
+        started = time.perf_counter()
+        try:
+            stats = copy_sqlite_database(source_file, partial_file, pages, step_sleep)
+            copied = time.perf_counter()
+            problems = verify_sqlite_database(partial_file) if verify else []
+            if problems:
+                raise RuntimeError(f"{source_file} 備份驗證失敗: {'; '.join(problems[:5])}")
+            os.replace(partial_file, target_file)
+        finally:
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+        report = dict(stats)
+        report.update({
+            "source": source_file,
+            "file": target_file,
+            "bytes": os.path.getsize(target_file),
+            "copy_seconds": round(copied - started, 3),
+            "verify_seconds": round(time.perf_counter() - copied, 3) if verify else None,
+            "removed": rotate_backups(prefix, keep, backup_dir),
+        })
+        reports.append(report)
+    return reports
+
+def run_backup_command():
+    """命令列指令：python app.py backup [--dir 路徑] [--keep N] [--interval 分鐘]"""
+    parser = argparse.ArgumentParser(prog="app.py backup", description="線上備份 SQLite 資料庫")
+    parser.add_argument("--dir", default=BACKUP_DIR, help="備份目錄")
+    parser.add_argument("--keep", type=int, default=BACKUP_KEEP, help="保留的備份份數，0 表示不刪除")
+    parser.add_argument("--pages", type=int, default=BACKUP_PAGES_PER_STEP, help="每段複製的頁數，-1 表示一次複製")
+    parser.add_argument("--sleep", type=float, default=BACKUP_STEP_SLEEP, help="每段之間暫停的秒數")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="略過 integrity_check")
+    parser.add_argument("--interval", type=float, default=0, help="每隔幾分鐘備份一次（持續執行），0 表示只備份一次")
+    args = parser.parse_args(sys.argv[2:])
+    while True:
+        try:
+            for report in backup_database(args.dir, args.keep, args.pages, args.sleep, args.verify):
+                verify_text = f"，驗證 {report['verify_seconds']} 秒" if args.verify else "，未驗證"
+                print(
+                    f"[完成] {report['source']} -> {report['file']}：{report['pages']} 頁（{report['bytes']} bytes），"
+                    f"{report['steps']} 段，重來 {report['restarts']} 次，複製 {report['copy_seconds']} 秒{verify_text}"
+                )
+                for name in report["removed"]:
+                    print(f"[備份] 已刪除舊備份 {name}")
+        except Exception as e:
+            if not args.interval:
+                raise
+            print(f"[錯誤] 備份失敗: {e}")
+        if not args.interval:
+            return
+        time.sleep(args.interval * 60)
+
+def run_rebuild_adherence_command():
+    """命令列指令：python app.py rebuild-adherence（含已封存的服藥紀錄）"""
+    conn = get_db_connection(readonly=False)
+    if not conn:
+        raise RuntimeError("資料庫連線失敗")
+    try:
+        # ATTACH 不能在交易中執行，需在 BEGIN 之前取得資料來源
+        source = get_history_source(conn, "medication_logs")
+        retry_on_busy(lambda: begin_write_transaction(conn))
+        try:
+            total = rebuild_medication_adherence(conn, source)
+            bump_adherence_epoch(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"[完成] 已重建 medication_adherence_daily，共 {total} 筆")
+    finally:
+        conn.close()
+
+def run_rebuild_access_command():
+    """命令列指令：python app.py rebuild-access（修改 CARE_LINK_MAX_HOPS 後需執行）"""
+    def rebuild(conn):
+        refresh_user_access(conn)
+        bump_auth_epoch(conn)
+        return conn.execute("SELECT COUNT(*) AS total FROM user_access").fetchone()["total"]
+
+    total = run_db_write(rebuild)
+    print(f"[完成] 已重建 user_access（最多 {CARE_LINK_MAX_HOPS} 層），共 {total} 筆")
 
 # 啟動時初始化資料庫
 init_db()
@@ -321,7 +2528,8 @@ def medication():
     default_start = datetime.now().strftime("%Y-%m-%d")
     if request.method == "POST":
         form = request.form
-        reminder_values = parse_reminder_times(form.get("reminder_times", ""))
+        reminder_minutes = parse_reminder_minutes(form.get("reminder_times", ""))
+        reminder_values = format_reminder_minutes(reminder_minutes)
         required_fields = [
             form.get("medication_name"),
             form.get("dosage"),
@@ -341,22 +2549,8 @@ def medication():
                 edit_mode=False,
             )
 
-        conn = get_db_connection()
-        if not conn:
-            return render_template(
-                "medication.html",
-                username=username,
-                lang=lang,
-                manageable_people=manageable_people,
-                form_data=form,
-                error=("Database connection failed" if lang == "en" else "資料庫連線失敗"),
-                edit_mode=False,
-            )
-        try:
-            resolved_target = resolve_manageable_target(username, form.get("target_profile"), lang)
-            if not resolved_target:
-                raise ValueError("Please choose a valid care target" if lang == "en" else "請選擇有效的用藥對象")
-            conn.execute(
+        def create_medication(conn):
+            medication_id = conn.execute(
                 """INSERT INTO medications
                    (username, owner_username, profile_id, created_by_username, medication_name, dosage, frequency,
                     reminder_times, start_date, end_date, instructions, precautions, status)
@@ -375,9 +2569,16 @@ def medication():
                     form.get("instructions", "").strip(),
                     form.get("precautions", "").strip(),
                 )
-            )
-            conn.commit()
-            return redirect(url_for("medication_list", success=("Medication plan created" if lang == "en" else "用藥計畫已新增"), lang=lang))
+            ).lastrowid
+            save_medication_reminders(conn, medication_id, reminder_minutes)
+            bump_adherence_epoch(conn, [resolved_target["owner_username"]])
+            return medication_id
+
+        try:
+            resolved_target = resolve_manageable_target(username, form.get("target_profile"), lang)
+            if not resolved_target:
+                raise ValueError("Please choose a valid care target" if lang == "en" else "請選擇有效的用藥對象")
+            medication_id = run_db_write(create_medication)
         except Exception as e:
             form_data = dict(form)
             form_data["target_profile"] = form.get("target_profile", default_target)
@@ -387,11 +2588,17 @@ def medication():
                 lang=lang,
                 manageable_people=manageable_people,
                 form_data=form_data,
-                error=(f"Create failed: {e}" if lang == "en" else f"新增失敗：{e}"),
+                error=(
+                    (f"Create failed: {e}" if lang == "en" else f"新增失敗：{e}")
+                    if isinstance(e, ValueError)
+                    else build_write_error_message(e, lang)
+                ),
                 edit_mode=False,
             )
-        finally:
-            conn.close()
+        message = ("Medication plan created" if lang == "en" else "用藥計畫已新增") + build_interaction_notice(
+            resolved_target["owner_username"], resolved_target.get("profile_id"), medication_id, lang
+        )
+        return redirect(url_for("medication_list", success=message, lang=lang))
 
     return render_template(
         "medication.html",
@@ -420,7 +2627,8 @@ def edit_medication(medication_id):
 
     if request.method == "POST":
         form = request.form
-        reminder_values = parse_reminder_times(form.get("reminder_times", ""))
+        reminder_minutes = parse_reminder_minutes(form.get("reminder_times", ""))
+        reminder_values = format_reminder_minutes(reminder_minutes)
         required_fields = [
             form.get("medication_name"),
             form.get("dosage"),
@@ -441,13 +2649,7 @@ def edit_medication(medication_id):
                 medication_id=medication_id,
             )
 
-        conn = get_db_connection()
-        if not conn:
-            return redirect(url_for("medication_list", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-        try:
-            resolved_target = resolve_manageable_target(username, form.get("target_profile"), lang)
-            if not resolved_target:
-                raise ValueError("Please choose a valid care target" if lang == "en" else "請選擇有效的用藥對象")
+        def update_medication(conn):
             conn.execute(
                 """UPDATE medications
                    SET username=?, owner_username=?, profile_id=?, created_by_username=?, medication_name=?, dosage=?,
@@ -470,8 +2672,19 @@ def edit_medication(medication_id):
                     medication_id,
                 )
             )
-            conn.commit()
-            return redirect(url_for("medication_list", success=("Medication plan updated" if lang == "en" else "用藥計畫已更新"), lang=lang))
+            save_medication_reminders(conn, medication_id, reminder_minutes)
+            # 今天起的彙總改用新的提醒次數，過去的紀錄保留當時的次數
+            conn.execute(
+                "UPDATE medication_adherence_daily SET scheduled = ? WHERE medication_id = ? AND log_date >= ?",
+                (len(reminder_values), medication_id, datetime.now().strftime("%Y-%m-%d"))
+            )
+            bump_adherence_epoch(conn, [medication_item["owner_username"], resolved_target["owner_username"]])
+
+        try:
+            resolved_target = resolve_manageable_target(username, form.get("target_profile"), lang)
+            if not resolved_target:
+                raise ValueError("Please choose a valid care target" if lang == "en" else "請選擇有效的用藥對象")
+            run_db_write(update_medication)
         except Exception as e:
             form_data = dict(form)
             form_data["target_profile"] = form.get("target_profile", target_value)
@@ -481,12 +2694,18 @@ def edit_medication(medication_id):
                 lang=lang,
                 manageable_people=manageable_people,
                 form_data=form_data,
-                error=(f"Update failed: {e}" if lang == "en" else f"更新失敗：{e}"),
+                error=(
+                    (f"Update failed: {e}" if lang == "en" else f"更新失敗：{e}")
+                    if isinstance(e, ValueError)
+                    else build_write_error_message(e, lang)
+                ),
                 edit_mode=True,
                 medication_id=medication_id,
             )
-        finally:
-            conn.close()
+        message = ("Medication plan updated" if lang == "en" else "用藥計畫已更新") + build_interaction_notice(
+            resolved_target["owner_username"], resolved_target.get("profile_id"), medication_id, lang
+        )
+        return redirect(url_for("medication_list", success=message, lang=lang))
 
     form_data = dict(medication_item)
     form_data["target_profile"] = target_value
@@ -503,23 +2722,34 @@ def edit_medication(medication_id):
 
 @app.route("/medication/archive/<int:medication_id>")
 @login_required
+@db_writes_on_get
 def archive_medication(medication_id):
     lang = get_request_lang()
     medication_item = get_medication_with_access(medication_id, session.get("user"))
     if not medication_item:
         return redirect(url_for("medication_list", error=("Medication record not found" if lang == "en" else "找不到這筆用藥資料"), lang=lang))
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for("medication_list", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-    try:
+    def archive(conn):
         conn.execute(
             "UPDATE medications SET status = 'inactive', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
             (medication_id,)
         )
-        conn.commit()
-        return redirect(url_for("medication_list", success=("Medication plan archived" if lang == "en" else "用藥計畫已封存"), lang=lang))
-    finally:
-        conn.close()
+        bump_adherence_epoch(conn, [medication_item["owner_username"]])
+
+    try:
+        run_db_write(archive)
+    except Exception as e:
+        return redirect(url_for("medication_list", error=build_write_error_message(e, lang), lang=lang))
+    return redirect(url_for("medication_list", success=("Medication plan archived" if lang == "en" else "用藥計畫已封存"), lang=lang))
+
+def build_medication_log_upsert_sql():
+    """服藥紀錄 upsert；參數依序為 medication_id, owner_username, log_date, reminder_time, status, note, created_by_username。"""
+    return build_upsert_sql(
+        "medication_logs",
+        ("medication_id", "owner_username", "log_date", "reminder_time", "status", "note", "created_by_username", "taken_at"),
+        ("medication_id", "log_date", "reminder_time"),
+        {"status": None, "note": None, "created_by_username": None, "taken_at": "CURRENT_TIMESTAMP"},
+        values={"taken_at": "CURRENT_TIMESTAMP"},
+    )
 
 @app.route("/medication/log/<int:medication_id>", methods=["POST"])
 @login_required
@@ -539,17 +2769,9 @@ def log_medication_status(medication_id):
     if status not in {"taken", "skipped"}:
         return redirect(url_for("medication_list", error=("Invalid medication status" if lang == "en" else "用藥狀態不正確"), lang=lang))
 
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for("medication_list", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-    try:
+    def save_log(conn):
         conn.execute(
-            """INSERT INTO medication_logs
-               (medication_id, owner_username, log_date, reminder_time, status, note, created_by_username, taken_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-               ON CONFLICT(medication_id, log_date, reminder_time)
-               DO UPDATE SET status=excluded.status, note=excluded.note, created_by_username=excluded.created_by_username,
-                             taken_at=CURRENT_TIMESTAMP""",
+            build_medication_log_upsert_sql(),
             (
                 medication_id,
                 medication_item["owner_username"],
@@ -560,11 +2782,125 @@ def log_medication_status(medication_id):
                 username,
             )
         )
-        conn.commit()
-        message = ("Marked as taken" if lang == "en" else "已標記為已服用") if status == "taken" else ("Marked as skipped" if lang == "en" else "已標記為略過")
-        return redirect(url_for("medication_list", success=message, lang=lang))
+        refresh_medication_adherence_day(conn, medication_id, log_date, len(medication_item["reminder_list"]))
+        bump_adherence_epoch(conn, [medication_item["owner_username"]])
+
+    try:
+        run_db_write(save_log)
+    except Exception as e:
+        return redirect(url_for("medication_list", error=build_write_error_message(e, lang), lang=lang))
+    message = ("Marked as taken" if lang == "en" else "已標記為已服用") if status == "taken" else ("Marked as skipped" if lang == "en" else "已標記為略過")
+    return redirect(url_for("medication_list", success=message, lang=lang))
+
+# 批次記錄一次最多可包含的筆數
+MEDICATION_LOG_BATCH_MAX = int(os.getenv("MEDICATION_LOG_BATCH_MAX", "100"))
+
+def load_loggable_medications(medication_ids, username):
+    """以單一查詢取得 username 可代辦的用藥與其提醒時間：{medication_id: {"owner_username", "reminder_list"}}。"""
+    placeholders = ",".join(["?"] * len(medication_ids))
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("資料庫連線失敗")
+    try:
+        rows = conn.execute(
+            f"""SELECT m.id, m.owner_username, r.minute_of_day
+                FROM medications m
+                LEFT JOIN medication_reminders r ON r.medication_id = m.id
+                WHERE m.id IN ({placeholders}) AND {build_owner_access_condition("m.owner_username")}
+                ORDER BY m.id, r.minute_of_day""",
+            list(medication_ids) + [username, username]
+        ).fetchall()
     finally:
         conn.close()
+    medications = {}
+    for row in rows:
+        medication = medications.setdefault(row["id"], {"owner_username": row["owner_username"], "reminder_list": []})
+        if row["minute_of_day"] is not None:
+            medication["reminder_list"].append(REMINDER_MINUTE_LABELS[row["minute_of_day"]])
+    return medications
+
+@app.route("/api/medications/logs", methods=["POST"])
+@login_required
+def log_medication_status_batch():
+    """批次記錄服藥狀態：{"entries": [{"medication_id", "reminder_time", "status", "log_date"（選填，預設今天）, "note"（選填）}]}。
+
+    權限以一次查詢驗證，通過的項目在同一個交易內寫入；results 依輸入順序回傳每一筆是否成功。
+    """
+    lang = get_request_lang()
+    username = session.get("user")
+    data = request.get_json(silent=True)
+    entries = data.get("entries") if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"success": False, "error": "entries must be a non-empty list" if lang == "en" else "entries 需為非空的陣列"}), 400
+    if len(entries) > MEDICATION_LOG_BATCH_MAX:
+        return jsonify({"success": False, "error": f"At most {MEDICATION_LOG_BATCH_MAX} entries per request" if lang == "en" else f"每次最多 {MEDICATION_LOG_BATCH_MAX} 筆"}), 400
+
+    today = datetime.now().strftime("%Y-%m-%d")
+    results = []
+    for index, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        result = {
+            "index": index,
+            "medication_id": entry.get("medication_id"),
+            "log_date": entry.get("log_date") or today,
+            "reminder_time": str(entry.get("reminder_time") or "").strip(),
+            "status": str(entry.get("status") or "taken").strip().lower(),
+            "note": str(entry.get("note") or "").strip(),
+            "success": False,
+        }
+        try:
+            result["medication_id"] = int(result["medication_id"])
+            result["log_date"] = date.fromisoformat(str(result["log_date"])).isoformat()
+        except (TypeError, ValueError):
+            result["error"] = "Invalid medication_id or log_date" if lang == "en" else "medication_id 或 log_date 格式不正確"
+        else:
+            if result["status"] not in {"taken", "skipped"}:
+                result["error"] = "Invalid medication status" if lang == "en" else "用藥狀態不正確"
+        results.append(result)
+
+    candidate_ids = sorted({result["medication_id"] for result in results if "error" not in result})
+    try:
+        medications = load_loggable_medications(candidate_ids, username) if candidate_ids else {}
+    except Exception as e:
+        return jsonify({"success": False, "error": build_write_error_message(e, lang)}), 500
+    accepted = []
+    for result in results:
+        if "error" in result:
+            continue
+        medication = medications.get(result["medication_id"])
+        if not medication:
+            result["error"] = "Medication record not found" if lang == "en" else "找不到這筆用藥資料"
+        elif result["reminder_time"] not in medication["reminder_list"]:
+            result["error"] = "Invalid reminder time" if lang == "en" else "提醒時間格式不正確"
+        else:
+            result["owner_username"] = medication["owner_username"]
+            accepted.append(result)
+
+    def save_logs(conn):
+        conn.executemany(build_medication_log_upsert_sql(), [
+            (
+                result["medication_id"], result["owner_username"], result["log_date"], result["reminder_time"],
+                result["status"], result["note"], username,
+            )
+            for result in accepted
+        ])
+        refresh_medication_adherence_days(conn, {
+            (result["medication_id"], result["log_date"]): len(medications[result["medication_id"]]["reminder_list"])
+            for result in accepted
+        })
+        bump_adherence_epoch(conn, [result["owner_username"] for result in accepted])
+
+    if accepted:
+        try:
+            run_db_write(save_logs)
+        except Exception as e:
+            return jsonify({"success": False, "error": build_write_error_message(e, lang)}), 500
+        for result in accepted:
+            result["success"] = True
+    for result in results:
+        result.pop("owner_username", None)
+        result.pop("note", None)
+    return jsonify({"success": True, "saved": len(accepted), "results": results})
 
 @app.route("/medication/list")
 @login_required
@@ -572,11 +2908,19 @@ def medication_list():
     lang = get_request_lang()
     username = session.get("user")
     keyword = request.args.get("keyword", "").strip()
+    limit, after, before = get_page_args()
     try:
-        medications = get_accessible_medications(username, keyword)
-        today_schedule = build_today_medication_schedule(medications)
+        # 啟用中的用藥只讀取精簡欄位，交互作用檢查與今日提醒共用同一份；
+        # 今日提醒只另外載入提醒時間與今日紀錄，遵從度與安全提示等完整資料只處理分頁內的用藥
+        regimen = get_active_regimen_medications(get_accessible_owner_usernames(username), lang)
+        interaction_warnings = get_regimen_interactions(regimen)
+        active_medications = load_today_medication_status(
+            [med for med in regimen if medication_matches_keyword(med, keyword)]
+        )
+        today_schedule = build_today_medication_schedule(active_medications)
+        page = get_medication_page(username, keyword, after, before, limit)
         summary = {
-            "active_count": sum(1 for med in medications if med.get("status") == "active"),
+            "active_count": len(active_medications),
             "today_reminders": len(today_schedule),
             "taken_count": sum(1 for item in today_schedule if item["status"] == "taken"),
             "due_count": sum(1 for item in today_schedule if item["status"] == "due"),
@@ -585,9 +2929,13 @@ def medication_list():
             "medication_list.html",
             username=username,
             lang=lang,
-            medications=medications,
+            medications=page["items"],
+            next_cursor=page["next_cursor"],
+            prev_cursor=page["prev_cursor"],
+            page_limit=limit,
             today_schedule=today_schedule,
             summary=summary,
+            interaction_warnings=interaction_warnings,
             keyword=keyword,
             success=request.args.get("success"),
             error=request.args.get("error"),
@@ -608,6 +2956,82 @@ def medication_list():
             accessible_owners=get_accessible_owner_usernames(username),
         )
 
+@app.route("/api/medications")
+@login_required
+def medication_list_api():
+    """JSON 版用藥列表，游標參數（after / before / limit）與 /medication/list 相同。"""
+    limit, after, before = get_page_args()
+    page = get_medication_page(session.get("user"), request.args.get("keyword", "").strip(), after, before, limit)
+    return jsonify({"success": True, **page})
+
+@app.route("/api/medications/calendar")
+@login_required
+def medication_calendar_api():
+    """用藥行事曆：?start=YYYY-MM-DD&days=N（預設從今天起 7 天）&owner=帳號（選填）。
+
+    每個用藥的 states 依「日期 → 提醒時間」排列，值為 state_names 的索引。
+    """
+    lang = get_request_lang()
+    try:
+        start_date = date.fromisoformat(request.args.get("start") or datetime.now().strftime("%Y-%m-%d"))
+        days = int(request.args.get("days", "7"))
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid start or days" if lang == "en" else "start 或 days 格式不正確"}), 400
+    if not 1 <= days <= MEDICATION_CALENDAR_MAX_DAYS:
+        return jsonify({"success": False, "error": f"days must be between 1 and {MEDICATION_CALENDAR_MAX_DAYS}" if lang == "en" else f"days 需介於 1 到 {MEDICATION_CALENDAR_MAX_DAYS}"}), 400
+    end_date = start_date + timedelta(days=days - 1)
+    calendar = get_medication_calendar(
+        session.get("user"), start_date.isoformat(), end_date.isoformat(),
+        request.args.get("owner", "").strip() or None, lang
+    )
+    return jsonify({"success": True, **calendar})
+
+@app.route("/api/medications/adherence")
+@login_required
+def medication_adherence_api():
+    """近 N 日遵從度：?windows=7,30,90（預設 ADHERENCE_WINDOWS）&owner=帳號（選填）。
+
+    依用藥（medications）、照護對象（profiles，profile_id 為 null 代表帳號本人）與帳號（owners）分別加總，
+    windows 內的 key 為天數。
+    """
+    lang = get_request_lang()
+    try:
+        windows = sorted({int(value) for value in request.args.get("windows", "").split(",") if value.strip()}) or list(ADHERENCE_WINDOWS)
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid windows" if lang == "en" else "windows 格式不正確"}), 400
+    if not all(1 <= window <= ADHERENCE_MAX_WINDOW_DAYS for window in windows):
+        return jsonify({"success": False, "error": f"windows must be between 1 and {ADHERENCE_MAX_WINDOW_DAYS}" if lang == "en" else f"windows 需介於 1 到 {ADHERENCE_MAX_WINDOW_DAYS}"}), 400
+    analytics = get_adherence_analytics(session.get("user"), windows, request.args.get("owner", "").strip() or None, lang)
+    return jsonify({"success": True, **analytics})
+
+@app.route("/api/mood/trend")
+@login_required
+def mood_trend_api():
+    """心情趨勢：?granularity=day|week|month（預設 week）&points=N&owner=帳號&profile=self|照護對象 id&start=&end=。
+
+    每一點為一段期間的平均分數；期間數超過 points 時相鄰期間會合併。
+    """
+    lang = get_request_lang()
+    granularity = request.args.get("granularity", "week")
+    if granularity not in MOOD_TREND_GRANULARITIES:
+        return jsonify({"success": False, "error": "granularity must be day, week or month" if lang == "en" else "granularity 需為 day、week 或 month"}), 400
+    profile = request.args.get("profile", "").strip()
+    try:
+        points = int(request.args.get("points", MOOD_TREND_DEFAULT_POINTS))
+        profile_key = None if not profile else 0 if profile == "self" else int(profile)
+        start_date = date.fromisoformat(request.args["start"]).isoformat() if request.args.get("start") else None
+        end_date = date.fromisoformat(request.args["end"]).isoformat() if request.args.get("end") else None
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid points, profile or date" if lang == "en" else "points、profile 或日期格式不正確"}), 400
+    if not 1 <= points <= MOOD_TREND_MAX_POINTS:
+        return jsonify({"success": False, "error": f"points must be between 1 and {MOOD_TREND_MAX_POINTS}" if lang == "en" else f"points 需介於 1 到 {MOOD_TREND_MAX_POINTS}"}), 400
+    trend = get_mood_trend(
+        session.get("user"), request.args.get("owner", "").strip() or None, profile_key, granularity, points, start_date, end_date
+    )
+    if trend is None:
+        return jsonify({"success": False, "error": "Account not accessible" if lang == "en" else "無權限查看這個帳號"}), 403
+    return jsonify({"success": True, **trend})
+
 @app.route("/mood/delete/<int:assessment_id>", methods=["POST"])
 @login_required
 def delete_mood_assessment(assessment_id):
@@ -617,15 +3041,15 @@ def delete_mood_assessment(assessment_id):
     if not assessment:
         return redirect(url_for("mood", error=("Mood assessment not found" if lang == "en" else "找不到這筆心情評估紀錄"), lang=lang))
 
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for("mood", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-    try:
+    def remove_assessment(conn):
         conn.execute("DELETE FROM mood_assessments WHERE id = ?", (assessment_id,))
-        conn.commit()
-        return redirect(url_for("mood", success=("Mood assessment deleted" if lang == "en" else "心情評估紀錄已刪除"), lang=lang))
-    finally:
-        conn.close()
+        update_mood_trend_buckets(conn, assessment, sign=-1)
+
+    try:
+        run_db_write(remove_assessment)
+    except Exception as e:
+        return redirect(url_for("mood", error=build_write_error_message(e, lang, "delete"), lang=lang))
+    return redirect(url_for("mood", success=("Mood assessment deleted" if lang == "en" else "心情評估紀錄已刪除"), lang=lang))
 
 @app.route("/mood", methods=["GET", "POST"])
 @login_required
@@ -668,11 +3092,9 @@ def mood():
                 scores[field] = int(risk_value)
 
             mood_result = evaluate_mood_scores(scores, lang)
-            conn = get_db_connection()
-            if not conn:
-                raise ValueError("Database connection failed" if lang == "en" else "資料庫連線失敗")
-            try:
-                cursor = conn.execute(
+
+            def save_assessment(conn):
+                new_id = conn.execute(
                     """INSERT INTO mood_assessments
                        (username, owner_username, profile_id, created_by_username, sleep_score, appetite_score,
                         energy_score, stress_score, social_score, emotion_score, interest_score, anxiety_score,
@@ -703,11 +3125,19 @@ def mood():
                         "",
                         mood_result["risk_alert"],
                     )
-                )
-                conn.commit()
-                return redirect(url_for("mood", assessment_id=cursor.lastrowid, success=("Mood assessment completed" if lang == "en" else "心情評估已完成"), lang=lang))
-            finally:
-                conn.close()
+                ).lastrowid
+                created_at = conn.execute("SELECT created_at FROM mood_assessments WHERE id = ?", (new_id,)).fetchone()["created_at"]
+                update_mood_trend_buckets(conn, {
+                    **scores,
+                    "total_score": mood_result["total_score"],
+                    "owner_username": resolved_target["owner_username"],
+                    "profile_id": resolved_target.get("profile_id"),
+                    "created_at": created_at,
+                })
+                return new_id
+
+            assessment_id = run_db_write(save_assessment)
+            return redirect(url_for("mood", assessment_id=assessment_id, success=("Mood assessment completed" if lang == "en" else "心情評估已完成"), lang=lang))
         except Exception as e:
             return render_template(
                 "mood.html",
@@ -828,7 +3258,7 @@ def resolve_gemini_api_key():
 def init_gemini_model():
     global gemini_model
 
-    if is_set_api_key_command():
+    if is_set_api_key_command() or get_db_command():
         return
 
     api_key = resolve_gemini_api_key()
@@ -885,15 +3315,29 @@ def get_user_by_username(username):
 
 def get_accessible_owner_usernames(username):
     """Return owner accounts the current user can manage."""
+    return list(request_memo(("accessible_owners", username), lambda: _get_session_owner_usernames(username)))
+
+def _get_session_owner_usernames(username):
+    """登入者的可代辦帳號與授權版本號一起存在 session；版本號相同時只需查一個整數，不必查授權關係。"""
+    if not has_request_context() or session.get("user") != username:
+        return _load_accessible_owner_usernames(username)
+    epoch = get_auth_epoch(username)
+    cached = session.get("auth_cache")
+    if epoch is not None and cached and cached.get("user") == username and cached.get("epoch") == epoch:
+        return cached["owners"]
+    owner_usernames = _load_accessible_owner_usernames(username)
+    if epoch is not None:
+        session["auth_cache"] = {"user": username, "epoch": epoch, "owners": owner_usernames}
+    return owner_usernames
+
+def _load_accessible_owner_usernames(username):
     conn = get_db_connection()
     if not conn:
         return [username]
     try:
         owner_usernames = {username}
         rows = conn.execute(
-            """SELECT owner_username
-               FROM care_links
-               WHERE linked_username = ? AND status = 'active'""",
+            "SELECT owner_username FROM user_access WHERE manager_username = ?",
             (username,)
         ).fetchall()
         owner_usernames.update(row["owner_username"] for row in rows)
@@ -901,6 +3345,13 @@ def get_accessible_owner_usernames(username):
     finally:
         conn.close()
 
+def build_owner_access_condition(column):
+    """單筆資料的權限條件：本人，或 user_access 中有對應的代辦權限（主鍵查詢）。參數為 (username, username)。"""
+    return (
+        f"({column} = ? OR EXISTS (SELECT 1 FROM user_access ua "
+        f"WHERE ua.manager_username = ? AND ua.owner_username = {column}))"
+    )
+
 def get_owner_linked_accounts(owner_username):
     conn = get_db_connection()
     if not conn:
@@ -965,96 +3416,167 @@ def build_target_label(profile_name=None, relationship=None, lang="zh"):
         return f"{profile_name}（{translated_relationship}）"
     return "Self" if lang == "en" else "自己"
 
+def build_user_target(owner, username, lang="zh"):
+    """帳號本人的代辦對象選項；owner 為 users 資料列。"""
+    owner_username = owner["username"]
+    owner_name = owner.get("name") or owner_username
+    return {
+        "target_value": f"user:{owner_username}",
+        "target_type": "user",
+        "owner_username": owner_username,
+        "profile_id": None,
+        "patient_name": owner_name,
+        "patient_phone": owner.get("phone", ""),
+        "patient_id": owner.get("identity_id", ""),
+        "label": (
+            f"{owner_name} (Self)"
+            if lang == "en" and owner_username == username
+            else f"{owner_name} ({owner_username} account)"
+            if lang == "en"
+            else f"{owner_name}（本人）"
+            if owner_username == username
+            else f"{owner_name}（{owner_username} 本人）"
+        ),
+        "description": (
+            "My account"
+            if lang == "en" and owner_username == username
+            else f"Authorized by {owner_username}"
+            if lang == "en"
+            else "我的帳號"
+            if owner_username == username
+            else f"由 {owner_username} 授權代辦"
+        )
+    }
+
+def build_profile_target(profile, username, lang="zh"):
+    """受照護對象的代辦對象選項；profile 為 care_profiles 資料列。"""
+    owner_username = profile["owner_username"]
+    relationship = profile.get("relationship") or "家人"
+    return {
+        "target_value": f"profile:{profile['id']}",
+        "target_type": "profile",
+        "owner_username": owner_username,
+        "profile_id": profile["id"],
+        "patient_name": profile.get("profile_name", ""),
+        "patient_phone": profile.get("phone", ""),
+        "patient_id": profile.get("identity_id", ""),
+        "relationship": relationship,
+        "birth_date": profile.get("birth_date", ""),
+        "notes": profile.get("notes", ""),
+        "label": build_target_label(profile.get("profile_name", ""), relationship, lang),
+        "description": (
+            "My care recipient"
+            if lang == "en" and owner_username == username
+            else f"{owner_username}'s family member"
+            if lang == "en"
+            else "我的受照護對象"
+            if owner_username == username
+            else f"{owner_username} 家庭成員"
+        )
+    }
+
+# 跨請求的可代辦對象快取：{(帳號, 語系): (授權版本號, 對象清單)}，該帳號的授權版本號變動後失效
+MANAGEABLE_PEOPLE_CACHE_SIZE = int(os.getenv("MANAGEABLE_PEOPLE_CACHE_SIZE", "1024"))
+_manageable_people_cache = {}
+_manageable_people_cache_lock = threading.Lock()
+
+def get_auth_epoch(username):
+    """帳號目前的授權版本號（同一請求內只查一次）；查詢失敗時回傳 None，呼叫端不使用快取。"""
+    def load():
+        conn = get_db_connection()
+        if not conn:
+            return None
+        try:
+            row = conn.execute("SELECT auth_epoch FROM users WHERE username = ?", (username,)).fetchone()
+            return row["auth_epoch"] if row else None
+        except Exception as e:
+            print(f"[警告] 讀取授權版本號失敗: {e}")
+            return None
+        finally:
+            conn.close()
+    return request_memo(("auth_epoch", username), load)
+
 def get_manageable_people(username, lang="zh"):
     """Build selectable booking targets for the current user."""
+    targets = request_memo(("manageable_people", username, lang), lambda: _get_cached_manageable_people(username, lang))
+    return [dict(target) for target in targets]
+
+def _get_cached_manageable_people(username, lang):
+    epoch = get_auth_epoch(username)
+    key = (username, lang)
+    if epoch is not None:
+        with _manageable_people_cache_lock:
+            cached = _manageable_people_cache.get(key)
+        if cached and cached[0] == epoch:
+            return cached[1]
+    targets = _load_manageable_people(username, lang)
+    if epoch is not None and MANAGEABLE_PEOPLE_CACHE_SIZE > 0:
+        with _manageable_people_cache_lock:
+            if len(_manageable_people_cache) >= MANAGEABLE_PEOPLE_CACHE_SIZE:
+                # 超過上限時丟掉最早放入的一筆（dict 保留插入順序）
+                _manageable_people_cache.pop(next(iter(_manageable_people_cache)))
+            _manageable_people_cache.pop(key, None)
+            _manageable_people_cache[key] = (epoch, targets)
+    return targets
+
+def _load_manageable_people(username, lang="zh"):
+    """以單一查詢取得所有可代辦帳號本人與其受照護對象，依帳號排序、本人在前。"""
     conn = get_db_connection()
     if not conn:
         return []
     try:
-        targets = []
-        owner_usernames = get_accessible_owner_usernames(username)
-        for owner_username in owner_usernames:
-            owner = conn.execute(
-                "SELECT username, name, phone, identity_id FROM users WHERE username = ?",
-                (owner_username,)
-            ).fetchone()
-            if owner:
-                owner = dict(owner)
-                owner_name = owner.get("name") or owner_username
-                targets.append({
-                    "target_value": f"user:{owner_username}",
-                    "target_type": "user",
-                    "owner_username": owner_username,
-                    "profile_id": None,
-                    "patient_name": owner_name,
-                    "patient_phone": owner.get("phone", ""),
-                    "patient_id": owner.get("identity_id", ""),
-                    "label": (
-                        f"{owner_name} (Self)"
-                        if lang == "en" and owner_username == username
-                        else f"{owner_name} ({owner_username} account)"
-                        if lang == "en"
-                        else f"{owner_name}（本人）"
-                        if owner_username == username
-                        else f"{owner_name}（{owner_username} 本人）"
-                    ),
-                    "description": (
-                        "My account"
-                        if lang == "en" and owner_username == username
-                        else f"Authorized by {owner_username}"
-                        if lang == "en"
-                        else "我的帳號"
-                        if owner_username == username
-                        else f"由 {owner_username} 授權代辦"
-                    )
-                })
-
-            profile_rows = conn.execute(
-                """SELECT id, owner_username, profile_name, relationship, phone, identity_id, birth_date, notes
-                   FROM care_profiles
-                   WHERE owner_username = ?
-                   ORDER BY created_at DESC, id DESC""",
-                (owner_username,)
-            ).fetchall()
-            for row in profile_rows:
-                profile = dict(row)
-                relationship = profile.get("relationship") or "家人"
-                targets.append({
-                    "target_value": f"profile:{profile['id']}",
-                    "target_type": "profile",
-                    "owner_username": owner_username,
-                    "profile_id": profile["id"],
-                    "patient_name": profile.get("profile_name", ""),
-                    "patient_phone": profile.get("phone", ""),
-                    "patient_id": profile.get("identity_id", ""),
-                    "relationship": relationship,
-                    "birth_date": profile.get("birth_date", ""),
-                    "notes": profile.get("notes", ""),
-                    "label": build_target_label(profile.get("profile_name", ""), relationship, lang),
-                    "description": (
-                        "My care recipient"
-                        if lang == "en" and owner_username == username
-                        else f"{owner_username}'s family member"
-                        if lang == "en"
-                        else "我的受照護對象"
-                        if owner_username == username
-                        else f"{owner_username} 家庭成員"
-                    )
-                })
-        return targets
+        rows = conn.execute(
+            f"""SELECT 0 AS target_group, u.username AS owner_username, NULL AS id, u.username,
+                       u.name, NULL AS profile_name, NULL AS relationship, u.phone, u.identity_id,
+                       NULL AS birth_date, NULL AS notes, NULL AS created_at
+                FROM users u
+                WHERE {build_owner_access_condition("u.username")}
+                UNION ALL
+                SELECT 1, cp.owner_username, cp.id, NULL,
+                       NULL, cp.profile_name, cp.relationship, cp.phone, cp.identity_id,
+                       cp.birth_date, cp.notes, cp.created_at
+                FROM care_profiles cp
+                WHERE {build_owner_access_condition("cp.owner_username")}
+                ORDER BY owner_username, target_group, created_at DESC, id DESC""",
+            (username, username, username, username)
+        ).fetchall()
     finally:
         conn.close()
+    return [
+        build_profile_target(dict(row), username, lang) if row["target_group"] else build_user_target(dict(row), username, lang)
+        for row in rows
+    ]
 
 def resolve_manageable_target(username, target_value, lang="zh"):
-    targets = get_manageable_people(username, lang)
-    target_map = {target["target_value"]: target for target in targets}
-    if target_value in target_map:
-        return target_map[target_value]
-    return target_map.get(f"user:{username}")
+    """將表單的 user:帳號 / profile:編號 解析成代辦對象；無效或無權限時回傳本人。
+
+    直接以主鍵查詢單一對象並檢查權限，不必先建立完整的可代辦清單。
+    """
+    target_type, _, target_key = (target_value or "").partition(":")
+    if target_type == "user" and target_key:
+        if target_key == username or target_key in get_accessible_owner_usernames(username):
+            owner = get_user_by_username(target_key)
+            if owner:
+                return build_user_target(owner, username, lang)
+    elif target_type == "profile" and target_key.isdigit():
+        conn = get_db_connection()
+        if conn:
+            try:
+                row = conn.execute(
+                    f"""SELECT id, owner_username, profile_name, relationship, phone, identity_id, birth_date, notes
+                        FROM care_profiles cp
+                        WHERE cp.id = ? AND {build_owner_access_condition("cp.owner_username")}""",
+                    (int(target_key), username, username)
+                ).fetchone()
+            finally:
+                conn.close()
+            if row:
+                return build_profile_target(dict(row), username, lang)
+    if target_value == f"user:{username}":
+        return None
+    return resolve_manageable_target(username, f"user:{username}", lang)
 
 def get_appointment_with_access(apt_id, username):
-    owner_usernames = get_accessible_owner_usernames(username)
-    placeholders = ",".join(["?"] * len(owner_usernames))
     conn = get_db_connection()
     if not conn:
         return None
@@ -1063,125 +3585,1016 @@ def get_appointment_with_access(apt_id, username):
             f"""SELECT ma.*, cp.profile_name, cp.relationship
                 FROM medical_appointments ma
                 LEFT JOIN care_profiles cp ON cp.id = ma.profile_id
-                WHERE ma.id = ? AND COALESCE(ma.owner_username, ma.username) IN ({placeholders})""",
-            [apt_id] + owner_usernames
+                WHERE ma.id = ? AND {build_owner_access_condition("ma.owner_username")}""",
+            (apt_id, username, username)
         ).fetchone()
         return dict(row) if row else None
     finally:
         conn.close()
 
-def get_accessible_appointments(username, keyword=""):
-    owner_usernames = get_accessible_owner_usernames(username)
+def build_accessible_appointments_query(owner_usernames, keyword="", keyset=None, backwards=False, limit=None, source=None):
+    """預約列表 SQL：依 owner_username 過濾並照 idx_appointments_owner_date 的順序排序。
+
+    關鍵字夠長時先由全文索引找出符合的預約，再套用擁有者條件。
+    keyset 為上一頁邊界的 (appointment_date, appointment_time, id)，backwards=True 時往前一頁查詢。
+    source 指定為 medical_appointments_history 時查詢含封存資料的歷史紀錄（關鍵字改以 LIKE 比對）。
+    """
     placeholders = ",".join(["?"] * len(owner_usernames))
-    conn = get_db_connection()
-    if not conn:
-        return []
-    try:
+    like = DB_DIALECT["like"]
+    if keyword and len(keyword) >= FTS_MIN_KEYWORD_LENGTH and DB_DIALECT["fulltext"] and not source:
+        sql = f"""
+            SELECT ma.*, cp.profile_name, cp.relationship
+            FROM medical_appointments_fts
+            CROSS JOIN medical_appointments ma ON ma.id = medical_appointments_fts.rowid
+            LEFT JOIN care_profiles cp ON cp.id = ma.profile_id
+            WHERE medical_appointments_fts MATCH ? AND ma.owner_username IN ({placeholders})
+        """
+        params = [build_fts_match(keyword)] + list(owner_usernames)
+    else:
         sql = f"""
             SELECT ma.*, cp.profile_name, cp.relationship
-            FROM medical_appointments ma
+            FROM {source or "medical_appointments"} ma
             LEFT JOIN care_profiles cp ON cp.id = ma.profile_id
-            WHERE COALESCE(ma.owner_username, ma.username) IN ({placeholders})
+            WHERE ma.owner_username IN ({placeholders})
         """
         params = list(owner_usernames)
         if keyword:
-            sql += """
+            sql += f"""
                 AND (
-                    ma.patient_id LIKE ? OR
-                    ma.patient_name LIKE ? OR
-                    ma.patient_phone LIKE ?
+                    ma.patient_id {like} ? OR
+                    ma.patient_name {like} ? OR
+                    ma.patient_phone {like} ?
                 )
             """
             params.extend([f"%{keyword}%", f"%{keyword}%", f"%{keyword}%"])
-        sql += " ORDER BY ma.appointment_date DESC, ma.appointment_time DESC"
+    if keyset:
+        operator = ">" if backwards else "<"
+        sql += f" AND (ma.appointment_date, ma.appointment_time, ma.id) {operator} (?, ?, ?)"
+        params.extend(keyset)
+    direction = "ASC" if backwards else "DESC"
+    sql += f" ORDER BY ma.appointment_date {direction}, ma.appointment_time {direction}, ma.id {direction}"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+def decorate_appointments(appointments, username):
+    for apt in appointments:
+        apt["owner_username"] = apt.get("owner_username") or apt.get("username")
+        apt["created_by_username"] = apt.get("created_by_username") or apt.get("username")
+        apt["booking_target"] = (
+            f"{apt.get('profile_name')} ({apt.get('relationship') or 'family'})"
+            if apt.get("profile_id")
+            else "Self"
+        )
+        apt["managed_for_other"] = apt["owner_username"] != username
+    return appointments
+
+def get_accessible_appointments(username, keyword=""):
+    owner_usernames = get_accessible_owner_usernames(username)
+    conn = get_db_connection()
+    if not conn:
+        return []
+    try:
+        sql, params = build_accessible_appointments_query(owner_usernames, keyword)
         appointments = [dict(row) for row in conn.execute(sql, params).fetchall()]
-        for apt in appointments:
-            apt["owner_username"] = apt.get("owner_username") or apt.get("username")
-            apt["created_by_username"] = apt.get("created_by_username") or apt.get("username")
-            apt["booking_target"] = (
-                f"{apt.get('profile_name')} ({apt.get('relationship') or 'family'})"
-                if apt.get("profile_id")
-                else "Self"
-            )
-            apt["managed_for_other"] = apt["owner_username"] != username
-        return appointments
+        return decorate_appointments(appointments, username)
     finally:
         conn.close()
 
-def parse_reminder_times(reminder_times):
-    """Normalize reminder time text into sorted HH:MM values."""
-    if not reminder_times:
+def appointment_cursor_values(apt):
+    return [apt["appointment_date"], apt["appointment_time"], apt["id"]]
+
+def get_appointment_page(username, keyword="", after=None, before=None, limit=LIST_PAGE_SIZE, history=False):
+    """以 keyset 分頁取得一頁預約，只讀取 limit + 1 筆；history=True 時包含已封存的預約。"""
+    owner_usernames = get_accessible_owner_usernames(username)
+    cursor_values = decode_page_cursor(before or after, (str, str, int))
+    backwards = bool(before) and cursor_values is not None
+    conn = get_db_connection()
+    if not conn:
+        return build_keyset_page([], limit, appointment_cursor_values, cursor_values, backwards)
+    try:
+        source = get_history_source(conn, "medical_appointments") if history else None
+        sql, params = build_accessible_appointments_query(
+            owner_usernames, keyword, keyset=cursor_values, backwards=backwards, limit=limit + 1, source=source
+        )
+        appointments = [dict(row) for row in conn.execute(sql, params).fetchall()]
+        page = build_keyset_page(appointments, limit, appointment_cursor_values, cursor_values, backwards)
+        decorate_appointments(page["items"], username)
+        return page
+    finally:
+        conn.close()
+
+def get_medication_reminder_lookup(medication_ids, conn=None):
+    """一次查詢多筆用藥的提醒時間，回傳 {medication_id: ["HH:MM", ...]}（依時間排序）。"""
+    lookup = {medication_id: [] for medication_id in medication_ids}
+    if not lookup:
+        return lookup
+    own_conn = conn is None
+    conn = conn or get_db_connection()
+    if not conn:
+        return lookup
+    try:
+        placeholders = ",".join(["?"] * len(lookup))
+        rows = conn.execute(
+            f"""SELECT medication_id, minute_of_day FROM medication_reminders
+                WHERE medication_id IN ({placeholders})
+                ORDER BY medication_id, minute_of_day""",
+            list(lookup)
+        ).fetchall()
+    finally:
+        if own_conn:
+            conn.close()
+    for row in rows:
+        lookup[row["medication_id"]].append(REMINDER_MINUTE_LABELS[row["minute_of_day"]])
+    return lookup
+
+def get_due_medication_reminders(minute_of_day, on_date=None):
+    """取得 on_date（預設今天）在 minute_of_day 該服用的啟用中用藥，走 idx_medication_reminders_minute。"""
+    on_date = on_date or datetime.now().strftime("%Y-%m-%d")
+    conn = get_db_connection()
+    if not conn:
         return []
-    values = []
-    for item in str(reminder_times).split(","):
-        cleaned = item.strip()
-        if not cleaned:
+    try:
+        rows = conn.execute(
+            """SELECT m.id, m.owner_username, m.profile_id, m.medication_name, m.dosage
+               FROM medication_reminders r
+               JOIN medications m ON m.id = r.medication_id
+               WHERE r.minute_of_day = ? AND m.status = 'active'
+                 AND m.start_date <= ? AND (m.end_date IS NULL OR m.end_date >= ?)
+               ORDER BY m.owner_username, m.id""",
+            (minute_of_day, on_date, on_date)
+        ).fetchall()
+        return [dict(row, reminder_time=REMINDER_MINUTE_LABELS[minute_of_day]) for row in rows]
+    finally:
+        conn.close()
+
+# === 用藥安全提醒 ===
+# 對照表放在 data/medication_safety.json（含版本號），啟動時載入一次，所有藥名編譯成單一 regex；
+# 同一個正規化藥名的比對結果以 lru_cache 保存，列表重複出現的藥品不需再比對。
+MEDICATION_SAFETY_FILE = os.getenv("MEDICATION_SAFETY_FILE") or os.path.join(basedir, "data", "medication_safety.json")
+MEDICATION_SAFETY_DEFAULT_HINT = "首次使用新藥、出現紅疹、呼吸喘或明顯不適時，應停止自行加量並儘快聯繫醫師或藥師。"
+INTERACTION_SEVERITY_ORDER = {"high": 0, "medium": 1, "low": 2}
+
+def normalize_medication_name(medication_name):
+    """全形轉半形、不分大小寫並合併空白，作為比對與快取的 key。"""
+    return " ".join(unicodedata.normalize("NFKC", medication_name or "").casefold().split())
+
+def load_medication_safety_rules(path=MEDICATION_SAFETY_FILE):
+    """讀取安全提醒對照表，編譯比對用的 regex 與交互作用配對索引；檔案不存在或格式錯誤時只使用通用提醒。"""
+    try:
+        with open(path, encoding="utf-8") as safety_file:
+            data = json.load(safety_file)
+    except (OSError, ValueError) as e:
+        print(f"[警告] 無法載入用藥安全資料 {path}: {e}")
+        return {"version": None, "hints": [], "ingredients": [], "name_index": {}, "pattern": None, "interactions": {}}
+    hints = []
+    ingredients = []
+    name_index = {}
+    for entry in data.get("entries", []):
+        hints.append(entry["hint"].strip())
+        ingredients.append((entry["id"],) + tuple(entry.get("classes", [])))
+        for name in entry.get("names", []):
+            name_index.setdefault(normalize_medication_name(name), len(hints) - 1)
+    # 以前瞻包住整個 alternation，藥名彼此重疊（例如同時含兩個成分）時每個起點都會被比對到
+    names = sorted(name_index, key=len, reverse=True)
+    pattern = re.compile("(?=(" + "|".join(re.escape(name) for name in names) + "))") if names else None
+    # 交互作用以排序後的成分配對為 key，檢查時只需查表
+    interactions = {
+        tuple(sorted(rule["ingredients"])): {"severity": rule.get("severity", "medium"), "hint": rule["hint"].strip()}
+        for rule in data.get("interactions", [])
+    }
+    print(f"[成功] 已載入用藥安全資料 v{data.get('version')}（{len(hints)} 項、{len(name_index)} 個藥名、{len(interactions)} 組交互作用）")
+    return {
+        "version": data.get("version"),
+        "hints": hints,
+        "ingredients": ingredients,
+        "name_index": name_index,
+        "pattern": pattern,
+        "interactions": interactions,
+    }
+
+MEDICATION_SAFETY_RULES = load_medication_safety_rules()
+
+@lru_cache(maxsize=4096)
+def match_medication_safety_entries(normalized_name):
+    """回傳藥名命中的對照表項目索引（依對照表順序、不重複）。"""
+    rules = MEDICATION_SAFETY_RULES
+    if not normalized_name or not rules["pattern"]:
+        return ()
+    return tuple(sorted({rules["name_index"][match.group(1)] for match in rules["pattern"].finditer(normalized_name)}))
+
+def get_medication_ingredients(medication_name, include_classes=True):
+    """藥名對應的成分與類別 id（例如 Augmentin → amoxicillin、antibiotic）；include_classes=False 時只回傳成分 id。"""
+    ingredients = MEDICATION_SAFETY_RULES["ingredients"]
+    entries = match_medication_safety_entries(normalize_medication_name(medication_name))
+    return sorted({
+        ingredient
+        for index in entries
+        for ingredient in (ingredients[index] if include_classes else ingredients[index][:1])
+    })
+
+def get_medication_safety_info(medication_name, precautions=""):
+    hints = [MEDICATION_SAFETY_RULES["hints"][index] for index in match_medication_safety_entries(normalize_medication_name(medication_name))]
+    if precautions:
+        hints.append(f"個別注意事項：{precautions}")
+    if not hints:
+        hints.append(MEDICATION_SAFETY_DEFAULT_HINT)
+    return hints[:3]
+
+@lru_cache(maxsize=4096)
+def check_ingredient_interactions(fingerprint, entry_fingerprint):
+    """回傳 [(成分 a, 成分 b, 規則)]，a == b（規則為 None）代表重複用藥。
+
+    fingerprint 為一個人所有啟用中用藥的成分與類別 id（排序、不同用藥可重複），用來比對交互作用規則；
+    entry_fingerprint 只含成分 id，用來判斷重複用藥，同類別（例如兩種抗生素）不算重複。
+    """
+    interactions = MEDICATION_SAFETY_RULES["interactions"]
+    counts = {}
+    for ingredient in entry_fingerprint:
+        counts[ingredient] = counts.get(ingredient, 0) + 1
+    found = [(ingredient, ingredient, None) for ingredient, count in counts.items() if count > 1]
+    found += [(a, b, interactions[(a, b)]) for a, b in itertools.combinations(sorted(set(fingerprint)), 2) if (a, b) in interactions]
+    return tuple(found)
+
+def get_regimen_interactions(medications):
+    """依 (帳號, 照護對象) 分組檢查啟用中用藥之間的交互作用與重複成分，回傳依嚴重程度排序的警示清單。
+
+    medications 需包含 id、owner_username、profile_id、medication_name；同一組成分只會實際比對一次（lru_cache）。
+    """
+    regimens = {}
+    for med in medications:
+        if med.get("status", "active") != "active":
             continue
-        try:
-            values.append(datetime.strptime(cleaned, "%H:%M").strftime("%H:%M"))
-        except ValueError:
+        regimens.setdefault((med["owner_username"], med.get("profile_id")), []).append(med)
+    warnings = []
+    for (owner_username, profile_id), regimen in regimens.items():
+        if len(regimen) < 2:
             continue
-    return sorted(set(values))
+        by_ingredient = {}
+        by_entry = {}
+        for med in regimen:
+            for ingredient in get_medication_ingredients(med["medication_name"]):
+                by_ingredient.setdefault(ingredient, []).append(med)
+            for ingredient in get_medication_ingredients(med["medication_name"], include_classes=False):
+                by_entry.setdefault(ingredient, []).append(med)
+        fingerprint = tuple(sorted(ingredient for ingredient, meds in by_ingredient.items() for _med in meds))
+        entry_fingerprint = tuple(sorted(ingredient for ingredient, meds in by_entry.items() for _med in meds))
+        seen = set()
+        for a, b, rule in check_ingredient_interactions(fingerprint, entry_fingerprint):
+            source = by_ingredient if rule else by_entry
+            involved = {med["id"]: med for med in source[a] + source[b]}
+            # 同一個複方藥品本身含有的兩種成分不算交互作用；同一組用藥只提示一次
+            key = (frozenset(involved), rule["hint"] if rule else None)
+            if len(involved) < 2 or key in seen:
+                continue
+            seen.add(key)
+            warnings.append({
+                "owner_username": owner_username,
+                "profile_id": profile_id,
+                "target_label": regimen[0].get("target_label"),
+                "severity": rule["severity"] if rule else "medium",
+                "hint": rule["hint"] if rule else "這些用藥含有相同成分，請確認是否重複服用，避免超過建議劑量。",
+                "medication_ids": sorted(involved),
+                "medication_names": [involved[medication_id]["medication_name"] for medication_id in sorted(involved)],
+            })
+    warnings.sort(key=lambda warning: (INTERACTION_SEVERITY_ORDER.get(warning["severity"], 1), warning["owner_username"], str(warning["profile_id"] or "")))
+    return warnings
+
+def get_active_regimen_medications(owner_usernames, lang="zh"):
+    """取得帳號們所有啟用中用藥的精簡資料，供交互作用檢查與今日提醒（不受列表分頁與關鍵字影響）。"""
+    if not owner_usernames:
+        return []
+    placeholders = ",".join(["?"] * len(owner_usernames))
+    conn = get_db_connection()
+    if not conn:
+        return []
+    try:
+        rows = conn.execute(
+            f"""SELECT m.id, m.owner_username, m.profile_id, m.medication_name, m.dosage, m.frequency,
+                       m.start_date, m.end_date, m.status, cp.profile_name, cp.relationship
+                FROM medications m
+                LEFT JOIN care_profiles cp ON cp.id = m.profile_id
+                WHERE m.owner_username IN ({placeholders}) AND m.status = 'active'
+                ORDER BY m.owner_username, m.profile_id, m.id""",
+            list(owner_usernames)
+        ).fetchall()
+    finally:
+        conn.close()
+    medications = []
+    for row in rows:
+        med = dict(row)
+        med["target_label"] = (
+            build_target_label(med.get("profile_name"), med.get("relationship"), lang)
+            if med.get("profile_id")
+            else build_target_label(lang=lang)
+        )
+        medications.append(med)
+    return medications
+
+def build_interaction_notice(owner_username, profile_id, medication_id, lang="zh"):
+    """新增 / 編輯用藥後，若這筆用藥與同一人的其他用藥有交互作用，回傳附加在成功訊息後的提醒文字。"""
+    regimen = [
+        med for med in get_active_regimen_medications([owner_username], lang)
+        if med.get("profile_id") == profile_id
+    ]
+    notices = [
+        f"{' + '.join(warning['medication_names'])}：{warning['hint']}"
+        for warning in get_regimen_interactions(regimen)
+        if medication_id in warning["medication_ids"]
+    ]
+    if not notices:
+        return ""
+    # 提醒文字本身以句號結尾，中文直接串接
+    return (" Interaction warning: " if lang == "en" else "；注意：") + ("" if lang != "en" else " ").join(notices)
+
+def get_medication_with_access(medication_id, username):
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        row = conn.execute(
+            f"""SELECT m.*, cp.profile_name, cp.relationship
+                FROM medications m
+                LEFT JOIN care_profiles cp ON cp.id = m.profile_id
+                WHERE m.id = ? AND {build_owner_access_condition("m.owner_username")}""",
+            (medication_id, username, username)
+        ).fetchone()
+        if not row:
+            return None
+        medication = dict(row)
+        medication["owner_username"] = medication.get("owner_username") or medication.get("username")
+        medication["created_by_username"] = medication.get("created_by_username") or medication.get("username")
+        medication["reminder_list"] = get_medication_reminder_lookup([medication["id"]], conn)[medication["id"]]
+        medication["target_label"] = (
+            f"{medication.get('profile_name')}（{medication.get('relationship') or '家人'}）"
+            if medication.get("profile_id")
+            else "自己"
+        )
+        medication["safety_info"] = get_medication_safety_info(
+            medication.get("medication_name"), medication.get("precautions", "")
+        )
+        return medication
+    finally:
+        conn.close()
+
+def get_medication_log_lookup(medication_ids, log_date):
+    if not medication_ids:
+        return {}
+    placeholders = ",".join(["?"] * len(medication_ids))
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    try:
+        rows = conn.execute(
+            f"""SELECT medication_id, reminder_time, status, note, taken_at
+                FROM medication_logs
+                WHERE log_date = ? AND medication_id IN ({placeholders})""",
+            [log_date] + medication_ids
+        ).fetchall()
+        lookup = {}
+        for row in rows:
+            entry = dict(row)
+            lookup.setdefault(entry["medication_id"], {})[entry["reminder_time"]] = entry
+        return lookup
+    finally:
+        conn.close()
+
+def count_medication_active_days(med, start_date, end_date):
+    """用藥在 [start_date, end_date] 內應服藥的天數；已封存且未設結束日的用藥算到封存當天。"""
+    first = max(start_date, str(med.get("start_date") or start_date))
+    last = min(end_date, str(med.get("end_date") or end_date))
+    if med.get("status") != "active" and not med.get("end_date") and med.get("updated_at"):
+        last = min(last, str(med["updated_at"])[:10])
+    if first > last:
+        return 0
+    return (date.fromisoformat(last[:10]) - date.fromisoformat(first[:10])).days + 1
+
+def get_medication_adherence(medications, start_date, end_date):
+    """以 medication_adherence_daily 的主鍵範圍加總取得區間遵從度，回傳 {medication_id: 統計}。
+
+    沒有任何紀錄的日子不會有彙總列，應服次數以用藥期間天數乘上目前的提醒次數補上。
+    區間最晚算到昨天（get_adherence_end_date）。
+    """
+    if not medications:
+        return {}
+    end_date = min(end_date, get_adherence_end_date())
+    medication_ids = [med["id"] for med in medications]
+    placeholders = ",".join(["?"] * len(medication_ids))
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    try:
+        rows = conn.execute(
+            f"""SELECT medication_id, COUNT(*) AS days, SUM(scheduled) AS scheduled,
+                       SUM(taken) AS taken, SUM(skipped) AS skipped
+                FROM medication_adherence_daily
+                WHERE medication_id IN ({placeholders}) AND log_date BETWEEN ? AND ?
+                GROUP BY medication_id""",
+            medication_ids + [start_date, end_date]
+        ).fetchall()
+    finally:
+        conn.close()
+    totals = {row["medication_id"]: dict(row) for row in rows}
+    reminder_lookup = {med["id"]: med["reminder_list"] for med in medications if "reminder_list" in med}
+    if len(reminder_lookup) < len(medications):
+        reminder_lookup.update(get_medication_reminder_lookup([med["id"] for med in medications if med["id"] not in reminder_lookup]))
+    return {
+        med["id"]: summarize_medication_adherence(
+            med, totals.get(med["id"], {}), start_date, end_date, len(reminder_lookup[med["id"]])
+        )
+        for med in medications
+    }
+
+def summarize_medication_adherence(med, total, start_date, end_date, reminder_count):
+    """由彙總表的區間加總（days / scheduled / taken / skipped）算出遵從度，沒有彙總列的日子以提醒次數補上應服次數。"""
+    unlogged_days = max(count_medication_active_days(med, start_date, end_date) - (total.get("days") or 0), 0)
+    scheduled = int(total.get("scheduled") or 0) + unlogged_days * reminder_count
+    taken = int(total.get("taken") or 0)
+    return {
+        "scheduled": scheduled,
+        "taken": taken,
+        "skipped": int(total.get("skipped") or 0),
+        "ratio": round(taken / scheduled * 100) if scheduled else 0,
+    }
+
+def get_adherence_end_date():
+    """遵從度區間的結束日為昨天：今天的提醒多半還沒到時間，全部計入應服次數會讓一早的比例偏低。"""
+    return (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+def new_adherence_totals():
+    return {"scheduled": 0, "taken": 0, "skipped": 0, "ratio": 0}
+
+def add_adherence_totals(target, stats):
+    for key in ("scheduled", "taken", "skipped"):
+        target[key] += stats[key]
+    target["ratio"] = round(target["taken"] / target["scheduled"] * 100) if target["scheduled"] else 0
+    return target
+
+# === 遵從度分析（近 N 日） ===
+# 每個帳號每個區間的結果快取在 worker 內：{(帳號, 天數, 結束日): (遵從度版本號, 各用藥統計)}，
+# 記錄服藥或修改用藥計畫時遞增該帳號的 adherence_epoch，下一個請求就會重新計算。
+ADHERENCE_WINDOWS = tuple(int(value) for value in os.getenv("ADHERENCE_WINDOWS", "7,30,90").split(",") if value.strip())
+ADHERENCE_MAX_WINDOW_DAYS = int(os.getenv("ADHERENCE_MAX_WINDOW_DAYS", "365"))
+ADHERENCE_CACHE_SIZE = int(os.getenv("ADHERENCE_CACHE_SIZE", "1024"))
+_adherence_cache = {}
+_adherence_cache_lock = threading.Lock()
+
+def get_adherence_epochs(owner_usernames):
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    try:
+        placeholders = ",".join(["?"] * len(owner_usernames))
+        rows = conn.execute(
+            f"SELECT username, adherence_epoch FROM users WHERE username IN ({placeholders})", list(owner_usernames)
+        ).fetchall()
+        return {row["username"]: row["adherence_epoch"] for row in rows}
+    finally:
+        conn.close()
+
+def compute_adherence_windows(owner_usernames, windows, end_date):
+    """一次計算多個帳號、多個區間的遵從度，回傳 {(帳號, 天數): [用藥統計, ...]}。
+
+    只掃描一次最長區間內的 medication_adherence_daily，各區間以條件加總分開計算。
+    """
+    window_starts = {window: (date.fromisoformat(end_date) - timedelta(days=window - 1)).isoformat() for window in windows}
+    earliest = min(window_starts.values())
+    owner_placeholders = ",".join(["?"] * len(owner_usernames))
+    window_columns = ",\n".join(
+        f"""COUNT(CASE WHEN a.log_date >= ? THEN 1 END) AS days_{window},
+            SUM(CASE WHEN a.log_date >= ? THEN a.scheduled ELSE 0 END) AS scheduled_{window},
+            SUM(CASE WHEN a.log_date >= ? THEN a.taken ELSE 0 END) AS taken_{window},
+            SUM(CASE WHEN a.log_date >= ? THEN a.skipped ELSE 0 END) AS skipped_{window}"""
+        for window in windows
+    )
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("資料庫連線失敗")
+    try:
+        medications = [dict(row) for row in conn.execute(
+            f"""SELECT m.id, m.owner_username, m.profile_id, m.medication_name, m.dosage, m.start_date, m.end_date,
+                       m.status, m.updated_at, cp.profile_name, cp.relationship
+                FROM medications m
+                LEFT JOIN care_profiles cp ON cp.id = m.profile_id
+                WHERE m.owner_username IN ({owner_placeholders}) AND m.start_date <= ?
+                  AND (m.end_date IS NULL OR m.end_date >= ?)
+                ORDER BY m.owner_username, m.medication_name, m.id""",
+            list(owner_usernames) + [end_date, earliest]
+        ).fetchall()]
+        if not medications:
+            return {(owner_username, window): [] for owner_username in owner_usernames for window in windows}
+        rows = conn.execute(
+            f"""SELECT a.medication_id, {window_columns}
+                FROM medication_adherence_daily a
+                JOIN medications m ON m.id = a.medication_id
+                WHERE m.owner_username IN ({owner_placeholders}) AND a.log_date BETWEEN ? AND ?
+                GROUP BY a.medication_id""",
+            [window_starts[window] for window in windows for _ in range(4)] + list(owner_usernames) + [earliest, end_date]
+        ).fetchall()
+        reminder_lookup = get_medication_reminder_lookup([med["id"] for med in medications], conn)
+    finally:
+        conn.close()
+    totals = {row["medication_id"]: dict(row) for row in rows}
+    results = {(owner_username, window): [] for owner_username in owner_usernames for window in windows}
+    for med in medications:
+        total = totals.get(med["id"], {})
+        for window in windows:
+            window_total = {key: total.get(f"{key}_{window}") for key in ("days", "scheduled", "taken", "skipped")}
+            stats = summarize_medication_adherence(
+                med, window_total, window_starts[window], end_date, len(reminder_lookup[med["id"]])
+            )
+            results[(med["owner_username"], window)].append({"medication": med, **stats})
+    return results
+
+def get_owner_adherence_windows(owner_usernames, windows, end_date):
+    """依帳號的遵從度版本號取用快取，只重新計算過期或未快取的（帳號, 區間）。"""
+    epochs = get_adherence_epochs(owner_usernames)
+    results = {}
+    missing_owners, missing_windows = set(), set()
+    with _adherence_cache_lock:
+        for owner_username in owner_usernames:
+            for window in windows:
+                cached = _adherence_cache.get((owner_username, window, end_date))
+                if cached and owner_username in epochs and cached[0] == epochs[owner_username]:
+                    results[(owner_username, window)] = cached[1]
+                else:
+                    missing_owners.add(owner_username)
+                    missing_windows.add(window)
+    if missing_owners:
+        computed = compute_adherence_windows(sorted(missing_owners), sorted(missing_windows), end_date)
+        with _adherence_cache_lock:
+            for key, value in computed.items():
+                results.setdefault(key, value)
+                if key[0] in epochs and ADHERENCE_CACHE_SIZE > 0:
+                    if len(_adherence_cache) >= ADHERENCE_CACHE_SIZE:
+                        _adherence_cache.pop(next(iter(_adherence_cache)))
+                    cache_key = (key[0], key[1], end_date)
+                    _adherence_cache.pop(cache_key, None)
+                    _adherence_cache[cache_key] = (epochs[key[0]], value)
+    return results
+
+def get_adherence_analytics(username, windows, owner_username=None, lang="zh"):
+    """近 N 日遵從度（到昨天為止的 N 個完整日）：依用藥、照護對象（含本人）與帳號分別加總。"""
+    end_date = get_adherence_end_date()
+    owner_usernames = get_accessible_owner_usernames(username)
+    if owner_username:
+        owner_usernames = [owner_username] if owner_username in owner_usernames else []
+    results = get_owner_adherence_windows(owner_usernames, windows, end_date) if owner_usernames else {}
+    medications, profiles, owners = {}, {}, {}
+    for owner_name in owner_usernames:
+        owners[owner_name] = {"owner_username": owner_name, "windows": {}}
+        for window in windows:
+            owner_totals = owners[owner_name]["windows"][str(window)] = new_adherence_totals()
+            for item in results.get((owner_name, window), []):
+                med = item["medication"]
+                stats = {key: item[key] for key in ("scheduled", "taken", "skipped", "ratio")}
+                target_label = (
+                    build_target_label(med.get("profile_name"), med.get("relationship"), lang)
+                    if med.get("profile_id") else build_target_label(lang=lang)
+                )
+                medication_entry = medications.setdefault(med["id"], {
+                    "id": med["id"],
+                    "medication_name": med["medication_name"],
+                    "dosage": med["dosage"],
+                    "status": med["status"],
+                    "owner_username": owner_name,
+                    "profile_id": med.get("profile_id"),
+                    "target_label": target_label,
+                    "windows": {},
+                })
+                medication_entry["windows"][str(window)] = stats
+                profile_entry = profiles.setdefault((owner_name, med.get("profile_id")), {
+                    "owner_username": owner_name,
+                    "profile_id": med.get("profile_id"),
+                    "target_label": target_label,
+                    "windows": {},
+                })
+                add_adherence_totals(profile_entry["windows"].setdefault(str(window), new_adherence_totals()), stats)
+                add_adherence_totals(owner_totals, stats)
+    return {
+        "end_date": end_date,
+        "windows": list(windows),
+        "owners": list(owners.values()),
+        "profiles": list(profiles.values()),
+        "medications": list(medications.values()),
+    }
+
+# === 用藥提醒派送 ===
+# python app.py dispatch-reminders 以獨立行程執行：heap 中每個用藥的每個提醒時間只有一筆「下一次檢查時間」，
+# 到期時批次確認 medication_logs，超過 REMINDER_GRACE_MINUTES 仍未記錄就送出 missed 事件給各個 sink。
+# 之後只透過 idx_medications_updated 讀取變動過的用藥，不會每分鐘掃描整張表。
+REMINDER_GRACE_MINUTES = int(os.getenv("REMINDER_GRACE_MINUTES", "30"))
+REMINDER_POLL_SECONDS = float(os.getenv("REMINDER_POLL_SECONDS", "30"))
+REMINDER_SINK_NAMES = [name.strip() for name in os.getenv("REMINDER_SINKS", "log,table").split(",") if name.strip()]
+REMINDER_LOG_FILE = os.getenv("REMINDER_LOG_FILE") or os.path.join(basedir, "reminder_events.log")
+REMINDER_WEBHOOK_URL = os.getenv("REMINDER_WEBHOOK_URL", "")
+REMINDER_WEBHOOK_TIMEOUT = float(os.getenv("REMINDER_WEBHOOK_TIMEOUT", "5"))
+REMINDER_QUERY_CHUNK = 500
+
+def write_reminder_events_log(events):
+    """log sink：每個事件一行 JSON 附加到 REMINDER_LOG_FILE。"""
+    with open(REMINDER_LOG_FILE, "a", encoding="utf-8") as log_file:
+        for event in events:
+            log_file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+def save_reminder_events(events):
+    """table sink：寫入 medication_reminder_events，同一次提醒重複送出時不會新增第二筆。"""
+    upsert_sql = build_upsert_sql(
+        "medication_reminder_events",
+        ("medication_id", "owner_username", "log_date", "reminder_time", "event_type"),
+        ("medication_id", "log_date", "reminder_time"),
+        {"event_type": None},
+    )
+    rows = [
+        (event["medication_id"], event["owner_username"], event["log_date"], event["reminder_time"], event["event"])
+        for event in events
+    ]
+    run_db_write(lambda conn: conn.executemany(upsert_sql, rows))
+
+def post_reminder_webhook(events):
+    """webhook sink：以 JSON POST 到 REMINDER_WEBHOOK_URL（未設定時略過）。"""
+    if not REMINDER_WEBHOOK_URL:
+        return
+    body = json.dumps({"events": events}, ensure_ascii=False).encode("utf-8")
+    request_obj = Request(REMINDER_WEBHOOK_URL, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    with urlopen(request_obj, timeout=REMINDER_WEBHOOK_TIMEOUT) as response:
+        response.read()
+
+# 可用的 sink；REMINDER_SINKS 以逗號指定要啟用哪些
+REMINDER_SINKS = {
+    "log": write_reminder_events_log,
+    "table": save_reminder_events,
+    "webhook": post_reminder_webhook,
+}
+
+class ReminderDispatcher:
+    """用藥提醒派送。
+
+    heap 的元素為 (檢查時間, medication_id, minute_of_day, 版本號)。用藥變動時只重新載入該用藥並換一個版本號，
+    舊版本的元素留在 heap 中，取出時比對版本號後丟棄，不需要在 heap 中搜尋刪除。
+    事件交給背景的 sink 執行緒送出，webhook 等較慢的 sink 不會拖住派送迴圈。
+    """
+
+    def __init__(self, sinks=None, grace_minutes=REMINDER_GRACE_MINUTES):
+        self.sinks = {name: REMINDER_SINKS[name] for name in (REMINDER_SINK_NAMES if sinks is None else sinks)}
+        self.grace = timedelta(minutes=grace_minutes)
+        self.heap = []
+        self.plans = {}
+        self.seen = {}
+        self.versions = itertools.count(1)
+        self.changed_since = None
+        self.outbox = None
+        self.stats = {"plans": 0, "reloads": 0, "checked": 0, "events": 0, "sink_errors": 0}
+
+    def load(self, now=None):
+        """啟動時載入所有啟用中的用藥；之後改由 poll_changes 增量更新。"""
+        now = now or datetime.now()
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError("資料庫連線失敗")
+        try:
+            self.changed_since = conn.execute("SELECT MAX(updated_at) AS latest FROM medications").fetchone()["latest"]
+            medications = conn.execute(
+                """SELECT id, owner_username, medication_name, dosage, start_date, end_date, status, updated_at
+                   FROM medications WHERE status = 'active'"""
+            ).fetchall()
+            reminders = conn.execute(
+                """SELECT r.medication_id, r.minute_of_day
+                   FROM medication_reminders r
+                   JOIN medications m ON m.id = r.medication_id
+                   WHERE m.status = 'active'
+                   ORDER BY r.medication_id, r.minute_of_day"""
+            ).fetchall()
+        finally:
+            conn.close()
+        minutes = {}
+        for row in reminders:
+            minutes.setdefault(row["medication_id"], []).append(row["minute_of_day"])
+        self.heap = []
+        self.plans = {}
+        self.seen = {}
+        for row in medications:
+            self._set_plan(dict(row), minutes.get(row["id"], []), now)
+        heapq.heapify(self.heap)
+
+    def poll_changes(self, now=None):
+        """重新讀取 updated_at 不早於上次檢查點的用藥，內容真的有變動的才重新排程，回傳重新載入的筆數。
+
+        CURRENT_TIMESTAMP 只到秒，同一秒內的第二次修改 updated_at 不變，因此不能只比對 updated_at：
+        以 >= 讀出上次檢查點那一秒之後的用藥，再與排程時記下的內容（含提醒時間）比對。
+        """
+        now = now or datetime.now()
+        conn = get_db_connection()
+        if not conn:
+            return 0
+        reloaded = 0
+        try:
+            candidate_ids = [
+                row["id"] for row in conn.execute(
+                    "SELECT id, updated_at FROM medications WHERE updated_at >= ?", (self.changed_since or "",)
+                ).fetchall()
+            ]
+            for offset in range(0, len(candidate_ids), REMINDER_QUERY_CHUNK):
+                chunk = candidate_ids[offset:offset + REMINDER_QUERY_CHUNK]
+                placeholders = ",".join(["?"] * len(chunk))
+                medications = conn.execute(
+                    f"""SELECT id, owner_username, medication_name, dosage, start_date, end_date, status, updated_at
+                        FROM medications WHERE id IN ({placeholders})""",
+                    chunk
+                ).fetchall()
+                minutes = {medication_id: [] for medication_id in chunk}
+                for row in conn.execute(
+                    f"SELECT medication_id, minute_of_day FROM medication_reminders WHERE medication_id IN ({placeholders})",
+                    chunk
+                ).fetchall():
+                    minutes[row["medication_id"]].append(row["minute_of_day"])
+                for row in medications:
+                    medication = dict(row)
+                    medication_minutes = sorted(minutes[row["id"]])
+                    if self.seen.get(row["id"]) == self._plan_token(medication, medication_minutes):
+                        continue
+                    self._set_plan(medication, medication_minutes, now, push=heapq.heappush)
+                    reloaded += 1
+                if medications:
+                    self.changed_since = max([self.changed_since or ""] + [str(row["updated_at"]) for row in medications])
+        finally:
+            conn.close()
+        self.stats["reloads"] += reloaded
+        return reloaded
+
+    @staticmethod
+    def _plan_token(medication, minutes):
+        """排程內容的比對值：影響提醒的欄位與提醒時間，任何一項不同就需要重新排程。"""
+        return (
+            medication["updated_at"], medication["status"], str(medication["start_date"]), str(medication.get("end_date")),
+            medication["owner_username"], medication["medication_name"], medication["dosage"], tuple(minutes),
+        )
+
+    def _set_plan(self, medication, minutes, now, push=list.append):
+        self.seen[medication["id"]] = self._plan_token(medication, minutes)
+        self.plans.pop(medication["id"], None)
+        if medication["status"] != "active" or not minutes:
+            self.stats["plans"] = len(self.plans)
+            return
+        plan = {
+            **medication,
+            "version": next(self.versions),
+            "start_date": date.fromisoformat(str(medication["start_date"])[:10]),
+            "end_date": date.fromisoformat(str(medication["end_date"])[:10]) if medication.get("end_date") else None,
+        }
+        self.plans[medication["id"]] = plan
+        self.stats["plans"] = len(self.plans)
+        for minute in minutes:
+            self._push_next(plan, minute, now, push)
+
+    def _push_next(self, plan, minute, not_before, push=heapq.heappush):
+        """排入 not_before 之後第一次的檢查時間（提醒時間 + 寬限時間）；超過結束日就不再排入。"""
+        day = max((not_before - self.grace).date(), plan["start_date"])
+        check_at = datetime.combine(day, datetime.min.time()) + timedelta(minutes=minute) + self.grace
+        if check_at < not_before:
+            check_at += timedelta(days=1)
+        if plan["end_date"] and (check_at - self.grace).date() > plan["end_date"]:
+            return
+        push(self.heap, (check_at, plan["id"], minute, plan["version"]))
+
+    def dispatch_due(self, now=None):
+        """取出所有已到檢查時間的提醒，沒有服藥紀錄的送出 missed 事件，回傳事件清單。"""
+        now = now or datetime.now()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            check_at, medication_id, minute, version = heapq.heappop(self.heap)
+            plan = self.plans.get(medication_id)
+            if not plan or plan["version"] != version:
+                continue
+            due.append((plan, (check_at - self.grace).date().isoformat(), REMINDER_MINUTE_LABELS[minute]))
+            self._push_next(plan, minute, check_at + timedelta(seconds=1))
+        if not due:
+            return []
+        self.stats["checked"] += len(due)
+        logged = self._load_logged_doses(due)
+        events = [
+            {
+                "event": "missed",
+                "medication_id": plan["id"],
+                "owner_username": plan["owner_username"],
+                "medication_name": plan["medication_name"],
+                "dosage": plan["dosage"],
+                "log_date": log_date,
+                "reminder_time": reminder_time,
+            }
+            for plan, log_date, reminder_time in due
+            if (plan["id"], log_date, reminder_time) not in logged
+        ]
+        if events:
+            self.emit(events)
+        return events
+
+    def _load_logged_doses(self, due):
+        conn = get_db_connection()
+        if not conn:
+            return set()
+        try:
+            log_dates = sorted({log_date for _plan, log_date, _time in due})
+            medication_ids = sorted({plan["id"] for plan, _date, _time in due})
+            logged = set()
+            for offset in range(0, len(medication_ids), REMINDER_QUERY_CHUNK):
+                chunk = medication_ids[offset:offset + REMINDER_QUERY_CHUNK]
+                rows = conn.execute(
+                    f"""SELECT medication_id, log_date, reminder_time FROM medication_logs
+                        WHERE medication_id IN ({",".join(["?"] * len(chunk))})
+                          AND log_date IN ({",".join(["?"] * len(log_dates))})""",
+                    chunk + log_dates
+                ).fetchall()
+                logged.update((row["medication_id"], str(row["log_date"]), row["reminder_time"]) for row in rows)
+            return logged
+        finally:
+            conn.close()
+
+    def emit(self, events):
+        """把事件交給 sink 執行緒；第一次呼叫時才啟動執行緒。"""
+        self.stats["events"] += len(events)
+        if self.outbox is None:
+            self.outbox = queue.Queue()
+            threading.Thread(target=self._drain_outbox, name="reminder-sinks", daemon=True).start()
+        self.outbox.put(events)
+
+    def _drain_outbox(self):
+        while True:
+            events = self.outbox.get()
+            try:
+                self.send(events)
+            finally:
+                self.outbox.task_done()
+
+    def send(self, events):
+        for name, sink in self.sinks.items():
+            try:
+                sink(events)
+            except Exception as e:
+                self.stats["sink_errors"] += 1
+                print(f"[警告] 提醒事件送出失敗（{name}）: {e}")
+
+    def flush(self):
+        """等待已交出的事件全部送完（--once 結束前使用）。"""
+        if self.outbox is not None:
+            self.outbox.join()
+
+    def run_once(self, now=None):
+        self.poll_changes(now)
+        return self.dispatch_due(now)
+
+    def seconds_until_next(self, now=None):
+        now = now or datetime.now()
+        if not self.heap:
+            return REMINDER_POLL_SECONDS
+        return min(max((self.heap[0][0] - now).total_seconds(), 0), REMINDER_POLL_SECONDS)
+
+def run_dispatch_reminders_command():
+    """命令列指令：python app.py dispatch-reminders [--once]（請只啟動一個行程）"""
+    parser = argparse.ArgumentParser(prog="app.py dispatch-reminders", description="檢查逾時未服藥的提醒並送出事件")
+    parser.add_argument("--once", action="store_true", help="只檢查一次目前已到期的提醒後結束")
+    args = parser.parse_args(sys.argv[2:])
+    dispatcher = ReminderDispatcher()
+    dispatcher.load()
+    print(f"[提醒派送] 已載入 {dispatcher.stats['plans']} 個用藥計畫，sink：{', '.join(dispatcher.sinks) or '無'}")
+    while True:
+        events = dispatcher.run_once()
+        if events:
+            print(f"[提醒派送] 送出 {len(events)} 筆逾時未服藥事件")
+        if args.once:
+            dispatcher.flush()
+            return
+        time.sleep(dispatcher.seconds_until_next())
+
+def build_accessible_medications_query(owner_usernames, keyword="", status_rank=None, keyset=None, backwards=False, limit=None):
+    """用藥列表 SQL：啟用中優先，排序與 idx_medications_owner_status_start 一致。
+
+    指定 status_rank（0 = 啟用中，1 = 其他）時只查該段，keyset 為該段內邊界的 (start_date, id)，
+    如此每一段都能在索引上直接定位，不必從頭掃描。
+    """
+    placeholders = ",".join(["?"] * len(owner_usernames))
+    like = DB_DIALECT["like"]
+    if keyword and len(keyword) >= FTS_MIN_KEYWORD_LENGTH and DB_DIALECT["fulltext"]:
+        sql = f"""
+            SELECT m.*, cp.profile_name, cp.relationship
+            FROM medications_fts
+            CROSS JOIN medications m ON m.id = medications_fts.rowid
+            LEFT JOIN care_profiles cp ON cp.id = m.profile_id
+            WHERE medications_fts MATCH ? AND m.owner_username IN ({placeholders})
+        """
+        params = [build_fts_match(keyword)] + list(owner_usernames)
+    else:
+        sql = f"""
+            SELECT m.*, cp.profile_name, cp.relationship
+            FROM medications m
+            LEFT JOIN care_profiles cp ON cp.id = m.profile_id
+            WHERE m.owner_username IN ({placeholders})
+        """
+        params = list(owner_usernames)
+        if keyword:
+            sql += f"""
+                AND (
+                    m.medication_name {like} ? OR
+                    m.dosage {like} ? OR
+                    m.frequency {like} ?
+                )
+            """
+            params.extend([f"%{keyword}%", f"%{keyword}%", f"%{keyword}%"])
+    direction = "ASC" if backwards else "DESC"
+    if status_rank is None:
+        sql += f" ORDER BY {MEDICATION_STATUS_RANK_SQL.format(alias='m.')}, m.start_date DESC, m.id DESC"
+    else:
+        sql += f" AND ({MEDICATION_STATUS_RANK_SQL.format(alias='m.')}) = ?"
+        params.append(status_rank)
+        if keyset:
+            operator = ">" if backwards else "<"
+            sql += f" AND (m.start_date, m.id) {operator} (?, ?)"
+            params.extend(keyset)
+        sql += f" ORDER BY m.start_date {direction}, m.id {direction}"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+def load_today_medication_status(medications):
+    """載入提醒時間與今日服藥紀錄；今日提醒只需要這兩項，不必完整執行 decorate_medications。"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    medication_ids = [med["id"] for med in medications]
+    log_lookup = get_medication_log_lookup(medication_ids, today)
+    reminder_lookup = get_medication_reminder_lookup(medication_ids)
+    for med in medications:
+        med["reminder_list"] = reminder_lookup[med["id"]]
+        med["today_logs"] = log_lookup.get(med["id"], {})
+    return medications
+
+def decorate_medications(medications):
+    load_today_medication_status(medications)
+    # 近 7 日為昨天往前的 7 個完整日
+    week_start = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+    week_adherence = get_medication_adherence(medications, week_start, get_adherence_end_date())
+    for med in medications:
+        med["owner_username"] = med.get("owner_username") or med.get("username")
+        med["created_by_username"] = med.get("created_by_username") or med.get("username")
+        med["target_label"] = (
+            f"{med.get('profile_name')}（{med.get('relationship') or '家人'}）"
+            if med.get("profile_id")
+            else "自己"
+        )
+        med["today_taken_count"] = sum(1 for entry in med["today_logs"].values() if entry["status"] == "taken")
+        med["daily_total"] = len(med["reminder_list"])
+        med["adherence_ratio"] = (
+            round((med["today_taken_count"] / med["daily_total"]) * 100)
+            if med["daily_total"] else 0
+        )
+        med["week_adherence_ratio"] = week_adherence.get(med["id"], {}).get("ratio", 0)
+        med["safety_info"] = get_medication_safety_info(med.get("medication_name"), med.get("precautions", ""))
+    return medications
 
-def get_medication_safety_info(medication_name, precautions=""):
-    name = (medication_name or "").lower()
-    hints = []
-    safety_map = {
-        "metformin": "服用後若持續噁心、嘔吐或食慾下降，請盡快回診評估。",
-        "insulin": "注射胰島素後請留意低血糖，若冒冷汗、手抖或頭暈應立即補充糖分。",
-        "warfarin": "服用抗凝血藥期間若有不明瘀青、血尿或黑便，應儘速就醫。",
-        "aspirin": "阿斯匹靈與其他止痛消炎藥併用前請先詢問醫師，避免增加出血風險。",
-        "ibuprofen": "止痛消炎藥建議飯後服用，若胃痛或黑便請停止使用並就醫。",
-        "acetaminophen": "含普拿疼成分藥物避免重複服用，以免增加肝臟負擔。",
-        "amoxicillin": "抗生素請依療程完成，勿自行提前停藥。",
-        "antibiotic": "抗生素請依醫囑完成療程，不要因症狀改善就自行停藥。",
-        "steroid": "類固醇藥物通常不建議自行突然停用，需依醫囑調整。",
-        "prednisone": "類固醇通常不建議自行突然停用，若需停藥請先與醫師討論。",
-        "atorvastatin": "降血脂藥若合併明顯肌肉痠痛或尿色變深，請盡快就醫。",
-        "amlodipine": "降血壓藥可能造成頭暈，初期起身動作請放慢。 ",
-    }
-    for keyword, hint in safety_map.items():
-        if keyword in name:
-            hints.append(hint.strip())
-    if precautions:
-        hints.append(f"個別注意事項：{precautions}")
-    if not hints:
-        hints.append("首次使用新藥、出現紅疹、呼吸喘或明顯不適時，應停止自行加量並儘快聯繫醫師或藥師。")
-    return hints[:3]
+def medication_matches_keyword(med, keyword):
+    """在已載入的用藥上套用與列表相同的關鍵字條件（藥名、劑量、頻率，不分大小寫的部分比對）。"""
+    keyword = keyword.casefold()
+    return not keyword or any(keyword in str(med.get(column) or "").casefold() for column in MEDICATION_SEARCH_COLUMNS)
 
-def get_medication_with_access(medication_id, username):
+def medication_cursor_values(med):
+    return [0 if med.get("status") == "active" else 1, med["start_date"], med["id"]]
+
+def get_medication_page(username, keyword="", after=None, before=None, limit=LIST_PAGE_SIZE):
+    """以 keyset 分頁取得一頁用藥；依「啟用中 / 其他」兩段各自在索引上定位，最多查詢兩次。"""
     owner_usernames = get_accessible_owner_usernames(username)
-    placeholders = ",".join(["?"] * len(owner_usernames))
+    cursor_values = decode_page_cursor(before or after, (int, str, int))
+    if cursor_values and cursor_values[0] not in (0, 1):
+        cursor_values = None
+    backwards = bool(before) and cursor_values is not None
     conn = get_db_connection()
     if not conn:
-        return None
+        return build_keyset_page([], limit, medication_cursor_values, cursor_values, backwards)
     try:
-        row = conn.execute(
-            f"""SELECT m.*, cp.profile_name, cp.relationship
-                FROM medications m
-                LEFT JOIN care_profiles cp ON cp.id = m.profile_id
-                WHERE m.id = ? AND COALESCE(m.owner_username, m.username) IN ({placeholders})""",
-            [medication_id] + owner_usernames
-        ).fetchone()
-        if not row:
-            return None
-        medication = dict(row)
-        medication["owner_username"] = medication.get("owner_username") or medication.get("username")
-        medication["created_by_username"] = medication.get("created_by_username") or medication.get("username")
-        medication["reminder_list"] = parse_reminder_times(medication.get("reminder_times"))
-        medication["target_label"] = (
-            f"{medication.get('profile_name')}（{medication.get('relationship') or '家人'}）"
-            if medication.get("profile_id")
-            else "自己"
-        )
-        medication["safety_info"] = get_medication_safety_info(
-            medication.get("medication_name"), medication.get("precautions", "")
-        )
-        return medication
+        medications = []
+        for status_rank in ((1, 0) if backwards else (0, 1)):
+            if cursor_values and (status_rank > cursor_values[0] if backwards else status_rank < cursor_values[0]):
+                continue
+            keyset = cursor_values[1:] if cursor_values and status_rank == cursor_values[0] else None
+            sql, params = build_accessible_medications_query(
+                owner_usernames, keyword, status_rank=status_rank, keyset=keyset,
+                backwards=backwards, limit=limit + 1 - len(medications)
+            )
+            medications.extend(dict(row) for row in conn.execute(sql, params).fetchall())
+            if len(medications) > limit:
+                break
+        page = build_keyset_page(medications, limit, medication_cursor_values, cursor_values, backwards)
+        decorate_medications(page["items"])
+        return page
     finally:
         conn.close()
 
-def get_medication_log_lookup(medication_ids, log_date):
+# 排程狀態；行事曆以狀態碼（SCHEDULE_STATES 的索引）存放，"none" 表示該日不在用藥期間內
+SCHEDULE_STATES = ("none", "pending", "due", "taken", "skipped", "missed")
+SCHEDULE_STATE_CODES = {state: code for code, state in enumerate(SCHEDULE_STATES)}
+MEDICATION_CALENDAR_MAX_DAYS = int(os.getenv("MEDICATION_CALENDAR_MAX_DAYS", "92"))
+
+def get_medication_logs_in_range(medication_ids, start_date, end_date):
+    """一次取得區間內的服藥紀錄：{(medication_id, log_date, reminder_time): 紀錄}；超過封存期限時包含封存資料。"""
     if not medication_ids:
         return {}
     placeholders = ",".join(["?"] * len(medication_ids))
@@ -1189,86 +4602,71 @@ def get_medication_log_lookup(medication_ids, log_date):
     if not conn:
         return {}
     try:
+        archive_cutoff = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d")
+        source = get_history_source(conn, "medication_logs") if start_date < archive_cutoff else "medication_logs"
         rows = conn.execute(
-            f"""SELECT medication_id, reminder_time, status, note, taken_at
-                FROM medication_logs
-                WHERE log_date = ? AND medication_id IN ({placeholders})""",
-            [log_date] + medication_ids
+            f"""SELECT medication_id, log_date, reminder_time, status, note
+                FROM {source}
+                WHERE medication_id IN ({placeholders}) AND log_date BETWEEN ? AND ?""",
+            list(medication_ids) + [start_date, end_date]
         ).fetchall()
-        lookup = {}
-        for row in rows:
-            entry = dict(row)
-            lookup.setdefault(entry["medication_id"], {})[entry["reminder_time"]] = entry
-        return lookup
-    finally:
-        conn.close()
-
-def get_accessible_medications(username, keyword=""):
-    owner_usernames = get_accessible_owner_usernames(username)
-    placeholders = ",".join(["?"] * len(owner_usernames))
-    conn = get_db_connection()
-    if not conn:
-        return []
-    try:
-        sql = f"""
-            SELECT m.*, cp.profile_name, cp.relationship
-            FROM medications m
-            LEFT JOIN care_profiles cp ON cp.id = m.profile_id
-            WHERE COALESCE(m.owner_username, m.username) IN ({placeholders})
-        """
-        params = list(owner_usernames)
-        if keyword:
-            sql += """
-                AND (
-                    m.medication_name LIKE ? OR
-                    m.dosage LIKE ? OR
-                    m.frequency LIKE ?
-                )
-            """
-            params.extend([f"%{keyword}%", f"%{keyword}%", f"%{keyword}%"])
-        sql += " ORDER BY CASE WHEN m.status = 'active' THEN 0 ELSE 1 END, m.start_date DESC, m.id DESC"
-        medications = [dict(row) for row in conn.execute(sql, params).fetchall()]
-        today = datetime.now().strftime("%Y-%m-%d")
-        log_lookup = get_medication_log_lookup([med["id"] for med in medications], today)
-        for med in medications:
-            med["owner_username"] = med.get("owner_username") or med.get("username")
-            med["created_by_username"] = med.get("created_by_username") or med.get("username")
-            med["reminder_list"] = parse_reminder_times(med.get("reminder_times"))
-            med["target_label"] = (
-                f"{med.get('profile_name')}（{med.get('relationship') or '家人'}）"
-                if med.get("profile_id")
-                else "自己"
-            )
-            med["today_logs"] = log_lookup.get(med["id"], {})
-            med["today_taken_count"] = sum(1 for entry in med["today_logs"].values() if entry["status"] == "taken")
-            med["daily_total"] = len(med["reminder_list"])
-            med["adherence_ratio"] = (
-                round((med["today_taken_count"] / med["daily_total"]) * 100)
-                if med["daily_total"] else 0
-            )
-            med["safety_info"] = get_medication_safety_info(med.get("medication_name"), med.get("precautions", ""))
-        return medications
+        return {(row["medication_id"], str(row["log_date"]), row["reminder_time"]): dict(row) for row in rows}
     finally:
         conn.close()
 
-def build_today_medication_schedule(medications):
-    today = datetime.now().strftime("%Y-%m-%d")
-    now_text = datetime.now().strftime("%H:%M")
-    schedule = []
+def build_medication_schedule(medications, start_date, end_date, log_lookup, now=None):
+    """將啟用中的用藥展開到 [start_date, end_date]。
+
+    回傳 {"dates": [...], "items": [{"medication", "times", "states"}]}；states 為 array('B')，
+    第 day * len(times) + slot 個元素是該日該提醒時間的狀態碼。日期只在每個用藥轉換一次，不逐日比對字串。
+    """
+    now = now or datetime.now()
+    first_day = date.fromisoformat(start_date)
+    day_count = (date.fromisoformat(end_date) - first_day).days + 1
+    dates = [(first_day + timedelta(days=offset)).isoformat() for offset in range(day_count)]
+    today_index = (now.date() - first_day).days
+    now_text = now.strftime("%H:%M")
+    items = []
     for med in medications:
         if med.get("status") != "active":
             continue
-        end_date = med.get("end_date")
-        if end_date and end_date < today:
-            continue
-        start_date = med.get("start_date")
-        if start_date and start_date > today:
+        times = med["reminder_list"]
+        first_index = (date.fromisoformat(str(med["start_date"])[:10]) - first_day).days if med.get("start_date") else 0
+        last_index = (date.fromisoformat(str(med["end_date"])[:10]) - first_day).days if med.get("end_date") else day_count - 1
+        first_index, last_index = max(first_index, 0), min(last_index, day_count - 1)
+        if not times or first_index > last_index:
             continue
-        for reminder_time in med.get("reminder_list", []):
-            log_entry = med.get("today_logs", {}).get(reminder_time)
-            state = log_entry["status"] if log_entry else "pending"
-            if state == "pending" and reminder_time < now_text:
-                state = "due"
+        slot_count = len(times)
+        states = array("B", bytes(day_count * slot_count))
+        for day_index in range(first_index, last_index + 1):
+            log_date = dates[day_index]
+            for slot, reminder_time in enumerate(times):
+                log_entry = log_lookup.get((med["id"], log_date, reminder_time))
+                if log_entry:
+                    state = log_entry["status"]
+                elif day_index < today_index:
+                    state = "missed"
+                elif day_index == today_index and reminder_time < now_text:
+                    state = "due"
+                else:
+                    state = "pending"
+                states[day_index * slot_count + slot] = SCHEDULE_STATE_CODES.get(state, SCHEDULE_STATE_CODES["pending"])
+        items.append({"medication": med, "times": times, "states": states})
+    return {"dates": dates, "items": items}
+
+def build_today_medication_schedule(medications):
+    today = datetime.now().strftime("%Y-%m-%d")
+    # 今日紀錄已由 decorate_medications 載入，不需再查詢
+    log_lookup = {
+        (med["id"], today, reminder_time): log_entry
+        for med in medications
+        for reminder_time, log_entry in med.get("today_logs", {}).items()
+    }
+    schedule = []
+    for item in build_medication_schedule(medications, today, today, log_lookup)["items"]:
+        med = item["medication"]
+        for slot, reminder_time in enumerate(item["times"]):
+            log_entry = log_lookup.get((med["id"], today, reminder_time))
             schedule.append({
                 "medication_id": med["id"],
                 "medication_name": med["medication_name"],
@@ -1277,12 +4675,66 @@ def build_today_medication_schedule(medications):
                 "target_label": med["target_label"],
                 "owner_username": med["owner_username"],
                 "reminder_time": reminder_time,
-                "status": state,
+                "status": SCHEDULE_STATES[item["states"][slot]],
                 "note": log_entry.get("note", "") if log_entry else "",
             })
     schedule.sort(key=lambda item: (item["reminder_time"], item["medication_name"]))
     return schedule
 
+def get_medication_calendar(username, start_date, end_date, owner_username=None, lang="zh"):
+    """可代辦的啟用中用藥在日期區間內的行事曆：一次查用藥、一次查紀錄。"""
+    owner_usernames = get_accessible_owner_usernames(username)
+    if owner_username:
+        owner_usernames = [owner_username] if owner_username in owner_usernames else []
+    if not owner_usernames:
+        medications = []
+    else:
+        placeholders = ",".join(["?"] * len(owner_usernames))
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError("資料庫連線失敗")
+        try:
+            medications = [dict(row) for row in conn.execute(
+                f"""SELECT m.id, m.owner_username, m.profile_id, m.medication_name, m.dosage, m.frequency,
+                           m.start_date, m.end_date, m.status, cp.profile_name, cp.relationship
+                    FROM medications m
+                    LEFT JOIN care_profiles cp ON cp.id = m.profile_id
+                    WHERE m.owner_username IN ({placeholders}) AND m.status = 'active'
+                      AND m.start_date <= ? AND (m.end_date IS NULL OR m.end_date >= ?)
+                    ORDER BY m.owner_username, m.medication_name, m.id""",
+                owner_usernames + [end_date, start_date]
+            ).fetchall()]
+            reminder_lookup = get_medication_reminder_lookup([med["id"] for med in medications], conn)
+            for med in medications:
+                med["reminder_list"] = reminder_lookup[med["id"]]
+        finally:
+            conn.close()
+    log_lookup = get_medication_logs_in_range([med["id"] for med in medications], start_date, end_date)
+    schedule = build_medication_schedule(medications, start_date, end_date, log_lookup)
+    totals = [0] * len(SCHEDULE_STATES)
+    calendar_items = []
+    for item in schedule["items"]:
+        med = item["medication"]
+        for code in range(1, len(SCHEDULE_STATES)):
+            totals[code] += item["states"].count(code)
+        calendar_items.append({
+            "id": med["id"],
+            "medication_name": med["medication_name"],
+            "dosage": med["dosage"],
+            "owner_username": med["owner_username"],
+            "target_label": build_target_label(med.get("profile_name"), med.get("relationship"), lang) if med.get("profile_id") else build_target_label(lang=lang),
+            "times": item["times"],
+            "states": item["states"].tolist(),
+        })
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "dates": schedule["dates"],
+        "state_names": list(SCHEDULE_STATES),
+        "medications": calendar_items,
+        "summary": {state: totals[code] for code, state in enumerate(SCHEDULE_STATES) if code},
+    }
+
 MOOD_QUESTIONS = [
     ("emotion_score", "最近是否常感到低落、難過或想哭？"),
     ("anxiety_score", "最近是否常感到焦慮、緊張或不安？"),
@@ -1368,8 +4820,6 @@ def evaluate_mood_scores(scores, lang="zh"):
     }
 
 def get_mood_assessment_with_access(assessment_id, username, lang="zh"):
-    owner_usernames = get_accessible_owner_usernames(username)
-    placeholders = ",".join(["?"] * len(owner_usernames))
     conn = get_db_connection()
     if not conn:
         return None
@@ -1378,8 +4828,8 @@ def get_mood_assessment_with_access(assessment_id, username, lang="zh"):
             f"""SELECT ma.*, cp.profile_name, cp.relationship
                 FROM mood_assessments ma
                 LEFT JOIN care_profiles cp ON cp.id = ma.profile_id
-                WHERE ma.id = ? AND COALESCE(ma.owner_username, ma.username) IN ({placeholders})""",
-            [assessment_id] + owner_usernames
+                WHERE ma.id = ? AND {build_owner_access_condition("ma.owner_username")}""",
+            (assessment_id, username, username)
         ).fetchone()
         if not row:
             return None
@@ -1395,22 +4845,25 @@ def get_mood_assessment_with_access(assessment_id, username, lang="zh"):
     finally:
         conn.close()
 
+def build_accessible_mood_assessments_query(owner_usernames, limit=12):
+    """心情紀錄列表 SQL：依 idx_mood_assessments_owner_created 取最新幾筆。"""
+    placeholders = ",".join(["?"] * len(owner_usernames))
+    sql = f"""SELECT ma.*, cp.profile_name, cp.relationship
+              FROM mood_assessments ma
+              LEFT JOIN care_profiles cp ON cp.id = ma.profile_id
+              WHERE ma.owner_username IN ({placeholders})
+              ORDER BY ma.created_at DESC, ma.id DESC
+              LIMIT ?"""
+    return sql, list(owner_usernames) + [limit]
+
 def get_accessible_mood_assessments(username, limit=12, lang="zh"):
     owner_usernames = get_accessible_owner_usernames(username)
-    placeholders = ",".join(["?"] * len(owner_usernames))
     conn = get_db_connection()
     if not conn:
         return []
     try:
-        rows = conn.execute(
-            f"""SELECT ma.*, cp.profile_name, cp.relationship
-                FROM mood_assessments ma
-                LEFT JOIN care_profiles cp ON cp.id = ma.profile_id
-                WHERE COALESCE(ma.owner_username, ma.username) IN ({placeholders})
-                ORDER BY ma.created_at DESC, ma.id DESC
-                LIMIT ?""",
-            list(owner_usernames) + [limit]
-        ).fetchall()
+        sql, params = build_accessible_mood_assessments_query(owner_usernames, limit)
+        rows = conn.execute(sql, params).fetchall()
         assessments = [dict(row) for row in rows]
         for assessment in assessments:
             assessment["owner_username"] = assessment.get("owner_username") or assessment.get("username")
@@ -1424,6 +4877,122 @@ def get_accessible_mood_assessments(username, limit=12, lang="zh"):
     finally:
         conn.close()
 
+# 心情趨勢最多回傳的點數（?points= 不可超過上限）
+MOOD_TREND_DEFAULT_POINTS = 60
+MOOD_TREND_MAX_POINTS = int(os.getenv("MOOD_TREND_MAX_POINTS", "366"))
+
+def downsample_mood_buckets(buckets, points):
+    """相鄰的彙總列每 ceil(n / points) 個合併成一點；合併的是總和與筆數，平均值不會因此失真。"""
+    if len(buckets) <= points:
+        return [[bucket] for bucket in buckets]
+    group_size = -(-len(buckets) // points)
+    return [buckets[offset:offset + group_size] for offset in range(0, len(buckets), group_size)]
+
+def get_mood_trend(username, owner_username=None, profile_key=None, granularity="week", points=MOOD_TREND_DEFAULT_POINTS,
+                   start_date=None, end_date=None):
+    """心情趨勢：讀取 mood_trend_buckets 並降採樣到最多 points 點，回傳各點的評估筆數、總分與各面向平均。
+
+    owner_username 未指定時為本人；profile_key 為 None 時合併該帳號所有對象，0 代表帳號本人。
+    """
+    owner_username = owner_username or username
+    if owner_username not in get_accessible_owner_usernames(username):
+        return None
+    sql = f"""SELECT bucket_start, SUM(entry_count) AS entry_count,
+                     {", ".join(f"SUM({column}_sum) AS {column}_sum" for column in MOOD_TREND_SCORE_COLUMNS)}
+              FROM mood_trend_buckets
+              WHERE owner_username = ? AND granularity = ?"""
+    params = [owner_username, granularity]
+    if profile_key is not None:
+        sql += " AND profile_key = ?"
+        params.append(profile_key)
+    if start_date:
+        sql += " AND bucket_start >= ?"
+        params.append(get_mood_bucket_starts(start_date)[granularity])
+    if end_date:
+        sql += " AND bucket_start <= ?"
+        params.append(end_date)
+    sql += " GROUP BY bucket_start HAVING SUM(entry_count) > 0 ORDER BY bucket_start"
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("資料庫連線失敗")
+    try:
+        buckets = [dict(row) for row in conn.execute(sql, params).fetchall()]
+    finally:
+        conn.close()
+    series = []
+    for group in downsample_mood_buckets(buckets, points):
+        entry_count = sum(bucket["entry_count"] for bucket in group)
+        averages = {
+            column: round(sum(bucket[f"{column}_sum"] for bucket in group) / entry_count, 2)
+            for column in MOOD_TREND_SCORE_COLUMNS
+        }
+        series.append({
+            "start": str(group[0]["bucket_start"]),
+            "end": str(group[-1]["bucket_start"]),
+            "count": entry_count,
+            "total_score": averages.pop("total_score"),
+            "risk_count": sum(bucket["meaninglessness_risk_sum"] + bucket["self_harm_risk_sum"] for bucket in group),
+            "dimensions": {column: value for column, value in averages.items() if not column.endswith("_risk")},
+        })
+    return {
+        "owner_username": owner_username,
+        "profile_key": profile_key,
+        "granularity": granularity,
+        "bucket_count": len(buckets),
+        "points": series,
+    }
+
+def check_list_query_plans(owner_username="admin"):
+    """以 EXPLAIN QUERY PLAN 確認列表查詢直接走複合索引，不需全表掃描或額外排序。"""
+    # (名稱, (sql, params), 預期出現在計畫中的索引, 是否允許排序)；關鍵字搜尋只排序命中的少數列
+    if DB_BACKEND != "sqlite":
+        print(f"[略過] 查詢計畫檢查使用 SQLite 的 EXPLAIN QUERY PLAN，目前後端為 {DB_BACKEND}")
+        return True
+    checks = [
+        ("appointment list", build_accessible_appointments_query([owner_username]), "idx_appointments_owner_date", False),
+        ("medication list", build_accessible_medications_query([owner_username]), "idx_medications_owner_status_start", False),
+        ("mood assessments", build_accessible_mood_assessments_query([owner_username]), "idx_mood_assessments_owner_created", False),
+        ("appointment next page",
+         build_accessible_appointments_query([owner_username], keyset=["2000-01-01", "09:00", 1], limit=LIST_PAGE_SIZE + 1),
+         "idx_appointments_owner_date", False),
+        ("medication next page",
+         build_accessible_medications_query([owner_username], status_rank=0, keyset=["2000-01-01", 1], limit=LIST_PAGE_SIZE + 1),
+         "idx_medications_owner_status_start", False),
+        ("appointment search", build_accessible_appointments_query([owner_username], "0912"), "medical_appointments_fts VIRTUAL TABLE", True),
+        ("medication search", build_accessible_medications_query([owner_username], "aspirin"), "medications_fts VIRTUAL TABLE", True),
+    ]
+    # 有家人連結的帳號以 owner_username IN (a, b, ...) 查詢：每個帳號各自在索引上定位（含游標邊界），
+    # 跨帳號的合併需要一次 TEMP B-TREE 排序；可存取的帳號數很少，這個排序是可接受的
+    owner_usernames = [owner_username, owner_username + "_linked"]
+    checks += [
+        ("appointment list (linked owners)",
+         build_accessible_appointments_query(owner_usernames, keyset=["2000-01-01", "09:00", 1], limit=LIST_PAGE_SIZE + 1),
+         "idx_appointments_owner_date (owner_username=? AND", True),
+        ("medication list (linked owners)",
+         build_accessible_medications_query(owner_usernames, status_rank=0, keyset=["2000-01-01", 1], limit=LIST_PAGE_SIZE + 1),
+         "idx_medications_owner_status_start (owner_username=? AND", True),
+        ("mood assessments (linked owners)", build_accessible_mood_assessments_query(owner_usernames),
+         "idx_mood_assessments_owner_created", True),
+    ]
+    conn = get_db_connection()
+    if not conn:
+        print("[錯誤] 資料庫連線失敗")
+        return False
+    all_passed = True
+    try:
+        for label, (sql, params), expected_index, sort_allowed in checks:
+            plan = [row["detail"] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+            uses_index = any(expected_index in detail for detail in plan)
+            needs_sort = any("TEMP B-TREE" in detail for detail in plan)
+            passed = uses_index and (sort_allowed or not needs_sort)
+            all_passed = all_passed and passed
+            print(f"[{'通過' if passed else '失敗'}] {label}: 預期索引 {expected_index}")
+            for detail in plan:
+                print(f"    {detail}")
+    finally:
+        conn.close()
+    return all_passed
+
 def mask_identity_id(identity_id):
     """遮碼身分證號，如 A123456789 -> A12***789"""
     if not identity_id or len(identity_id) < 6:
@@ -1443,23 +5012,20 @@ def index():
 
 @app.route("/appointment/cancel/<int:apt_id>")
 @login_required
+@db_writes_on_get
 def cancel_appointment(apt_id):
     lang = get_request_lang()
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for('appointment_list', error="Database connection failed", lang=lang))
+    apt = get_appointment_with_access(apt_id, session.get('user'))
+    if not apt:
+        return redirect(url_for('appointment_list', error="You do not have access to this appointment", lang=lang))
     try:
-        apt = get_appointment_with_access(apt_id, session.get('user'))
-        if not apt:
-            return redirect(url_for('appointment_list', error="You do not have access to this appointment", lang=lang))
-        conn.execute(
+        run_db_write(lambda conn: conn.execute(
             "UPDATE medical_appointments SET status = 'canceled', updated_at = CURRENT_TIMESTAMP WHERE id = ?",
             (apt_id,)
-        )
-        conn.commit()
-        return redirect(url_for('appointment_list', success="Appointment updated", lang=lang))
-    finally:
-        conn.close()
+        ))
+    except Exception as e:
+        return redirect(url_for('appointment_list', error=build_write_error_message(e, lang), lang=lang))
+    return redirect(url_for('appointment_list', success="Appointment updated", lang=lang))
 
 @app.route("/appointment/edit/<int:apt_id>", methods=["GET", "POST"])
 @login_required
@@ -1469,7 +5035,6 @@ def edit_appointment(apt_id):
     if not apt:
         return redirect(url_for('appointment_list', error="You do not have access to this appointment", lang=lang))
 
-    conn = get_db_connection()
     doctors_map = get_doctors_by_department()
     min_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
     manageable_people = get_manageable_people(session.get('user'), lang)
@@ -1479,7 +5044,6 @@ def edit_appointment(apt_id):
         form = request.form
         if not all([form.get("patient_name"), form.get("patient_phone"), form.get("department"),
                     form.get("doctor_name"), form.get("appointment_date"), form.get("appointment_time")]):
-            conn.close()
             form_data = dict(form)
             form_data["target_profile"] = form.get("target_profile", target_value)
             return render_template(
@@ -1495,10 +5059,10 @@ def edit_appointment(apt_id):
                 manageable_people=manageable_people
             )
 
-        try:
-            resolved_target = resolve_manageable_target(session.get('user'), form.get("target_profile"), lang)
-            if not resolved_target:
-                raise ValueError("Invalid booking target")
+        # 寫入工作可能在寫入執行緒執行，不能在裡面讀取 session
+        username = session.get('user')
+
+        def update_appointment(conn):
             conn.execute("""
                 UPDATE medical_appointments
                 SET username=?, owner_username=?, profile_id=?, created_by_username=?, patient_id=?, patient_name=?, patient_phone=?, department=?,
@@ -1508,7 +5072,7 @@ def edit_appointment(apt_id):
                 resolved_target["owner_username"],
                 resolved_target["owner_username"],
                 resolved_target.get("profile_id"),
-                session.get('user'),
+                username,
                 form.get("patient_id"),
                 form.get("patient_name"),
                 form.get("patient_phone"),
@@ -1519,8 +5083,12 @@ def edit_appointment(apt_id):
                 form.get("symptoms"),
                 apt_id
             ))
-            conn.commit()
-            return redirect(url_for('appointment_list', success="Appointment updated", lang=lang))
+
+        try:
+            resolved_target = resolve_manageable_target(session.get('user'), form.get("target_profile"), lang)
+            if not resolved_target:
+                raise ValueError("Invalid booking target")
+            run_db_write(update_appointment)
         except Exception as e:
             form_data = dict(form)
             form_data["target_profile"] = form.get("target_profile", target_value)
@@ -1530,16 +5098,14 @@ def edit_appointment(apt_id):
                 lang=lang,
                 min_date=min_date,
                 doctor_options=doctors_map,
-                error=f"Update failed: {e}",
+                error=f"Update failed: {e}" if isinstance(e, ValueError) else build_write_error_message(e, lang),
                 form_data=form_data,
                 edit_mode=True,
                 apt_id=apt_id,
                 manageable_people=manageable_people
             )
-        finally:
-            conn.close()
+        return redirect(url_for('appointment_list', success="Appointment updated", lang=lang))
 
-    conn.close()
     form_data = dict(apt)
     form_data["target_profile"] = target_value
     return render_template(
@@ -1566,6 +5132,7 @@ def login():
         user = get_user_by_username(username)
         if user and check_password_hash(user['password_hash'], password):
             session["user"] = username
+            session.pop("auth_cache", None)
             return redirect(url_for("index", lang=lang))
         msg = "Invalid username or password" if lang == "en" else "帳號或密碼錯誤"
     return render_template("login.html", message=msg, lang=lang)
@@ -1581,29 +5148,24 @@ def register():
         name = request.form.get("name", "").strip()
         phone = request.form.get("phone", "").strip()
         identity_id = request.form.get("identity_id", "").strip()
-        conn = get_db_connection()
-        if not conn:
-            msg = "Database connection failed" if lang == "en" else "資料庫連線失敗"
-        else:
-            try:
-                conn.execute(
-                    "INSERT INTO users (username, password_hash, name, phone, identity_id) VALUES (?, ?, ?, ?, ?)",
-                    (username, generate_password_hash(password), name, phone, identity_id)
-                )
-                conn.commit()
-                msg = "Registration successful. Please sign in." if lang == "en" else "註冊成功！請登入"
-            except Exception as e:
-                if 'UNIQUE' in str(e):
-                    msg = "Username already exists" if lang == "en" else "帳號已存在"
-                else:
-                    msg = f"Registration failed: {e}" if lang == "en" else f"註冊失敗：{e}"
-            finally:
-                conn.close()
+        password_hash = generate_password_hash(password)
+        try:
+            run_db_write(lambda conn: conn.execute(
+                "INSERT INTO users (username, password_hash, name, phone, identity_id) VALUES (?, ?, ?, ?, ?)",
+                (username, password_hash, name, phone, identity_id)
+            ))
+            msg = "Registration successful. Please sign in." if lang == "en" else "註冊成功！請登入"
+        except Exception as e:
+            if 'UNIQUE' in str(e):
+                msg = "Username already exists" if lang == "en" else "帳號已存在"
+            else:
+                msg = f"Registration failed: {e}" if lang == "en" else f"註冊失敗：{e}"
     return render_template("register.html", message=msg, lang=lang)
 
 @app.route("/logout")
 def logout():
     session.pop("user", None)
+    session.pop("auth_cache", None)
     return redirect(url_for("welcome", lang=get_request_lang()))
 
 @app.route("/profile", methods=["GET", "POST"])
@@ -1617,21 +5179,19 @@ def profile():
     if request.method == "POST":
         name = request.form.get("name", "").strip()
         phone = request.form.get("phone", "").strip()
-        conn = get_db_connection()
-        if conn:
-            try:
-                conn.execute(
-                    "UPDATE users SET name=?, phone=? WHERE username=?",
-                    (name, phone, username)
-                )
-                conn.commit()
-                success_msg = "Profile updated successfully" if lang == "en" else "基本資料已更新"
-            except Exception as e:
-                error_msg = f"Update failed: {e}" if lang == "en" else f"更新失敗：{e}"
-            finally:
-                conn.close()
-        else:
-            error_msg = "Database connection failed" if lang == "en" else "資料庫連線失敗"
+
+        def update_profile(conn):
+            conn.execute(
+                "UPDATE users SET name=?, phone=? WHERE username=?",
+                (name, phone, username)
+            )
+            bump_auth_epoch(conn, [username])
+
+        try:
+            run_db_write(update_profile)
+            success_msg = "Profile updated successfully" if lang == "en" else "基本資料已更新"
+        except Exception as e:
+            error_msg = build_write_error_message(e, lang)
 
     user = get_user_by_username(username) or {}
     masked_id = mask_identity_id(user.get('identity_id', ''))
@@ -1654,13 +5214,10 @@ def add_care_profile():
     lang = get_request_lang()
     username = session.get("user")
     form = request.form
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for("profile", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-    try:
-        profile_name = form.get("profile_name", "").strip()
-        if not profile_name:
-            return redirect(url_for("profile", error=("Please complete all required fields" if lang == "en" else "請完成所有必填欄位"), lang=lang))
+    profile_name = form.get("profile_name", "").strip()
+    if not profile_name:
+        return redirect(url_for("profile", error=("Please complete all required fields" if lang == "en" else "請完成所有必填欄位"), lang=lang))
+    def create_profile(conn):
         conn.execute(
             """INSERT INTO care_profiles (owner_username, profile_name, relationship, phone, identity_id, birth_date, notes)
                VALUES (?, ?, ?, ?, ?, ?, ?)""",
@@ -1674,20 +5231,21 @@ def add_care_profile():
                 form.get("notes", "").strip()
             )
         )
-        conn.commit()
-        return redirect(url_for("profile", success=("Care recipient added" if lang == "en" else "受照護對象已新增"), lang=lang))
-    finally:
-        conn.close()
+        bump_auth_epoch(conn, [username])
+
+    try:
+        run_db_write(create_profile)
+    except Exception as e:
+        return redirect(url_for("profile", error=build_write_error_message(e, lang), lang=lang))
+    return redirect(url_for("profile", success=("Care recipient added" if lang == "en" else "受照護對象已新增"), lang=lang))
 
 @app.route("/family/profile/delete/<int:profile_id>", methods=["POST"])
 @login_required
 def delete_care_profile(profile_id):
     lang = get_request_lang()
     username = session.get("user")
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for("profile", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-    try:
+
+    def remove_profile(conn):
         conn.execute(
             "DELETE FROM care_profiles WHERE id = ? AND owner_username = ?",
             (profile_id, username)
@@ -1696,10 +5254,13 @@ def delete_care_profile(profile_id):
             "UPDATE medical_appointments SET profile_id = NULL, updated_at = CURRENT_TIMESTAMP WHERE profile_id = ? AND owner_username = ?",
             (profile_id, username)
         )
-        conn.commit()
-        return redirect(url_for("profile", success=("Care recipient removed" if lang == "en" else "受照護對象已移除"), lang=lang))
-    finally:
-        conn.close()
+        bump_auth_epoch(conn, [username])
+
+    try:
+        run_db_write(remove_profile)
+    except Exception as e:
+        return redirect(url_for("profile", error=build_write_error_message(e, lang, "delete"), lang=lang))
+    return redirect(url_for("profile", success=("Care recipient removed" if lang == "en" else "受照護對象已移除"), lang=lang))
 
 @app.route("/family/link/add", methods=["POST"])
 @login_required
@@ -1716,39 +5277,45 @@ def add_family_link():
     if not linked_user:
         return redirect(url_for("profile", error=("The target account does not exist" if lang == "en" else "找不到這個帳號"), lang=lang))
 
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for("profile", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-    try:
+    def save_link(conn):
         conn.execute(
-            """INSERT INTO care_links (owner_username, linked_username, note, status)
-               VALUES (?, ?, ?, 'active')
-               ON CONFLICT(owner_username, linked_username)
-               DO UPDATE SET note=excluded.note, status='active'""",
+            build_upsert_sql(
+                "care_links",
+                ("owner_username", "linked_username", "note", "status"),
+                ("owner_username", "linked_username"),
+                {"note": None, "status": "'active'"},
+                values={"status": "'active'"},
+            ),
             (username, linked_username, note)
         )
-        conn.commit()
-        return redirect(url_for("profile", success=("Linked account authorized" if lang == "en" else "家族連動帳號已授權"), lang=lang))
-    finally:
-        conn.close()
+        refresh_user_access_for_link(conn, linked_username)
+
+    try:
+        run_db_write(save_link)
+    except Exception as e:
+        return redirect(url_for("profile", error=build_write_error_message(e, lang), lang=lang))
+    return redirect(url_for("profile", success=("Linked account authorized" if lang == "en" else "家族連動帳號已授權"), lang=lang))
 
 @app.route("/family/link/delete/<int:link_id>", methods=["POST"])
 @login_required
 def delete_family_link(link_id):
     lang = get_request_lang()
     username = session.get("user")
-    conn = get_db_connection()
-    if not conn:
-        return redirect(url_for("profile", error=("Database connection failed" if lang == "en" else "資料庫連線失敗"), lang=lang))
-    try:
-        conn.execute(
-            "DELETE FROM care_links WHERE id = ? AND owner_username = ?",
+    def remove_link(conn):
+        row = conn.execute(
+            "SELECT linked_username FROM care_links WHERE id = ? AND owner_username = ?",
             (link_id, username)
-        )
-        conn.commit()
-        return redirect(url_for("profile", success=("Linked account removed" if lang == "en" else "家族連動帳號已解除授權"), lang=lang))
-    finally:
-        conn.close()
+        ).fetchone()
+        if not row:
+            return
+        conn.execute("DELETE FROM care_links WHERE id = ?", (link_id,))
+        refresh_user_access_for_link(conn, row["linked_username"])
+
+    try:
+        run_db_write(remove_link)
+    except Exception as e:
+        return redirect(url_for("profile", error=build_write_error_message(e, lang, "delete"), lang=lang))
+    return redirect(url_for("profile", success=("Linked account removed" if lang == "en" else "家族連動帳號已解除授權"), lang=lang))
 
 # === Appointment Features ===
 @app.route("/appointment", methods=["GET", "POST"])
@@ -1757,23 +5324,14 @@ def appointment():
     lang = get_request_lang()
     min_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
     doctors_map = get_doctors_by_department()
-    manageable_people = get_manageable_people(session.get("user"), lang)
-    default_target = request.args.get("target_profile") or (manageable_people[0]["target_value"] if manageable_people else f"user:{session.get('user')}")
+    # 送出表單成功時不需要整份可代辦清單，只在需要重新顯示表單時才建立
+    def load_targets():
+        manageable_people = get_manageable_people(session.get("user"), lang)
+        default_target = request.args.get("target_profile") or (manageable_people[0]["target_value"] if manageable_people else f"user:{session.get('user')}")
+        return manageable_people, default_target
+
     if request.method == "POST":
         form = request.form
-        conn = get_db_connection()
-        if not conn:
-            return render_template(
-                "appointment.html",
-                username=session.get("user"),
-                lang=lang,
-                error="Database connection failed",
-                form_data=form,
-                min_date=min_date,
-                doctor_options=doctors_map,
-                manageable_people=manageable_people
-            )
-
         try:
             resolved_target = resolve_manageable_target(session.get("user"), form.get("target_profile"), lang)
             if not resolved_target:
@@ -1785,7 +5343,7 @@ def appointment():
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')"""
             symptoms = form.get("symptoms", "").strip() or None
             patient_id = form.get("patient_id", "").strip() or None
-            conn.execute(sql, (
+            params = (
                 resolved_target["owner_username"],
                 resolved_target["owner_username"],
                 resolved_target.get("profile_id"),
@@ -1798,11 +5356,12 @@ def appointment():
                 form["appointment_date"],
                 form["appointment_time"],
                 symptoms
-            ))
-            conn.commit()
+            )
+            run_db_write(lambda conn: conn.execute(sql, params))
             success_msg = "Appointment created successfully!" if lang == 'en' else "Appointment created"
             return redirect(url_for("appointment_list", success=success_msg, lang=lang))
         except Exception as e:
+            manageable_people, default_target = load_targets()
             form_data = dict(form)
             form_data["target_profile"] = form.get("target_profile", default_target)
             return render_template(
@@ -1815,8 +5374,7 @@ def appointment():
                 doctor_options=doctors_map,
                 manageable_people=manageable_people
             )
-        finally:
-            conn.close()
+    manageable_people, default_target = load_targets()
     return render_template(
         "appointment.html",
         username=session.get("user"),
@@ -1832,8 +5390,11 @@ def appointment():
 def appointment_list():
     lang = normalize_lang(request.args.get('lang', 'zh'))
     username = session.get("user")
+    limit, after, before = get_page_args()
+    history = request.args.get("history") == "1"
     try:
-        appointments = get_accessible_appointments(username)
+        page = get_appointment_page(username, after=after, before=before, limit=limit, history=history)
+        appointments = page["items"]
         for apt in appointments:
             if apt.get('appointment_date') and not isinstance(apt['appointment_date'], str):
                 apt['appointment_date'] = apt['appointment_date'].strftime('%Y-%m-%d')
@@ -1846,6 +5407,10 @@ def appointment_list():
             username=username,
             lang=lang,
             appointments=appointments,
+            next_cursor=page["next_cursor"],
+            prev_cursor=page["prev_cursor"],
+            page_limit=limit,
+            history=history,
             success=request.args.get("success"),
             error=request.args.get("error"),
             accessible_owners=get_accessible_owner_usernames(username)
@@ -1856,10 +5421,23 @@ def appointment_list():
             username=username,
             lang=lang,
             appointments=[],
+            page_limit=limit,
+            history=history,
             error=str(e),
             accessible_owners=get_accessible_owner_usernames(username)
         )
 
+@app.route("/api/appointments")
+@login_required
+def appointment_list_api():
+    """JSON 版預約列表，游標參數（after / before / limit / history）與 /appointment/list 相同。"""
+    limit, after, before = get_page_args()
+    page = get_appointment_page(
+        session.get("user"), request.args.get("keyword", "").strip(), after, before, limit,
+        history=request.args.get("history") == "1"
+    )
+    return jsonify({"success": True, **page})
+
 # === AI 模型設定 ===
 medical_system_prompt = """你是一位專業的醫療AI助理，專門協助處理醫療相關問題和預約服務。
 
@@ -1949,7 +5527,7 @@ def resolve_gemini_api_key():
 def init_gemini_model():
     global gemini_model
 
-    if is_set_api_key_command():
+    if is_set_api_key_command() or get_db_command():
         return
 
     api_key = resolve_gemini_api_key()
@@ -1995,7 +5573,11 @@ def get_whisper_model():
     return whisper_model
 
 def get_user_by_username(username):
-    """從 SQLite 查詢使用者。"""
+    """從 SQLite 查詢使用者（同一請求內只查一次）；回傳副本，呼叫端修改不會影響之後的讀取。"""
+    user = request_memo(("user", username), lambda: _load_user_by_username(username))
+    return dict(user) if user else None
+
+def _load_user_by_username(username):
     conn = get_db_connection()
     if not conn: return None
     try:
@@ -2021,10 +5603,6 @@ def query_appointments_by_keyword(username, keyword=""):
 
 def create_appointment_via_ai(username, appointment_data):
     """通過 AI 創建預約"""
-    conn = get_db_connection()
-    if not conn:
-        return {"success": False, "error": "資料庫連接失敗"}
-    
     try:
         # 驗證必填欄位
         required_fields = ['patient_name', 'patient_phone', 'department', 'doctor_name', 'appointment_date', 'appointment_time']
@@ -2044,13 +5622,15 @@ def create_appointment_via_ai(username, appointment_data):
             return {"success": False, "error": "日期或時間格式錯誤"}
         
         sql = """INSERT INTO medical_appointments 
-                (username, patient_id, patient_name, patient_phone, department, doctor_name, 
+                (username, owner_username, created_by_username, patient_id, patient_name, patient_phone, department, doctor_name, 
                     appointment_date, appointment_time, symptoms, status) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')"""
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')"""
         symptoms = appointment_data.get("symptoms", "").strip() or None
         patient_id = appointment_data.get("patient_id", "").strip() or None
         
-        cursor = conn.execute(sql, (
+        appointment_id = run_db_write(lambda conn: conn.execute(sql, (
+            username,
+            username,
             username,
             patient_id,
             appointment_data['patient_name'],
@@ -2060,16 +5640,12 @@ def create_appointment_via_ai(username, appointment_data):
             appointment_data['appointment_date'],
             appointment_data['appointment_time'],
             symptoms
-        ))
-        appointment_id = cursor.lastrowid
-        conn.commit()
+        )).lastrowid)
         
         return {"success": True, "appointment_id": appointment_id, "message": "預約已成功創建"}
     except Exception as e:
         print(f"[錯誤] 創建預約失敗: {e}")
         return {"success": False, "error": str(e)}
-    finally:
-        conn.close()
 
 def update_appointment_via_ai(username, appointment_id, update_data):
     """通過 AI 修改預約"""
@@ -2102,8 +5678,7 @@ def update_appointment_via_ai(username, appointment_id, update_data):
         update_values.append(appointment_id)
         
         sql = f"UPDATE medical_appointments SET {', '.join(update_fields)} WHERE id = ?"
-        conn.execute(sql, update_values)
-        conn.commit()
+        run_db_write(lambda write_conn: write_conn.execute(sql, update_values))
         
         return {"success": True, "message": "預約已成功更新"}
     except Exception as e:
@@ -2530,6 +6105,22 @@ def clear_history():
 if __name__ == "__main__":
     if is_set_api_key_command():
         handle_set_api_key_command()
+    elif is_migrate_command():
+        run_migrate_command()
+    elif get_db_command() == "check-query-plans":
+        sys.exit(0 if check_list_query_plans() else 1)
+    elif get_db_command() == "archive":
+        run_archive_command()
+    elif get_db_command() in ("import", "export"):
+        run_bulk_command(get_db_command())
+    elif get_db_command() == "backup":
+        run_backup_command()
+    elif get_db_command() == "rebuild-adherence":
+        run_rebuild_adherence_command()
+    elif get_db_command() == "rebuild-access":
+        run_rebuild_access_command()
+    elif get_db_command() == "dispatch-reminders":
+        run_dispatch_reminders_command()
     else:
         app.run(debug=True)
 
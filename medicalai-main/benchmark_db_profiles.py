@@ -0,0 +1,155 @@
+"""
+SQLite 併發設定效能比較
+
+以多個行程模擬 gunicorn worker，分別在 legacy（rollback journal）與 wal 設定下
+對 /appointment/list、/medication/list 讀取並寫入 /medication/log，比較吞吐量與失敗次數。
+每個設定使用獨立的暫存資料庫，不會動到 medical_appointments.db。
+
+用法：python benchmark_db_profiles.py [--workers 4] [--seconds 10] [--rows 2000] [--write-ratio 0.2]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCH_USER = "bench_user"
+BENCH_PASSWORD = "bench_password"
+
+
+def load_app(profile, db_file):
+    os.environ["DB_PROFILE"] = profile
+    os.environ["SQLITE_DB_FILE"] = db_file
+    import app as app_module
+    return app_module
+
+
+def seed_database(profile, db_file, rows):
+    app_module = load_app(profile, db_file)
+    client = app_module.app.test_client()
+    client.post("/register", data={"username": BENCH_USER, "password": BENCH_PASSWORD, "name": "Bench"})
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    conn.executemany(
+        """INSERT INTO medical_appointments
+           (username, owner_username, created_by_username, patient_name, patient_phone, department, doctor_name,
+            appointment_date, appointment_time, status)
+           VALUES (?, ?, ?, ?, ?, '內科', '張內晨', ?, ?, 'pending')""",
+        [
+            (BENCH_USER, BENCH_USER, BENCH_USER, f"病患{i}", f"09{i:08d}",
+             f"2025-{(i % 12) + 1:02d}-{(i % 28) + 1:02d}", f"{9 + i % 12:02d}:00")
+            for i in range(rows)
+        ]
+    )
+    conn.executemany(
+        """INSERT INTO medications
+           (username, owner_username, created_by_username, medication_name, dosage, frequency, reminder_times,
+            start_date, status)
+           VALUES (?, ?, ?, ?, '1 顆', '每日兩次', '08:00,20:00', '2024-01-01', ?)""",
+        [
+            (BENCH_USER, BENCH_USER, BENCH_USER, f"Medication {i}", "active" if i % 4 else "inactive")
+            for i in range(max(rows // 10, 1))
+        ]
+    )
+    # 直接 INSERT 不會產生提醒時間列，補上後 /medication/log 才會接受 08:00 / 20:00
+    app_module.sync_medication_reminders(conn)
+    conn.commit()
+    medication_ids = [row[0] for row in conn.execute("SELECT id FROM medications WHERE status = 'active'")]
+    conn.close()
+    return medication_ids
+
+
+def run_worker(profile, db_file, seconds, write_ratio, medication_ids, results):
+    app_module = load_app(profile, db_file)
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": BENCH_USER, "password": BENCH_PASSWORD})
+    counts = {"reads": 0, "writes": 0, "errors": 0, "write_errors": 0, "read_time": 0.0, "write_time": 0.0}
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        started = time.perf_counter()
+        if random.random() < write_ratio:
+            response = client.post(
+                f"/medication/log/{random.choice(medication_ids)}",
+                data={
+                    "reminder_time": random.choice(["08:00", "20:00"]),
+                    "status": random.choice(["taken", "skipped"]),
+                    "log_date": f"2026-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+                },
+            )
+            ok = response.status_code == 302 and "error=" not in response.headers.get("Location", "")
+            counts["writes"] += 1
+            counts["write_time"] += time.perf_counter() - started
+            if not ok:
+                counts["write_errors"] += 1
+        else:
+            response = client.get(random.choice(["/appointment/list", "/medication/list"]))
+            ok = response.status_code == 200
+            counts["reads"] += 1
+            counts["read_time"] += time.perf_counter() - started
+        if not ok:
+            counts["errors"] += 1
+    results.put(counts)
+
+
+def benchmark_profile(profile, args):
+    workdir = tempfile.mkdtemp(prefix=f"bench_{profile}_")
+    db_file = os.path.join(workdir, "bench.db")
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        medication_ids = pool.apply(seed_database, (profile, db_file, args.rows))
+
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_worker, args=(profile, db_file, args.seconds, args.write_ratio, medication_ids, results))
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    totals = {"reads": 0, "writes": 0, "errors": 0, "write_errors": 0, "read_time": 0.0, "write_time": 0.0}
+    for _ in workers:
+        for key, value in results.get().items():
+            totals[key] += value
+    for worker in workers:
+        worker.join()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較 SQLite 併發設定下列表頁的讀寫吞吐量")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--profiles", nargs="+", default=["legacy", "wal"])
+    args = parser.parse_args()
+
+    print("=" * 72)
+    print(f"SQLite 併發設定比較：{args.workers} 個 worker，{args.seconds} 秒，{args.rows} 筆預約")
+    print("=" * 72)
+    report = []
+    for profile in args.profiles:
+        totals = benchmark_profile(profile, args)
+        report.append((profile, totals))
+
+    print(f"\n{'設定':<8}{'讀取/秒':>10}{'寫入/秒':>10}{'讀取平均(ms)':>14}{'寫入平均(ms)':>14}{'失敗':>8}")
+    for profile, totals in report:
+        read_avg = totals["read_time"] / totals["reads"] * 1000 if totals["reads"] else 0
+        write_avg = totals["write_time"] / totals["writes"] * 1000 if totals["writes"] else 0
+        print(
+            f"{profile:<8}{totals['reads'] / args.seconds:>10.1f}{totals['writes'] / args.seconds:>10.1f}"
+            f"{read_avg:>14.1f}{write_avg:>14.1f}{totals['errors']:>8}"
+        )
+
+    # 寫入失敗代表比較的是被拒絕的請求而不是實際寫入，結果不可信
+    write_errors = {profile: totals["write_errors"] for profile, totals in report if totals["write_errors"]}
+    if write_errors:
+        print(f"\n[錯誤] 有寫入失敗，比較結果無效：{write_errors}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
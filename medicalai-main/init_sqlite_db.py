@@ -17,8 +17,12 @@ print("=" * 60)
 if os.path.exists(DB_FILE):
     backup_file = f"{DB_FILE}.backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
     print(f"\n[注意] 資料庫檔案已存在，正在備份為: {backup_file}")
-    import shutil
-    shutil.copy2(DB_FILE, backup_file)
+    # 使用 SQLite backup API，應用程式正在寫入時也能得到一致的副本（直接複製檔案會漏掉 WAL 中的變更）
+    source_conn = sqlite3.connect(DB_FILE)
+    backup_conn = sqlite3.connect(backup_file)
+    source_conn.backup(backup_conn)
+    backup_conn.close()
+    source_conn.close()
 
 # 連接資料庫（如果不存在會自動創建）
 conn = sqlite3.connect(DB_FILE)
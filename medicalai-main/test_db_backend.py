@@ -0,0 +1,123 @@
+"""
+資料庫後端測試
+
+以 app.py 的連線管理器對目前設定的後端（DB_BACKEND）執行遷移、連線池、placeholder 轉換與 upsert 檢查。
+測試資料會在結束時刪除。
+
+用法：
+  python test_db_backend.py                                   # SQLite（預設）
+  DB_BACKEND=mysql DB_HOST=127.0.0.1 DB_PASSWORD=secret python test_db_backend.py
+  DB_BACKEND=postgresql DB_HOST=127.0.0.1 DB_PASSWORD=secret python test_db_backend.py
+
+本機可用容器代替正式資料庫：
+  docker run -d -p 3306:3306 -e MYSQL_ROOT_PASSWORD=secret -e MYSQL_DATABASE=medical_db mysql:8
+  docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=secret -e POSTGRES_DB=medical_db postgres:16
+"""
+
+import sys
+
+import app as app_module
+
+TEST_USER = "backend_test_user"
+TEST_LINKED_USER = "backend_test_linked"
+
+
+def check(label, passed, detail=""):
+    print(f"  {'✅' if passed else '❌'} {label}{('：' + str(detail)) if detail else ''}")
+    return passed
+
+
+def cleanup(conn):
+    conn.execute("DELETE FROM medication_logs WHERE owner_username = ?", (TEST_USER,))
+    conn.execute("DELETE FROM medications WHERE owner_username = ?", (TEST_USER,))
+    conn.execute("DELETE FROM care_links WHERE owner_username = ?", (TEST_USER,))
+    conn.execute("DELETE FROM users WHERE username IN (?, ?)", (TEST_USER, TEST_LINKED_USER))
+    conn.commit()
+
+
+def main():
+    print("=" * 60)
+    print(f"資料庫後端測試：{app_module.DB_BACKEND}")
+    print("=" * 60)
+    results = []
+
+    print("\n[1] schema 遷移")
+    app_module.migrate_db()
+    conn = app_module.get_db_connection()
+    if not conn:
+        print("  ❌ 資料庫連線失敗")
+        sys.exit(1)
+    try:
+        version = app_module.get_schema_version(conn)
+        results.append(check("schema 版本", version == app_module.LATEST_SCHEMA_VERSION, f"v{version}"))
+    finally:
+        conn.close()
+
+    print("\n[2] 連線池")
+    before = app_module.get_db_pool_stats()
+    app_module.get_db_connection().close()
+    after = app_module.get_db_pool_stats()
+    expected_reuse = app_module.DB_POOL_SIZE > 0
+    results.append(check("連線重用", (after["reused"] > before["reused"]) == expected_reuse, after))
+
+    conn = app_module.get_db_connection()
+    try:
+        cleanup(conn)
+
+        print("\n[3] placeholder 轉換")
+        row = conn.execute("SELECT '?' AS mark, ? AS value", (42,)).fetchone()
+        results.append(check("字串常值內的 ? 不轉換", row["mark"] == "?" and row["value"] == 42, dict(row)))
+
+        print("\n[4] lastrowid")
+        cursor = conn.execute(
+            """INSERT INTO medications
+               (username, owner_username, created_by_username, medication_name, dosage, frequency, reminder_times, start_date)
+               VALUES (?, ?, ?, 'Backend Test', '1 顆', '每日一次', '08:00', '2024-01-01')""",
+            (TEST_USER, TEST_USER, TEST_USER)
+        )
+        medication_id = cursor.lastrowid
+        conn.commit()
+        stored = conn.execute("SELECT medication_name, start_date FROM medications WHERE id = ?", (medication_id,)).fetchone()
+        results.append(check("新增後取得 id", stored is not None, medication_id))
+        results.append(check("日期以字串回傳", stored is not None and stored["start_date"] == "2024-01-01", stored and stored["start_date"]))
+
+        print("\n[5] upsert")
+        upsert_sql = app_module.build_upsert_sql(
+            "medication_logs",
+            ("medication_id", "owner_username", "log_date", "reminder_time", "status", "note", "created_by_username", "taken_at"),
+            ("medication_id", "log_date", "reminder_time"),
+            {"status": None, "note": None, "created_by_username": None, "taken_at": "CURRENT_TIMESTAMP"},
+            values={"taken_at": "CURRENT_TIMESTAMP"},
+        )
+        for status in ("taken", "skipped"):
+            conn.execute(upsert_sql, (medication_id, TEST_USER, "2024-01-01", "08:00", status, "", TEST_USER))
+        conn.commit()
+        logs = conn.execute("SELECT status FROM medication_logs WHERE medication_id = ?", (medication_id,)).fetchall()
+        results.append(check("用藥紀錄只保留一筆並更新狀態", len(logs) == 1 and logs[0]["status"] == "skipped", [log["status"] for log in logs]))
+
+        link_sql = app_module.build_upsert_sql(
+            "care_links",
+            ("owner_username", "linked_username", "note", "status"),
+            ("owner_username", "linked_username"),
+            {"note": None, "status": "'active'"},
+            values={"status": "'active'"},
+        )
+        for note in ("first", "second"):
+            conn.execute(link_sql, (TEST_USER, TEST_LINKED_USER, note))
+        conn.commit()
+        links = conn.execute("SELECT note FROM care_links WHERE owner_username = ?", (TEST_USER,)).fetchall()
+        results.append(check("家族連動只保留一筆並更新備註", len(links) == 1 and links[0]["note"] == "second", [link["note"] for link in links]))
+    finally:
+        cleanup(conn)
+        conn.close()
+
+    print()
+    if all(results):
+        print("[完成] 所有檢查通過")
+    else:
+        print("[失敗] 部分檢查未通過")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
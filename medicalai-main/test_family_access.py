@@ -0,0 +1,131 @@
+"""
+家族代辦權限測試
+
+以 Flask test client 走過「授權家族帳號 → 新增受照護對象 → 解除授權」的流程，確認：
+  - 新增 / 解除家族連動時 user_access 會在同一個交易內更新
+  - 被授權帳號 session 中快取的可代辦帳號，在授權變動後的下一個請求就會失效（解除授權後立即無法再看到對方資料）
+測試資料會在結束時刪除。
+
+用法：
+  python test_family_access.py
+"""
+
+import sys
+
+from werkzeug.security import generate_password_hash
+
+import app as app_module
+
+TEST_OWNER = "access_test_owner"
+TEST_CAREGIVER = "access_test_caregiver"
+TEST_PASSWORD = "access-test-password"
+TEST_PROFILE_NAME = "權限測試長輩"
+TEST_MEDICATION_NAME = "Access Test Medication"
+
+
+def check(label, passed, detail=""):
+    print(f"  {'✅' if passed else '❌'} {label}{('：' + str(detail)) if detail else ''}")
+    return passed
+
+
+def cleanup(conn):
+    usernames = (TEST_OWNER, TEST_CAREGIVER)
+    conn.execute("DELETE FROM medication_reminders WHERE medication_id IN (SELECT id FROM medications WHERE owner_username IN (?, ?))", usernames)
+    conn.execute("DELETE FROM medications WHERE owner_username IN (?, ?)", usernames)
+    conn.execute("DELETE FROM care_profiles WHERE owner_username IN (?, ?)", usernames)
+    conn.execute("DELETE FROM care_links WHERE owner_username IN (?, ?) OR linked_username IN (?, ?)", usernames * 2)
+    conn.execute("DELETE FROM user_access WHERE manager_username IN (?, ?) OR owner_username IN (?, ?)", usernames * 2)
+    conn.execute("DELETE FROM users WHERE username IN (?, ?)", usernames)
+    conn.commit()
+
+
+def login(username):
+    client = app_module.app.test_client()
+    client.post("/login", data={"username": username, "password": TEST_PASSWORD})
+    return client
+
+
+def visible_medications(client):
+    """被授權帳號透過列表 API 看得到的測試用藥名稱。"""
+    items = client.get("/api/medications?limit=100").get_json()["items"]
+    return [item["medication_name"] for item in items if item["medication_name"] == TEST_MEDICATION_NAME]
+
+
+def has_access_row(conn):
+    row = conn.execute(
+        "SELECT 1 FROM user_access WHERE manager_username = ? AND owner_username = ?",
+        (TEST_CAREGIVER, TEST_OWNER)
+    ).fetchone()
+    return row is not None
+
+
+def main():
+    print("=" * 60)
+    print(f"家族代辦權限測試：{app_module.DB_BACKEND}")
+    print("=" * 60)
+    results = []
+
+    app_module.migrate_db()
+    conn = app_module.get_db_connection()
+    if not conn:
+        print("  ❌ 資料庫連線失敗")
+        sys.exit(1)
+    try:
+        cleanup(conn)
+        for username in (TEST_OWNER, TEST_CAREGIVER):
+            conn.execute(
+                "INSERT INTO users (username, password_hash, name, phone, identity_id) VALUES (?, ?, ?, '', '')",
+                (username, generate_password_hash(TEST_PASSWORD), username)
+            )
+        conn.execute(
+            """INSERT INTO medications
+               (username, owner_username, created_by_username, medication_name, dosage, frequency, reminder_times, start_date)
+               VALUES (?, ?, ?, ?, '1 顆', '每日一次', '08:00', '2024-01-01')""",
+            (TEST_OWNER, TEST_OWNER, TEST_OWNER, TEST_MEDICATION_NAME)
+        )
+        conn.commit()
+
+        owner_client = login(TEST_OWNER)
+        caregiver_client = login(TEST_CAREGIVER)
+
+        print("\n[1] 授權前")
+        # 先讀一次，讓可代辦帳號快取進 session
+        results.append(check("看不到對方的用藥", visible_medications(caregiver_client) == []))
+        results.append(check("user_access 沒有授權", not has_access_row(conn)))
+
+        print("\n[2] 授權家族帳號")
+        owner_client.post("/family/link/add", data={"linked_username": TEST_CAREGIVER, "note": "test"})
+        results.append(check("user_access 已新增授權", has_access_row(conn)))
+        results.append(check("下一個請求就看得到對方的用藥", visible_medications(caregiver_client) == [TEST_MEDICATION_NAME]))
+
+        print("\n[3] 新增受照護對象")
+        owner_client.post("/family/profile/add", data={"profile_name": TEST_PROFILE_NAME, "relationship": "父親"})
+        page = caregiver_client.get("/medication").get_data(as_text=True)
+        results.append(check("被授權帳號可代辦新的受照護對象", TEST_PROFILE_NAME in page))
+        # 以目前的版本號重新快取可代辦帳號，確認接下來的失效是由解除授權觸發
+        results.append(check("仍看得到對方的用藥", visible_medications(caregiver_client) == [TEST_MEDICATION_NAME]))
+
+        print("\n[4] 解除授權")
+        link = conn.execute(
+            "SELECT id FROM care_links WHERE owner_username = ? AND linked_username = ?",
+            (TEST_OWNER, TEST_CAREGIVER)
+        ).fetchone()
+        owner_client.post(f"/family/link/delete/{link['id']}")
+        results.append(check("user_access 已移除授權", not has_access_row(conn)))
+        results.append(check("session 快取失效，下一個請求就看不到對方的用藥", visible_medications(caregiver_client) == []))
+        page = caregiver_client.get("/medication").get_data(as_text=True)
+        results.append(check("不再能代辦對方的受照護對象", TEST_PROFILE_NAME not in page))
+    finally:
+        cleanup(conn)
+        conn.close()
+
+    print()
+    if all(results):
+        print("[完成] 所有檢查通過")
+    else:
+        print("[失敗] 部分檢查未通過")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()